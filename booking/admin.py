@@ -1,8 +1,13 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.db import transaction
+from django.utils import timezone
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Service, Appointment, WorkingHours, Holiday
+from .models import Service, Barber, Appointment, WorkingHours, Holiday, NotificationOutbox, NotificationLedger, InboundEvent, ProcessedMessage, IdempotencyKey
+from .availability_cache import bump_availability_version
+from .ledger import exclude_notified
+from .notifications import NOTIFICATION_PLAN, enqueue_bulk_notifications
 
 @admin.register(Service)
 class ServiceAdmin(admin.ModelAdmin):
@@ -25,14 +30,22 @@ class ServiceAdmin(admin.ModelAdmin):
         }),
     )
 
+@admin.register(Barber)
+class BarberAdmin(admin.ModelAdmin):
+    list_display = ['name', 'is_active', 'created_at']
+    list_filter = ['is_active']
+    search_fields = ['name']
+    ordering = ['name']
+    readonly_fields = ['created_at', 'updated_at']
+
 @admin.register(Appointment)
 class AppointmentAdmin(admin.ModelAdmin):
     list_display = [
-        'appointment_id_short', 'customer_name', 'service', 'date', 'time', 
+        'appointment_id_short', 'customer_name', 'service', 'barber', 'date', 'time', 
         'status', 'phone', 'created_at'
     ]
     list_filter = [
-        'status', 'date', 'service', 'created_at', 'whatsapp_sent'
+        'status', 'date', 'service', 'barber', 'created_at', 'whatsapp_sent'
     ]
     search_fields = ['name', 'email', 'phone', 'appointment_id']
     ordering = ['-date', '-time']
@@ -46,11 +59,11 @@ class AppointmentAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         """Optimize queries with select_related to avoid N+1 queries"""
-        return super().get_queryset(request).select_related('service')
+        return super().get_queryset(request).select_related('service', 'barber')
     
     fieldsets = (
         ('Appointment Information', {
-            'fields': ('appointment_id', 'service', 'date', 'time', 'duration', 'status')
+            'fields': ('appointment_id', 'service', 'barber', 'date', 'time', 'duration', 'status')
         }),
         ('Customer Details', {
             'fields': ('name', 'email', 'phone', 'notes')
@@ -77,39 +90,82 @@ class AppointmentAdmin(admin.ModelAdmin):
         return obj.name
     customer_name.short_description = "Customer"
     
+    def change_status(self, queryset, status, timestamp_field=None):
+        """
+        Move the selected appointments to a status with a single UPDATE and
+        queue their notifications for background delivery.
+        
+        Appointments already in that status are left alone. Returns the
+        number of appointments changed and of notifications queued.
+        """
+        now = timezone.now()
+        updates = {'status': status, 'updated_at': now}
+        if timestamp_field:
+            updates[timestamp_field] = now
+        
+        with transaction.atomic():
+            # Load only what the outbox rows need, without the service/barber joins
+            appointments = list(
+                queryset.select_related(None).exclude(status=status).only('id', 'date', 'email', 'phone')
+            )
+            changed = Appointment.objects.filter(pk__in=[appointment.pk for appointment in appointments]).update(**updates)
+            queued = enqueue_bulk_notifications(appointments, status) if status in NOTIFICATION_PLAN else []
+            
+            # queryset.update() skips model signals, so invalidate explicitly
+            dates = {appointment.date for appointment in appointments}
+            transaction.on_commit(lambda: bump_availability_version(*dates))
+        
+        return changed, len(queued)
+    
+    def report_queued(self, request, summary, queued, template):
+        """Report an action's result with a link to its notifications in the outbox"""
+        if not queued:
+            self.message_user(request, summary)
+            return
+        outbox_url = reverse('admin:booking_notificationoutbox_changelist') + f'?template__exact={template}'
+        self.message_user(request, format_html(
+            '{} {} notification(s) queued for delivery - <a href="{}">track progress in the outbox</a>.',
+            summary, queued, outbox_url
+        ))
+    
     def confirm_appointments(self, request, queryset):
         """Action to confirm selected appointments"""
-        from django.utils import timezone
-        updated = queryset.update(
-            status='confirmed', 
-            confirmed_at=timezone.now()
-        )
-        self.message_user(
-            request, 
-            f"Successfully confirmed {updated} appointment(s)."
-        )
+        selected = queryset.count()
+        changed, queued = self.change_status(queryset, 'confirmed', 'confirmed_at')
+        summary = f"Successfully confirmed {changed} appointment(s)."
+        if selected > changed:
+            summary += f" {selected - changed} were already confirmed."
+        self.report_queued(request, summary, queued, 'confirmed')
     confirm_appointments.short_description = "Confirm selected appointments"
     
     def mark_completed(self, request, queryset):
         """Action to mark appointments as completed"""
-        from django.utils import timezone
-        updated = queryset.update(
-            status='completed', 
-            completed_at=timezone.now()
-        )
-        self.message_user(
-            request, 
-            f"Successfully marked {updated} appointment(s) as completed."
-        )
+        selected = queryset.count()
+        changed, queued = self.change_status(queryset, 'completed', 'completed_at')
+        summary = f"Successfully marked {changed} appointment(s) as completed."
+        if selected > changed:
+            summary += f" {selected - changed} were already completed."
+        self.report_queued(request, summary, queued, 'completed')
     mark_completed.short_description = "Mark selected appointments as completed"
     
     def send_whatsapp_reminders(self, request, queryset):
-        """Action to send WhatsApp reminders"""
-        # This would integrate with your WhatsApp service
-        self.message_user(
-            request, 
-            f"WhatsApp reminders would be sent for {queryset.count()} appointment(s)."
-        )
+        """Action to queue WhatsApp reminders for upcoming appointments"""
+        upcoming = queryset.select_related(None).filter(status__in=['pending', 'confirmed'], date__gte=timezone.localdate())
+        selected = queryset.count()
+        eligible = upcoming.count()
+        with transaction.atomic():
+            appointments = list(exclude_notified(upcoming, 'whatsapp', 'reminder').only('id', 'email', 'phone'))
+            queued = enqueue_bulk_notifications(appointments, 'reminder', channels=['whatsapp'])
+        
+        if selected > eligible:
+            self.message_user(
+                request,
+                f"Skipped {selected - eligible} past, completed or cancelled appointment(s).",
+                level=messages.WARNING
+            )
+        if eligible > len(appointments):
+            self.message_user(request, f"Skipped {eligible - len(appointments)} appointment(s) that were already reminded.")
+        self.report_queued(request, f"Reminders queued for {len(appointments)} appointment(s).", len(queued), 'reminder')
     send_whatsapp_reminders.short_description = "Send WhatsApp reminders"
 
 @admin.register(WorkingHours)
@@ -152,6 +208,54 @@ class HolidayAdmin(admin.ModelAdmin):
     is_this_year.boolean = True
     is_this_year.short_description = "This Year"
 
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    list_display = [
+        'id', 'channel', 'template', 'appointment', 'status', 'attempts',
+        'next_attempt_at', 'sent_at'
+    ]
+    list_filter = ['status', 'channel', 'template']
+    search_fields = ['appointment__name', 'appointment__email', 'appointment__phone']
+    ordering = ['-id']
+    readonly_fields = ['created_at', 'sent_at', 'claimed_by', 'claimed_at', 'last_error']
+    list_select_related = ['appointment__service']
+    list_per_page = 50
+
+@admin.register(NotificationLedger)
+class NotificationLedgerAdmin(admin.ModelAdmin):
+    list_display = ['appointment', 'channel', 'event', 'status', 'provider_message_id', 'sent_at']
+    list_filter = ['status', 'channel', 'event']
+    search_fields = ['provider_message_id', 'appointment__name', 'appointment__phone', 'appointment__email']
+    readonly_fields = ['appointment', 'channel', 'event', 'status', 'provider_message_id', 'sent_at', 'updated_at']
+    list_select_related = ['appointment__service']
+    ordering = ['-updated_at']
+    list_per_page = 50
+
+@admin.register(InboundEvent)
+class InboundEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'sender', 'status', 'attempts', 'next_attempt_at', 'received_at', 'processed_at']
+    list_filter = ['status']
+    search_fields = ['sender']
+    readonly_fields = ['body', 'sender', 'attempts', 'next_attempt_at', 'last_error', 'claimed_by', 'claimed_at', 'received_at', 'processed_at']
+    ordering = ['-id']
+    list_per_page = 50
+
+@admin.register(ProcessedMessage)
+class ProcessedMessageAdmin(admin.ModelAdmin):
+    list_display = ['message_id', 'sender', 'processed_at']
+    search_fields = ['message_id', 'sender']
+    readonly_fields = ['message_id', 'sender', 'processed_at']
+    ordering = ['-processed_at']
+    list_per_page = 50
+
+@admin.register(IdempotencyKey)
+class IdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ['key', 'appointment', 'response_status', 'created_at', 'expires_at']
+    search_fields = ['key', 'appointment__appointment_id']
+    readonly_fields = ['key', 'request_hash', 'appointment', 'response_status', 'response_body', 'created_at', 'expires_at']
+    list_select_related = ['appointment__service']
+    ordering = ['-created_at']
+
 # Customize admin site
 admin.site.site_header = "FitBlendz Pro - Admin Dashboard"
 admin.site.site_title = "FitBlendz Pro Admin"
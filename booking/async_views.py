@@ -0,0 +1,331 @@
+"""
+Async versions of the I/O-bound public endpoints, for ASGI deployments.
+
+Enabled with ASYNC_VIEWS = True (see booking.urls) and served by uvicorn
+workers, so a slow database or Graph API call parks a coroutine instead of
+tying up a whole worker process. Reads use Django's async ORM; the booking
+transaction and the WhatsApp command handlers are synchronous code run via
+sync_to_async, and the replies they produce are sent concurrently with an
+async HTTP client. Unless WHATSAPP_WEBHOOK_PROCESSING is 'inline', the
+webhook only stores the delivery (see booking.inbound) and answers at once.
+
+The async HTTP client is kept per event loop and closed on the ASGI
+lifespan shutdown event (see fitblendz_pro.asgi).
+"""
+import asyncio
+import json
+import time
+import weakref
+from datetime import datetime
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.db import IntegrityError
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import aget_object_or_404, render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from . import views
+from .models import Appointment, Service
+from .availability_cache import get_cached_availability
+from .dedupe import is_redelivery
+from .idempotency import (
+    aget_stored_response, get_idempotency_key, replay_response, replay_retries, request_fingerprint, store_response,
+)
+from .inbound import processing_mode, record_inbound_event
+from .ratelimit import rate_limit
+from .reservations import reserve_appointment
+from .schedule import get_schedule
+from .structured_logging import Lazy, mask_phone, truncate
+from .utils import find_next_available_slots
+from .webhook_batch import WebhookBatch
+from .webhook_views import collect_replies, process_webhook_payload, signed_by_meta, verify_webhook
+from .whatsapp import get_whatsapp_scheduler, graph_headers, graph_messages_url, is_throttled, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# One HTTP client per event loop, so connections are reused across requests
+_graph_clients = weakref.WeakKeyDictionary()
+
+
+async def booking_page(request):
+    """Booking page; the form submission is handled asynchronously"""
+    if request.method == 'POST':
+        return await handle_booking_submission(request)
+    return await sync_to_async(views.booking_page)(request)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@replay_retries
+@rate_limit('booking')
+async def handle_booking_submission(request):
+    """Handle booking form submission"""
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+
+        # Retries with a stored response were already answered by replay_retries
+        try:
+            idempotency_key = get_idempotency_key(request, data)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+        fingerprint = request_fingerprint(data) if idempotency_key else None
+
+        # Validate required fields
+        missing_fields = [field for field in views.BOOKING_REQUIRED_FIELDS if not data.get(field)]
+
+        if missing_fields:
+            return JsonResponse({
+                'success': False,
+                'error': f'Missing required fields: {", ".join(missing_fields)}'
+            }, status=400)
+
+        # Validate service
+        try:
+            service = await Service.objects.aget(id=data['service'], is_active=True)
+        except Service.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Selected service is not available'
+            }, status=400)
+
+        # Validate date and time against the booking window and opening hours
+        schedule = await sync_to_async(get_schedule)()
+        error, appointment_date, appointment_time = views.check_booking_slot(data, schedule)
+        if error:
+            return JsonResponse({
+                'success': False,
+                'error': error
+            }, status=400)
+
+        # Store the response under the idempotency key in the booking transaction
+        def remember_response(appointment):
+            store_response(idempotency_key, fingerprint, views.booking_success_payload(appointment), appointment=appointment)
+
+        # The check-and-insert transaction runs on the sync thread, under the per-date lock
+        try:
+            appointment = await sync_to_async(reserve_appointment)(
+                service,
+                appointment_date,
+                appointment_time,
+                name=data['name'],
+                email=data['email'],
+                phone=data['phone'],
+                notes=data.get('notes', ''),
+                status='pending',
+                notify_event='pending',
+                on_reserved=remember_response if idempotency_key else None
+            )
+        except IntegrityError:
+            # A concurrent retry with the same key won; its booking was kept and ours rolled back
+            stored = await aget_stored_response(idempotency_key) if idempotency_key else None
+            if stored is None:
+                raise
+            return replay_response(stored, fingerprint)
+
+        if appointment is None:
+            # A concurrent retry with the same key may be the booking that took the slot
+            stored = await aget_stored_response(idempotency_key) if idempotency_key else None
+            if stored:
+                return replay_response(stored, fingerprint)
+            next_available = await sync_to_async(find_next_available_slots)(
+                service.id, datetime.combine(appointment_date, appointment_time), 3
+            )
+            return JsonResponse({
+                'success': False,
+                'error': 'This time slot is already booked. Please select another time.',
+                'next_available': next_available
+            }, status=400)
+
+        logger.info("Appointment created: %s for %s", appointment.id, appointment.name)
+
+        return JsonResponse(views.booking_success_payload(appointment))
+
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid request format'
+        }, status=400)
+    except Exception as e:
+        logger.error("Error handling booking submission: %s", e)
+        return JsonResponse({
+            'success': False,
+            'error': 'An error occurred while booking your appointment. Please try again.'
+        }, status=500)
+
+
+@rate_limit('available_times')
+async def get_available_times(request):
+    """Get available time slots for a given date"""
+    try:
+        date_str = request.GET.get('date')
+        if not date_str:
+            return JsonResponse({'error': 'Date parameter is required'}, status=400)
+
+        appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+
+        # Cache hits return without a query; a miss computes on the sync thread
+        payload = await sync_to_async(get_cached_availability)(appointment_date, views.build_available_times)
+        return JsonResponse(payload)
+
+    except ValueError:
+        return JsonResponse({'error': 'Invalid date format'}, status=400)
+    except Exception as e:
+        logger.error("Error getting available times: %s", e)
+        return JsonResponse({'error': 'An error occurred'}, status=500)
+
+
+@rate_limit('appointment_status')
+async def appointment_status(request, appointment_id):
+    """Check appointment status"""
+    try:
+        appointment = await aget_object_or_404(
+            Appointment.objects.select_related('service'), appointment_id=appointment_id
+        )
+
+        context = {
+            'appointment': appointment,
+            'page_title': f'Appointment Status - {appointment.appointment_id}'
+        }
+        return render(request, 'booking/appointment_status.html', context)
+
+    except Exception as e:
+        logger.error("Error in appointment_status view: %s", e)
+        # Message storage may load the session, which is synchronous
+        await sync_to_async(messages.error)(request, "Sorry, there was an error loading the appointment status.")
+        return render(request, 'booking/error.html', {'error': str(e)})
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@rate_limit('webhook', exempt=signed_by_meta)
+async def whatsapp_webhook(request):
+    """WhatsApp webhook handler for both verification and incoming messages"""
+    if request.method == "GET":
+        return verify_webhook(request)
+
+    try:
+        data = json.loads(request.body)
+
+        messages = WebhookBatch(data).messages
+        if messages and await sync_to_async(is_redelivery)(messages):
+            # Every message in it was handled already; just acknowledge it again
+            logger.info("Ignoring redelivered webhook event")
+            return HttpResponse('OK', content_type='text/plain')
+
+        if processing_mode() != 'inline':
+            # Store the delivery and acknowledge it; the handlers run in the background
+            await sync_to_async(record_inbound_event)(request.body, data)
+            return HttpResponse('OK', content_type='text/plain')
+
+        # Run the handlers, then send every reply they produced at once
+        with collect_replies() as replies:
+            await sync_to_async(process_webhook_payload)(data)
+
+        if replies:
+            await send_graph_payloads(replies)
+
+        return HttpResponse('OK', content_type='text/plain')
+
+    except json.JSONDecodeError as e:
+        logger.error("Invalid JSON in webhook: %s", e)
+        return HttpResponse('Invalid JSON', status=400, content_type='text/plain')
+    except Exception as e:
+        logger.error("Error processing webhook: %s", e)
+        return HttpResponse('Internal Error', status=500, content_type='text/plain')
+
+
+def get_graph_client():
+    """Return the async Graph API client for the running event loop"""
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = _graph_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.WHATSAPP_TIMEOUT, connect=settings.WHATSAPP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_keepalive_connections=settings.WHATSAPP_POOL_SIZE),
+            headers=graph_headers()
+        )
+        _graph_clients[loop] = client
+    return client
+
+
+async def close_graph_clients():
+    """Close the Graph API client of the running event loop, if it has one"""
+    client = _graph_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def lifespan(scope, receive, send):
+    """ASGI lifespan events; pooled Graph API connections are closed at shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            try:
+                await close_graph_clients()
+            except Exception as e:
+                logger.error("Error closing Graph API client: %s", e)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def send_graph_payload(client, url, payload):
+    """POST one message to the Graph API at the scheduler's rate; returns its message ID, or None on failure"""
+    scheduler = get_whatsapp_scheduler()
+    started = time.monotonic()
+    attempt = 0
+
+    while True:
+        await scheduler.limiter.aacquire()
+        try:
+            response = await client.post(url, json=payload)
+        except Exception as e:
+            logger.error("Request error sending WhatsApp message to %s: %s", mask_phone(payload.get('to', '')), e)
+            return None
+
+        if response.status_code == 200:
+            scheduler.limiter.succeeded()
+            message_id = response.json().get('messages', [{}])[0].get('id', '')
+            logger.info("WhatsApp message sent successfully to %s (ID: %s)", mask_phone(payload.get('to', '')), message_id or 'Unknown')
+            return message_id
+
+        try:
+            error_code = response.json().get('error', {}).get('code')
+        except ValueError:
+            error_code = None
+
+        if not is_throttled(response.status_code, error_code):
+            break
+
+        attempt += 1
+        if not scheduler.defer(attempt, started, response.status_code, error_code, parse_retry_after(response.headers)):
+            break
+
+    logger.error("WhatsApp API error: %s - %s", response.status_code, Lazy(truncate, response.text))
+    return None
+
+
+async def send_graph_payloads(replies):
+    """Send collected webhook replies concurrently and run their callbacks; returns how many succeeded"""
+    client = get_graph_client()
+    url = graph_messages_url()
+    message_ids = await asyncio.gather(*(send_graph_payload(client, url, reply.payload) for reply in replies))
+
+    delivered = [(reply, message_id) for reply, message_id in zip(replies, message_ids) if message_id is not None]
+    if any(reply.callbacks for reply, _ in delivered):
+        await sync_to_async(run_reply_callbacks)(delivered)
+    return len(delivered)
+
+
+def run_reply_callbacks(delivered):
+    """Record sent replies (e.g. in the notification ledger) in one thread hop"""
+    for reply, message_id in delivered:
+        reply.sent(message_id)
@@ -0,0 +1,323 @@
+"""
+Availability engine for FitBlendz Pro.
+
+Appointments for a day are loaded with a single query and converted to minute
+offsets from midnight. One sweep over their start/end events yields the
+intervals where every chair is taken, and each configured barber's own busy
+intervals are merged the same way. Free slots are then found with a second
+sweep over those intervals instead of a query or a full appointment scan per
+slot. A slot is listed only if one barber is free for all of it, which is the
+rule find_slot_barber() applies when the booking is made.
+"""
+from datetime import timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Slots are offered every 30 minutes from opening time
+SLOT_INTERVAL = 30
+
+# Appointments in these states block their time slot
+BLOCKING_STATUSES = ('pending', 'confirmed')
+
+# Customers can book at most this many days ahead
+BOOKING_HORIZON_DAYS = 90
+
+
+def time_to_minutes(value):
+    """Convert a time object to minutes since midnight"""
+    return value.hour * 60 + value.minute
+
+
+def minutes_to_slot(minutes):
+    """Format minutes since midnight as an 'HH:MM' slot string"""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def full_intervals(intervals, capacity=1):
+    """
+    Return the sorted, non-overlapping (start, end) minute intervals where
+    at least ``capacity`` of the given intervals overlap.
+
+    A single pass over the start/end events keeps a running occupancy
+    counter, so a day with N appointments costs O(N log N) regardless of
+    how many barbers or slots there are.
+    """
+    events = []
+    for start, end in intervals:
+        if end > start:
+            events.append((start, 1))
+            events.append((end, -1))
+
+    # Ends sort before starts at the same minute (intervals are half-open)
+    events.sort()
+
+    full = []
+    occupancy = 0
+    full_since = None
+    for minute, change in events:
+        occupancy += change
+        if full_since is None and occupancy >= capacity:
+            full_since = minute
+        elif full_since is not None and occupancy < capacity:
+            if minute > full_since:
+                full.append((full_since, minute))
+            full_since = None
+    return full
+
+
+def to_busy_intervals(appointments, capacity=1):
+    """Convert (time, duration) pairs into the intervals where every chair is taken"""
+    intervals = []
+    for appt_time, appt_duration in appointments:
+        start = time_to_minutes(appt_time)
+        intervals.append((start, start + appt_duration))
+    return full_intervals(intervals, capacity)
+
+
+def load_day_appointments(date):
+    """Load (time, duration, barber_id) for a date's blocking appointments in one query"""
+    from .models import Appointment
+
+    return list(Appointment.objects.filter(
+        date=date,
+        status__in=BLOCKING_STATUSES
+    ).order_by().values_list('time', 'duration', 'barber_id'))
+
+
+def day_busy_intervals(appointments, capacity=1, barber_ids=()):
+    """
+    Convert (time, duration, barber_id) tuples into (busy, barber_busy).
+
+    ``busy`` holds the intervals where every chair is taken. ``barber_busy``
+    holds each configured barber's own busy intervals, or None when no
+    barbers are configured and the shop runs a single chair.
+    """
+    appointments = list(appointments)
+    busy = to_busy_intervals(((t, d) for t, d, _ in appointments), capacity)
+    if not barber_ids:
+        return busy, None
+
+    by_barber = {barber_id: [] for barber_id in barber_ids}
+    for appt_time, appt_duration, appt_barber_id in appointments:
+        if appt_barber_id in by_barber:
+            start = time_to_minutes(appt_time)
+            by_barber[appt_barber_id].append((start, start + appt_duration))
+    return busy, [full_intervals(intervals) for intervals in by_barber.values()]
+
+
+def _fits(intervals, index, start, end):
+    """
+    Advance index past the intervals ending by ``start`` and check whether
+    [start, end) overlaps the next one; returns (fits, index).
+    """
+    while index < len(intervals) and intervals[index][1] <= start:
+        index += 1
+    return index == len(intervals) or intervals[index][0] >= end, index
+
+
+def compute_free_slots(open_time, close_time, busy, slot_length=SLOT_INTERVAL, step=SLOT_INTERVAL, barber_busy=None):
+    """
+    Return 'HH:MM' start times between open_time and close_time whose
+    [start, start + slot_length) window does not overlap a busy interval
+    and, if ``barber_busy`` is given, fits between one barber's appointments.
+
+    ``busy`` and each list in ``barber_busy`` must be sorted and
+    non-overlapping, as returned by day_busy_intervals().
+    """
+    if not open_time or not close_time:
+        return []
+
+    slots = []
+    close = time_to_minutes(close_time)
+    current = time_to_minutes(open_time)
+    index = 0
+    barber_indexes = [0] * len(barber_busy or ())
+
+    while current < close:
+        end = current + slot_length
+        free, index = _fits(busy, index, current, end)
+
+        if free and barber_busy is not None:
+            # Every barber's pointer moves forward so the sweep stays linear
+            free = False
+            for position, intervals in enumerate(barber_busy):
+                barber_free, barber_indexes[position] = _fits(intervals, barber_indexes[position], current, end)
+                free = free or barber_free
+
+        if free:
+            slots.append(minutes_to_slot(current))
+
+        current += step
+
+    return slots
+
+
+def get_free_slots(date, open_time, close_time, slot_length=SLOT_INTERVAL, capacity=1, barber_ids=()):
+    """Compute the free slots for a date inside the given opening hours"""
+    if not open_time or not close_time:
+        return []
+    busy, barber_busy = day_busy_intervals(load_day_appointments(date), capacity, barber_ids)
+    return compute_free_slots(open_time, close_time, busy, slot_length, barber_busy=barber_busy)
+
+
+def find_slot_barber(appointments, start_time, duration, capacity=1, barber_ids=()):
+    """
+    Check whether a new appointment fits among a day's appointments.
+
+    ``appointments`` holds (time, duration, barber_id) tuples as returned by
+    load_day_appointments(). Returns (available, barber_id) where barber_id
+    is an active barber with no overlapping appointment. When barbers are
+    configured the slot is only available if one of them is free for the
+    whole appointment; with none configured the shop runs a single chair and
+    a free slot returns (True, None). compute_free_slots() lists slots by the
+    same rule.
+    """
+    start = time_to_minutes(start_time)
+    end = start + duration
+
+    overlapping = []
+    for appt_time, appt_duration, appt_barber_id in appointments:
+        appt_start = time_to_minutes(appt_time)
+        if appt_start < end and start < appt_start + appt_duration:
+            overlapping.append((appt_time, appt_duration, appt_barber_id))
+
+    busy = to_busy_intervals(((t, d) for t, d, _ in overlapping), capacity)
+    if any(busy_start < end and start < busy_end for busy_start, busy_end in busy):
+        return False, None
+
+    taken = {appt_barber_id for _, _, appt_barber_id in overlapping}
+    for barber_id in barber_ids:
+        if barber_id not in taken:
+            return True, barber_id
+
+    # Every barber has an overlapping appointment, even if never all at once
+    return not barber_ids, None
+
+
+def load_busy_intervals_for_range(start_date, end_date, capacity=1, barber_ids=()):
+    """
+    Load (busy, barber_busy) intervals, as returned by day_busy_intervals(),
+    for every date in a range with a single query. Dates without appointments
+    are left out.
+    """
+    from .models import Appointment
+
+    appointments = Appointment.objects.filter(
+        date__range=(start_date, end_date),
+        status__in=BLOCKING_STATUSES
+    ).order_by().values_list('date', 'time', 'duration', 'barber_id')
+
+    by_date = {}
+    for appt_date, appt_time, appt_duration, appt_barber_id in appointments:
+        by_date.setdefault(appt_date, []).append((appt_time, appt_duration, appt_barber_id))
+
+    return {
+        appt_date: day_busy_intervals(day_appointments, capacity, barber_ids)
+        for appt_date, day_appointments in by_date.items()
+    }
+
+
+def get_availability_calendar(start_date, end_date, slot_length=SLOT_INTERVAL, include_times=True):
+    """
+    Return one entry per day between start_date and end_date (inclusive)
+    describing whether the shop is open and which slots are free.
+
+    Uses the cached schedule (one WorkingHours and one Holiday read when
+    cold) and one Appointment query for the whole range.
+    """
+    from .schedule import get_schedule
+
+    schedule = get_schedule()
+    busy_by_date = load_busy_intervals_for_range(start_date, end_date, schedule.capacity, schedule.barber_ids)
+
+    days = []
+    current = start_date
+    while current <= end_date:
+        day = {'date': current.isoformat()}
+        working_hours = schedule.hours_for(current)
+
+        if schedule.is_holiday(current):
+            day['status'] = 'holiday'
+            slots = []
+        elif not working_hours or not working_hours.is_open:
+            day['status'] = 'closed'
+            slots = []
+        else:
+            busy, barber_busy = busy_by_date.get(current, ([], None))
+            slots = compute_free_slots(
+                working_hours.open_time,
+                working_hours.close_time,
+                busy,
+                slot_length,
+                barber_busy=barber_busy
+            )
+            day['status'] = 'open' if slots else 'full'
+
+        day['available_count'] = len(slots)
+        if include_times:
+            day['available_times'] = slots
+
+        days.append(day)
+        current += timedelta(days=1)
+
+    return days
+
+
+# Days of appointments loaded per query when searching forward
+SEARCH_WINDOW_DAYS = 14
+
+
+def find_next_free_slots(start_date, start_minutes, slot_length, count, horizon_date):
+    """
+    Return up to ``count`` (date, 'HH:MM') pairs at or after the given start
+    where a ``slot_length`` minute appointment fits, searching no further
+    than horizon_date.
+
+    Holidays and closed weekdays are skipped using the cached schedule, and
+    appointments are loaded one SEARCH_WINDOW_DAYS window per query, so the
+    whole search costs at most a handful of queries. Slots are checked per
+    barber, like reserve_appointment() does, so a suggestion can be booked.
+    """
+    from .schedule import get_schedule
+
+    schedule = get_schedule()
+    earliest_slot = minutes_to_slot(start_minutes)
+    results = []
+    window_start = start_date
+
+    while window_start <= horizon_date and len(results) < count:
+        window_end = min(window_start + timedelta(days=SEARCH_WINDOW_DAYS - 1), horizon_date)
+
+        open_days = []
+        current = window_start
+        while current <= window_end:
+            if schedule.is_open(current):
+                open_days.append(current)
+            current += timedelta(days=1)
+
+        if open_days:
+            busy_by_date = load_busy_intervals_for_range(
+                open_days[0], open_days[-1], schedule.capacity, schedule.barber_ids
+            )
+
+            for day in open_days:
+                working_hours = schedule.hours_for(day)
+                busy, barber_busy = busy_by_date.get(day, ([], None))
+                for slot in compute_free_slots(
+                    working_hours.open_time,
+                    working_hours.close_time,
+                    busy,
+                    slot_length,
+                    barber_busy=barber_busy
+                ):
+                    # Zero-padded 'HH:MM' strings sort like the times they name
+                    if day == start_date and slot < earliest_slot:
+                        continue
+                    results.append((day, slot))
+                    if len(results) == count:
+                        return results
+
+        window_start = window_end + timedelta(days=1)
+
+    return results
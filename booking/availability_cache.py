@@ -0,0 +1,134 @@
+"""
+Versioned per-date cache for availability responses.
+
+Each date has a version counter in the configured Django cache. Appointment
+writes bump the counter for the dates they touch (see booking.signals and
+the bulk actions in booking.admin), and schedule changes bump a global
+counter. A cached response is fresh while both counters still match the ones
+it was computed under.
+
+The counters are only shared between processes that share the cache, so a
+deployment with several worker processes needs a shared backend (Redis,
+Memcached or the database cache). With LocMemCache a booking handled by one
+process leaves the others serving the old availability until the entry
+expires; `manage.py check --deploy` warns about this.
+
+With AVAILABILITY_CACHE_STALE_WHILE_REVALIDATE enabled (off by default), an
+outdated entry is returned immediately while a background thread recomputes
+it, so a slow database never blocks the date picker.
+"""
+import threading
+import time as time_module
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'availability:version:{date}'
+ENTRY_KEY = 'availability:entry:{date}'
+REFRESH_KEY = 'availability:refresh:{date}'
+SCHEDULE_VERSION_KEY = 'availability:schedule-version'
+
+# How long a background refresh may hold its lock before another can start
+REFRESH_LOCK_TIMEOUT = 30
+
+
+def _initial_version():
+    """Seed value for a missing counter, so a reset never reuses an old version"""
+    return time_module.time_ns()
+
+
+def _bump(key):
+    """Atomically increment a version counter, creating it if missing"""
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, _initial_version(), None):
+            cache.incr(key)
+
+
+def bump_availability_version(*dates):
+    """Invalidate the cached availability for the given dates"""
+    for date in {str(date) for date in dates if date}:
+        _bump(VERSION_KEY.format(date=date))
+
+
+def bump_schedule_version():
+    """Invalidate cached availability for every date"""
+    _bump(SCHEDULE_VERSION_KEY)
+
+
+def _current_versions(date, values):
+    """Return the (date, schedule) versions, initialising missing counters"""
+    versions = []
+    for key in (VERSION_KEY.format(date=date), SCHEDULE_VERSION_KEY):
+        version = values.get(key)
+        if version is None:
+            cache.add(key, _initial_version(), None)
+            version = cache.get(key)
+        versions.append(version)
+    return tuple(versions)
+
+
+def _store(date, versions, payload):
+    """Cache a computed payload together with the versions it reflects"""
+    cache.set(
+        ENTRY_KEY.format(date=date),
+        {'versions': versions, 'computed_at': time_module.time(), 'payload': payload},
+        getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 86400)
+    )
+
+
+def _refresh(date, compute):
+    """Recompute and store a date's availability"""
+    values = cache.get_many([VERSION_KEY.format(date=date), SCHEDULE_VERSION_KEY])
+    versions = _current_versions(date, values)
+    payload = compute(date)
+    _store(date, versions, payload)
+    return payload
+
+
+def _refresh_in_background(date, compute):
+    """Start a single background refresh for a date"""
+    lock_key = REFRESH_KEY.format(date=date)
+    if not cache.add(lock_key, 1, REFRESH_LOCK_TIMEOUT):
+        return
+
+    def run():
+        try:
+            _refresh(date, compute)
+        except Exception as e:
+            logger.error("Error refreshing availability for %s: %s", date, e)
+        finally:
+            cache.delete(lock_key)
+            close_old_connections()
+
+    threading.Thread(target=run, name=f"availability-refresh-{date}", daemon=True).start()
+
+
+def get_cached_availability(date, compute):
+    """
+    Return compute(date), served from cache while the date is unchanged.
+
+    Costs a single cache round trip on a hit.
+    """
+    version_key = VERSION_KEY.format(date=date)
+    entry_key = ENTRY_KEY.format(date=date)
+
+    values = cache.get_many([version_key, SCHEDULE_VERSION_KEY, entry_key])
+    versions = _current_versions(date, values)
+    entry = values.get(entry_key)
+
+    if entry is not None:
+        if entry['versions'] == versions:
+            return entry['payload']
+
+        if getattr(settings, 'AVAILABILITY_CACHE_STALE_WHILE_REVALIDATE', False):
+            _refresh_in_background(date, compute)
+            return entry['payload']
+
+    payload = compute(date)
+    _store(date, versions, payload)
+    return payload
@@ -0,0 +1,41 @@
+"""
+System checks for settings the booking app relies on.
+"""
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Cache backends whose contents are private to one process
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache'}
+
+# Backends on which booking.ratelimit updates a bucket atomically across processes
+ATOMIC_RATE_LIMIT_CACHES = {'django.core.cache.backends.redis.RedisCache'}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """The availability cache versions must be visible to every worker process"""
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Warning(
+        'The default cache is local to each process, so availability cache '
+        'invalidations and rate limits are not shared between workers.',
+        hint='Use a shared cache backend (Redis, Memcached or DatabaseCache) '
+             'when running more than one worker process.',
+        id='booking.W001',
+    )]
+
+
+@register(Tags.caches, deploy=True)
+def check_rate_limit_cache(app_configs, **kwargs):
+    """Shared rate-limit buckets need a backend with atomic read-modify-write"""
+    alias = getattr(settings, 'RATE_LIMIT_CACHE', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES | ATOMIC_RATE_LIMIT_CACHES:
+        return []
+    return [Warning(
+        f"The rate-limit cache '{alias}' cannot update a bucket atomically, "
+        'so concurrent requests on different workers can exceed the limit.',
+        hint='Point RATE_LIMIT_CACHE at a Redis cache.',
+        id='booking.W002',
+    )]
@@ -0,0 +1,147 @@
+"""
+De-duplication of incoming WhatsApp messages.
+
+Meta redelivers webhook events whenever it is unsure we received them, with
+the same message ``id``. Every message that is handled has its id recorded
+in ProcessedMessage (unique index) in the same transaction that handles it,
+and redelivered messages are dropped before any handler runs, so a repeated
+"approve" or button reply changes no appointment and sends nothing.
+
+A bounded in-process LRU of recently handled ids sits in front of the table,
+so most redeliveries are recognised without a query. Records older than
+WHATSAPP_DEDUPE_TTL seconds are pruned; Meta stops redelivering long before.
+"""
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+import logging
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+_recent = None
+_recent_lock = threading.Lock()
+
+
+class RecentMessageIds:
+    """Thread-safe LRU set of message ids, holding at most maxsize entries"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def seen(self, message_ids):
+        """Subset of message_ids in the cache; hits become most recently used"""
+        hits = set()
+        with self._lock:
+            for message_id in message_ids:
+                if message_id in self._ids:
+                    self._ids.move_to_end(message_id)
+                    hits.add(message_id)
+        return hits
+
+    def add(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._ids[message_id] = None
+                self._ids.move_to_end(message_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+def get_recent_ids():
+    """Process-wide cache of recently handled message ids"""
+    global _recent
+
+    if _recent is None:
+        with _recent_lock:
+            if _recent is None:
+                _recent = RecentMessageIds(getattr(settings, 'WHATSAPP_DEDUPE_CACHE_SIZE', 10000))
+    return _recent
+
+
+@receiver(setting_changed)
+def reset_recent_ids(setting, **kwargs):
+    """Start a new cache when its size changes (e.g. in tests)"""
+    global _recent
+
+    if setting == 'WHATSAPP_DEDUPE_CACHE_SIZE':
+        _recent = None
+
+
+def processed_ids(message_ids):
+    """Subset of message_ids already handled: LRU hits, then one indexed query for the rest"""
+    from .models import ProcessedMessage
+
+    message_ids = set(message_ids)
+    recent = get_recent_ids()
+    processed = recent.seen(message_ids)
+
+    missing = message_ids - processed
+    if missing:
+        stored = set(ProcessedMessage.objects.filter(message_id__in=missing).values_list('message_id', flat=True))
+        recent.add(stored)
+        processed |= stored
+    return processed
+
+
+def is_redelivery(messages):
+    """Whether every message in a delivery was already handled (False when none carry an id)"""
+    message_ids = {message.get('id') for message in messages} - {None, ''}
+    if not message_ids or len(message_ids) < len(messages):
+        return False
+    return processed_ids(message_ids) == message_ids
+
+
+def claim_new_messages(messages):
+    """
+    Drop messages that were already handled (or repeat within the delivery)
+    and record the rest as handled; returns the messages to handle.
+
+    Call inside the transaction that handles them: the records roll back with
+    it, and the ids only enter the LRU once it commits. Messages without an
+    id cannot be tracked and are always returned.
+    """
+    from .models import ProcessedMessage
+
+    processed = processed_ids(message.get('id') for message in messages if message.get('id'))
+
+    new_messages, new_records = [], {}
+    for message in messages:
+        message_id = message.get('id')
+        if not message_id:
+            new_messages.append(message)
+        elif message_id not in processed and message_id not in new_records:
+            new_messages.append(message)
+            new_records[message_id] = ProcessedMessage(message_id=message_id, sender=str(message.get('from', ''))[:32])
+
+    if len(new_messages) < len(messages):
+        logger.info("Skipping %s redelivered WhatsApp message(s)", len(messages) - len(new_messages))
+
+    if new_records:
+        # A concurrent delivery of the same id makes this insert fail and the whole batch roll back
+        ProcessedMessage.objects.bulk_create(new_records.values())
+        transaction.on_commit(lambda: get_recent_ids().add(new_records))
+    return new_messages
+
+
+def prune_processed_messages(older_than=None):
+    """Delete message ids recorded more than WHATSAPP_DEDUPE_TTL seconds ago; returns the count"""
+    from .models import ProcessedMessage
+
+    if older_than is None:
+        older_than = timezone.now() - timedelta(seconds=getattr(settings, 'WHATSAPP_DEDUPE_TTL', 7 * 86400))
+    deleted, _ = ProcessedMessage.objects.filter(processed_at__lt=older_than).delete()
+    return deleted
@@ -0,0 +1,256 @@
+"""
+Local stand-ins for the external services used by notifications.
+
+SMTPSink is a minimal SMTP server that accepts and counts every message
+without delivering anything. It speaks just enough ESMTP for smtplib and
+Django's SMTP backends (EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP,
+QUIT) and can add an artificial delay to each new connection to model the
+TLS handshake and login round trips of a real provider.
+
+FakeGraphAPI serves the WhatsApp Cloud API messages endpoint over plain
+HTTP with keep-alive and counts the connections it accepts. It can add latency to every call, reject a share of
+messages with error 131030 (recipient not in the allowed list) and throttle
+above a given throughput with HTTP 429 / error 130429, like Meta does.
+
+Point the app at them with settings, e.g. via `manage.py run_fake_services`:
+
+    WHATSAPP_API_BASE_URL=http://127.0.0.1:8099
+    EMAIL_HOST=127.0.0.1 EMAIL_PORT=8025 EMAIL_USE_TLS=False
+"""
+import json
+import random
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """One SMTP session"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        sink = self.server.service
+        sink.record_connection()
+        if sink.handshake_delay:
+            time.sleep(sink.handshake_delay)
+        self.reply('220 fitblendz-sink ESMTP ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            verb = line.decode('utf-8', 'replace').strip().split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.wfile.write(b'250-fitblendz-sink\r\n250-8BITMIME\r\n250 AUTH PLAIN\r\n')
+            elif verb == 'HELO':
+                self.reply('250 fitblendz-sink')
+            elif verb == 'AUTH':
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                sink.record_message()
+                self.reply('250 OK: queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _BackgroundServer:
+    """Runs a socketserver in a daemon thread; use as a context manager"""
+
+    server_class = None
+    handler_class = None
+    name = 'fake-service'
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving in a background thread; port 0 picks a free port"""
+        self._server = self.server_class((self.host, self.port), self.handler_class)
+        self._server.service = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+        logger.info("%s listening on %s:%s", self.name, self.host, self.port)
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class SMTPSink(_BackgroundServer):
+    """Threaded SMTP server that swallows messages; use as a context manager"""
+
+    server_class = _ThreadingServer
+    handler_class = SMTPSinkHandler
+    name = 'smtp-sink'
+
+    def __init__(self, host='127.0.0.1', port=0, handshake_delay=0.0):
+        super().__init__(host, port)
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self.messages = 0
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def record_message(self):
+        with self._lock:
+            self.messages += 1
+
+
+class GraphAPIHandler(BaseHTTPRequestHandler):
+    """POST /<version>/<phone number id>/messages"""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like graph.facebook.com
+
+    def setup(self):
+        super().setup()
+        self.server.service.record_connection()
+
+    def log_message(self, format, *args):
+        logger.debug("fake-graph: " + format, *args)
+
+    def respond(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        api = self.server.service
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+        if not self.path.rstrip('/').endswith('/messages'):
+            self.respond(404, {'error': {'message': 'Unknown path', 'code': 100}})
+            return
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.respond(401, {'error': {'message': 'Invalid OAuth access token', 'code': 190}})
+            return
+
+        if api.latency or api.jitter:
+            time.sleep(api.latency + random.uniform(0, api.jitter))
+
+        status, body, headers = api.handle_message(payload)
+        self.respond(status, body, headers)
+
+
+class FakeGraphAPI(_BackgroundServer):
+    """
+    Local WhatsApp Cloud API messages endpoint.
+
+    latency/jitter: seconds added to every call (jitter is uniform on top).
+    error_rate: share of messages rejected with 131030; numbers listed in
+    blocked_numbers are always rejected.
+    throughput: messages per second accepted before answering HTTP 429
+    with error 130429 (None for unlimited); retry_after, if set, is sent as
+    a Retry-After header on those responses.
+    """
+
+    server_class = ThreadingHTTPServer
+    handler_class = GraphAPIHandler
+    name = 'fake-graph-api'
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 blocked_numbers=(), throughput=None, retry_after=None):
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.blocked_numbers = set(blocked_numbers)
+        self.throughput = throughput
+        self.retry_after = retry_after
+        self.connections = 0
+        self.requests = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.throttled = 0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    @property
+    def url(self):
+        """Value for WHATSAPP_API_BASE_URL"""
+        return f"http://{self.host}:{self.port}"
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def _over_throughput(self):
+        """Fixed one-second window counter; call with the lock held"""
+        if not self.throughput:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            self._window_start, self._window_count = now, 0
+        if self._window_count >= self.throughput:
+            return True
+        self._window_count += 1
+        return False
+
+    def handle_message(self, payload):
+        """Decide the response for one message; returns (status, body, headers)"""
+        to = str(payload.get('to', ''))
+
+        with self._lock:
+            self.requests += 1
+            if self._over_throughput():
+                self.throttled += 1
+                headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else {}
+                return 429, {'error': {
+                    'message': '(#130429) Rate limit hit', 'type': 'OAuthException', 'code': 130429
+                }}, headers
+
+            if to in self.blocked_numbers or random.random() < self.error_rate:
+                self.rejected += 1
+                return 400, {'error': {
+                    'message': '(#131030) Recipient phone number not in allowed list',
+                    'type': 'OAuthException', 'code': 131030
+                }}, {}
+
+            self.accepted += 1
+
+        return 200, {
+            'messaging_product': 'whatsapp',
+            'contacts': [{'input': to, 'wa_id': ''.join(filter(str.isdigit, to))}],
+            'messages': [{'id': f"wamid.{uuid.uuid4().hex}"}],
+        }, {}
@@ -0,0 +1,143 @@
+"""
+Idempotency keys for booking submissions.
+
+Clients send an ``Idempotency-Key`` header (or an ``idempotency_key`` field
+in the JSON body) with POST /book/. The first successful booking stores its
+response under the key, in the same transaction that creates the
+appointment. Retries with the same key are answered from that stored
+response without running validation, touching the appointments table or
+queuing notifications again. The ``replay_retries`` decorator answers them
+before the view's rate limit, so a client retrying a booking that already
+went through is never refused with 429. Keys expire after
+IDEMPOTENCY_KEY_TTL seconds.
+"""
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+from asgiref.sync import iscoroutinefunction
+import logging
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 255
+
+# Fields that identify a booking request; a key reused with different values is rejected
+FINGERPRINT_FIELDS = ('name', 'email', 'phone', 'service', 'date', 'time', 'notes')
+
+
+def get_idempotency_key(request, data):
+    """Return the client's idempotency key from the header or request body, if any"""
+    key = request.META.get(IDEMPOTENCY_HEADER) or data.get(IDEMPOTENCY_FIELD) or ''
+    key = str(key).strip()
+    if len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f'Idempotency key must be at most {MAX_KEY_LENGTH} characters')
+    return key or None
+
+
+def request_fingerprint(data):
+    """Stable hash of the booking fields, used to spot a key reused for another request"""
+    fields = {field: str(data.get(field, '')) for field in FINGERPRINT_FIELDS}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+def get_stored_response(key):
+    """Return the unexpired IdempotencyKey for a key, or None"""
+    from .models import IdempotencyKey
+
+    return IdempotencyKey.objects.filter(key=key, expires_at__gt=timezone.now()).first()
+
+
+async def aget_stored_response(key):
+    """Async version of get_stored_response"""
+    from .models import IdempotencyKey
+
+    return await IdempotencyKey.objects.filter(key=key, expires_at__gt=timezone.now()).afirst()
+
+
+def replay_response(record, fingerprint):
+    """Build the response for a retried request from its stored record"""
+    if record.request_hash != fingerprint:
+        return JsonResponse({
+            'success': False,
+            'error': 'This idempotency key was already used for a different booking request.'
+        }, status=422)
+
+    response = JsonResponse(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def retry_identity(request):
+    """(key, fingerprint) of a request carrying a valid idempotency key, else None"""
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+        key = get_idempotency_key(request, data)
+    except ValueError:
+        # Malformed bodies and keys are reported by the view itself
+        return None
+    return (key, request_fingerprint(data)) if key else None
+
+
+def replay_retries(view_func):
+    """
+    Answer a retried request from its stored response instead of calling the view.
+
+    Apply it above ``rate_limit`` so replays do not use up the client's
+    allowance. Works on both sync and async views.
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapped(request, *args, **kwargs):
+            retry = retry_identity(request)
+            stored = await aget_stored_response(retry[0]) if retry else None
+            if stored:
+                return replay_response(stored, retry[1])
+            return await view_func(request, *args, **kwargs)
+        return async_wrapped
+
+    @wraps(view_func)
+    def wrapped(request, *args, **kwargs):
+        retry = retry_identity(request)
+        stored = get_stored_response(retry[0]) if retry else None
+        if stored:
+            return replay_response(stored, retry[1])
+        return view_func(request, *args, **kwargs)
+    return wrapped
+
+
+def store_response(key, fingerprint, body, status=200, appointment=None):
+    """
+    Save the response for a key.
+
+    Call inside the transaction that produced the response: if another
+    request stored the same key first, the unique constraint raises
+    IntegrityError and the whole transaction rolls back.
+    """
+    from .models import IdempotencyKey
+
+    now = timezone.now()
+    # An expired record would otherwise block reusing its key
+    IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+
+    return IdempotencyKey.objects.create(
+        key=key,
+        request_hash=fingerprint,
+        appointment=appointment,
+        response_status=status,
+        response_body=body,
+        expires_at=now + timedelta(seconds=getattr(settings, 'IDEMPOTENCY_KEY_TTL', 86400))
+    )
+
+
+def prune_expired_keys():
+    """Delete expired keys; returns the number removed"""
+    from .models import IdempotencyKey
+
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
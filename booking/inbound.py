@@ -0,0 +1,237 @@
+"""
+Inbound WhatsApp webhook events.
+
+Meta expects the webhook to answer quickly and redelivers when it does not,
+so the webhook only validates the body and stores it as an InboundEvent
+(one INSERT) before answering 200. The commands, approvals and replies it
+triggers run afterwards:
+
+- WHATSAPP_WEBHOOK_PROCESSING = 'thread' (the default): after commit, a
+  background thread in the web process drains the pending events.
+- 'worker': only ``manage.py process_inbound_events`` processes them.
+- 'inline': the old behaviour; the request handles the messages itself and
+  nothing is stored.
+
+An event whose handlers raise is retried with the notification outbox's
+exponential backoff (NOTIFICATION_RETRY_BASE_SECONDS, doubling up to
+NOTIFICATION_RETRY_MAX_SECONDS); after WHATSAPP_WEBHOOK_MAX_ATTEMPTS it is
+parked as 'failed' until ``process_inbound_events --retry-failed`` queues it
+again. A retry is picked up by the next drain, i.e. the next webhook
+delivery in 'thread' mode or the worker's next poll.
+
+Processed events are deleted after INBOUND_EVENT_RETENTION_DAYS, along with
+the handled message ids booking.dedupe keeps past WHATSAPP_DEDUPE_TTL; both
+the background thread and the worker command prune at most once an hour.
+
+Events are claimed oldest first with the same protocol as the notification
+outbox, but only the oldest unfinished event of each sender can be claimed.
+Each sender's events are therefore handled one at a time and in the order
+they arrived, across any number of workers, while different senders are
+handled in parallel. An event waiting for a retry holds back its sender's
+later events until it succeeds or is parked.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .notifications import CLAIM_TIMEOUT, retry_delay, worker_id
+
+logger = logging.getLogger(__name__)
+
+# Seconds between pruning passes
+PRUNE_INTERVAL = 3600
+
+_drainer = None
+_drainer_lock = threading.Lock()
+_last_prune = None
+
+
+def processing_mode():
+    return getattr(settings, 'WHATSAPP_WEBHOOK_PROCESSING', 'thread')
+
+
+def event_sender(data):
+    """WhatsApp number of the first message in a delivery ('' for status-only deliveries)"""
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            for message in change.get('value', {}).get('messages', []):
+                if message.get('from'):
+                    return str(message['from'])
+    return ''
+
+
+def record_inbound_event(body, data):
+    """
+    Store a webhook delivery for background processing and return it.
+
+    ``body`` is the raw request body and ``data`` its parsed JSON.
+    """
+    from .models import InboundEvent
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    event = InboundEvent.objects.create(body=body, sender=event_sender(data))
+
+    if processing_mode() == 'thread':
+        transaction.on_commit(lambda: get_drainer().submit(_drain_in_background))
+    return event
+
+
+def claim_events(batch_size=50, claimed_by=None):
+    """
+    Claim the oldest due events, at most one per sender.
+
+    An event is only a candidate while no earlier event of its sender is
+    unfinished (pending, even if waiting for a retry, or processing) and no
+    other event of its sender is being processed. Whichever worker claims a
+    sender's oldest event therefore holds the whole sender: a concurrent
+    worker that skips that event (locked or already claimed) finds the
+    sender's later events blocked behind it instead of claiming them.
+    """
+    from .models import InboundEvent
+
+    claimed_by = claimed_by or worker_id()
+    now = timezone.now()
+    due = Q(status='pending', next_attempt_at__lte=now) | Q(status='processing', claimed_at__lt=now - CLAIM_TIMEOUT)
+
+    blocking = InboundEvent.objects.filter(sender=OuterRef('sender')).exclude(pk=OuterRef('pk')).filter(
+        Q(pk__lt=OuterRef('pk'), status__in=('pending', 'processing'))
+        | Q(status='processing', claimed_at__gte=now - CLAIM_TIMEOUT)
+    )
+    # Status-only deliveries have no sender and need no ordering
+    first_of_sender = Q(sender='') | ~Exists(blocking)
+
+    with transaction.atomic():
+        candidates = InboundEvent.objects.filter(due).filter(first_of_sender).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('pk', flat=True)[:batch_size])
+
+        if not ids:
+            return []
+
+        InboundEvent.objects.filter(due, pk__in=ids).update(
+            status='processing',
+            claimed_by=claimed_by,
+            claimed_at=now
+        )
+
+    return list(InboundEvent.objects.filter(claimed_by=claimed_by, status='processing').order_by('id'))
+
+
+def process_event(event):
+    """
+    Run the webhook handlers for one claimed event and record the outcome;
+    returns True on success. A failed event is scheduled for a retry, or
+    parked once it has used WHATSAPP_WEBHOOK_MAX_ATTEMPTS.
+    """
+    from .models import InboundEvent
+    from .webhook_views import process_webhook_payload
+
+    error = ''
+    try:
+        process_webhook_payload(json.loads(event.body))
+    except Exception as e:
+        logger.error("Error processing webhook event %s: %s", event.pk, e)
+        error = str(e)
+
+    now = timezone.now()
+    attempts = event.attempts + 1
+    updates = {'attempts': attempts, 'last_error': error, 'claimed_by': '', 'claimed_at': None}
+
+    if not error:
+        updates.update(status='done', processed_at=now)
+    elif attempts >= getattr(settings, 'WHATSAPP_WEBHOOK_MAX_ATTEMPTS', 5):
+        updates.update(status='failed', processed_at=now)
+        logger.warning("Parking webhook event %s after %s failed attempts", event.pk, attempts)
+    else:
+        updates.update(status='pending', next_attempt_at=now + retry_delay(attempts))
+
+    InboundEvent.objects.filter(pk=event.pk).update(**updates)
+    return not error
+
+
+def retry_failed_events():
+    """Queue every parked event for a fresh round of attempts; returns the count"""
+    from .models import InboundEvent
+
+    return InboundEvent.objects.filter(status='failed').update(
+        status='pending', attempts=0, next_attempt_at=timezone.now(), processed_at=None
+    )
+
+
+def process_inbound_events(batch_size=50, workers=None):
+    """Claim and process one batch of events; returns (processed, failed) counts"""
+    events = claim_events(batch_size=batch_size)
+    if not events:
+        return 0, 0
+
+    # At most one event per sender was claimed, so they can all run in parallel
+    def process(event):
+        try:
+            return process_event(event)
+        finally:
+            close_old_connections()
+
+    workers = workers or getattr(settings, 'WHATSAPP_WEBHOOK_WORKERS', 4)
+    with ThreadPoolExecutor(max_workers=min(workers, len(events)), thread_name_prefix='inbound-events') as executor:
+        results = list(executor.map(process, events))
+
+    processed = sum(results)
+    return processed, len(results) - processed
+
+
+def prune_inbound_events(older_than=None):
+    """Delete processed events received more than INBOUND_EVENT_RETENTION_DAYS ago; returns the count"""
+    from .models import InboundEvent
+
+    if older_than is None:
+        older_than = timezone.now() - timedelta(days=getattr(settings, 'INBOUND_EVENT_RETENTION_DAYS', 7))
+    deleted, _ = InboundEvent.objects.filter(status='done', received_at__lt=older_than).delete()
+    return deleted
+
+
+def prune_if_due():
+    """
+    Prune old events and handled message ids if PRUNE_INTERVAL has passed
+    since the last pass in this process; returns (events, message ids)
+    deleted, or None when it was not due.
+    """
+    from .dedupe import prune_processed_messages
+
+    global _last_prune
+
+    now = time.monotonic()
+    if _last_prune is not None and now - _last_prune < PRUNE_INTERVAL:
+        return None
+    _last_prune = now
+    return prune_inbound_events(), prune_processed_messages()
+
+
+def get_drainer():
+    """Single background thread that drains pending events in the web process"""
+    global _drainer
+
+    if _drainer is None:
+        with _drainer_lock:
+            if _drainer is None:
+                _drainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inbound-drainer')
+    return _drainer
+
+
+def _drain_in_background():
+    """Process events until none are due; extra submissions find nothing left and return"""
+    try:
+        while any(process_inbound_events()):
+            pass
+        prune_if_due()
+    except Exception as e:
+        logger.error("Error draining webhook events: %s", e)
+    finally:
+        close_old_connections()
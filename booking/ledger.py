@@ -0,0 +1,85 @@
+"""
+Notification ledger.
+
+Every appointment email and WhatsApp message is recorded in
+NotificationLedger under (appointment, channel, event), so each sender can
+skip a message that already went out, whichever path (outbox worker,
+webhook handler, reminder run, retry) triggers it again. The duplicate check
+is a single lookup on the unique (appointment, channel, event) index, and
+bulk senders can drop already-notified appointments from a queryset in the
+same query that selects them.
+"""
+import logging
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def already_sent(appointment, channel, event):
+    """Whether this message was already delivered for the appointment"""
+    from .models import NotificationLedger
+
+    return NotificationLedger.objects.filter(
+        appointment_id=getattr(appointment, 'pk', appointment), channel=channel, event=event, status='sent'
+    ).exists()
+
+
+def record_sent(appointment, channel, event, provider_message_id=''):
+    """Mark a message as delivered"""
+    from .models import NotificationLedger
+
+    NotificationLedger.objects.update_or_create(
+        appointment_id=getattr(appointment, 'pk', appointment),
+        channel=channel,
+        event=event,
+        defaults={'status': 'sent', 'provider_message_id': provider_message_id or '', 'sent_at': timezone.now()}
+    )
+
+
+def record_failed(appointment, channel, event):
+    """Note a failed attempt, unless the message was already delivered"""
+    from .models import NotificationLedger
+
+    entry, created = NotificationLedger.objects.get_or_create(
+        appointment_id=getattr(appointment, 'pk', appointment),
+        channel=channel,
+        event=event,
+        defaults={'status': 'failed'}
+    )
+    if not created and entry.status != 'sent':
+        NotificationLedger.objects.filter(pk=entry.pk).update(status='failed', updated_at=timezone.now())
+
+
+def sent_entries(channel, event):
+    """Ledger rows of delivered messages for the appointment in the outer query"""
+    from .models import NotificationLedger
+
+    return NotificationLedger.objects.filter(appointment=OuterRef('pk'), channel=channel, event=event, status='sent')
+
+
+def exclude_notified(queryset, channel, event):
+    """Drop appointments whose message was already delivered; stays a single query"""
+    return queryset.exclude(Exists(sent_entries(channel, event)))
+
+
+def notified_appointment_ids(appointment_ids, channel, event):
+    """Subset of appointment_ids whose message was already delivered, in one query"""
+    from .models import NotificationLedger
+
+    return set(
+        NotificationLedger.objects.filter(
+            appointment_id__in=appointment_ids, channel=channel, event=event, status='sent'
+        ).values_list('appointment_id', flat=True)
+    )
+
+
+def record_delivery_failures(provider_message_ids):
+    """Mark messages WhatsApp reported as undeliverable as failed, so they can be sent again; returns the count"""
+    from .models import NotificationLedger
+
+    if not provider_message_ids:
+        return 0
+    return NotificationLedger.objects.filter(provider_message_id__in=provider_message_ids, status='sent').update(
+        status='failed', updated_at=timezone.now()
+    )
@@ -0,0 +1,226 @@
+"""
+Pooled SMTP email backend.
+
+Django's SMTP backend opens a connection, runs STARTTLS and logs in for
+every ``send_mail`` call. PooledEmailBackend keeps authenticated connections
+in a process-wide pool instead, so consecutive emails (and concurrent ones
+from the notification workers) reuse them:
+
+- A connection idle for longer than EMAIL_POOL_IDLE_TIMEOUT seconds is
+  closed instead of reused, and one that has sent EMAIL_POOL_MAX_MESSAGES
+  messages is retired.
+- At most EMAIL_POOL_SIZE idle connections are kept per server/account.
+- If the server has dropped a pooled connection, the message is retried once
+  on a fresh connection.
+
+Enable it with EMAIL_BACKEND = 'booking.mail.PooledEmailBackend'. Use
+send_batch() to send many prepared messages over a single connection.
+"""
+import atexit
+import smtplib
+import threading
+import time
+import logging
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.message import sanitize_address
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """An authenticated SMTP connection and its usage counters"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+
+    def quit(self):
+        """Close the connection, ignoring errors from an already dead socket"""
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of idle SMTP connections, keyed by server and account"""
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self, key, idle_timeout):
+        """Return the most recently used live idle connection for key, or None"""
+        now = time.monotonic()
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+            fresh = [connection for connection in idle if now - connection.last_used <= idle_timeout]
+            stale = [connection for connection in idle if now - connection.last_used > idle_timeout]
+            pooled = fresh.pop() if fresh else None
+            self._idle[key] = fresh
+
+        for connection in stale:
+            connection.quit()
+        return pooled
+
+    def record_open(self):
+        """Count a newly opened connection"""
+        with self._lock:
+            self.opened += 1
+
+    def release(self, key, pooled, pool_size):
+        """Return a connection to the pool, closing it if the pool is full"""
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < pool_size:
+                idle.append(pooled)
+                return
+        pooled.quit()
+
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle = [connection for connections in self._idle.values() for connection in connections]
+            self._idle.clear()
+        for connection in idle:
+            connection.quit()
+
+
+_pool = SMTPConnectionPool()
+atexit.register(_pool.close_all)
+
+
+class PooledEmailBackend(EmailBackend):
+    """SMTP backend that borrows authenticated connections from a shared pool"""
+
+    def __init__(self, idle_timeout=None, max_messages=None, pool_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.idle_timeout = getattr(settings, 'EMAIL_POOL_IDLE_TIMEOUT', 60) if idle_timeout is None else idle_timeout
+        self.max_messages = getattr(settings, 'EMAIL_POOL_MAX_MESSAGES', 100) if max_messages is None else max_messages
+        self.pool_size = getattr(settings, 'EMAIL_POOL_SIZE', 4) if pool_size is None else pool_size
+        self._pooled = None
+
+    @property
+    def pool_key(self):
+        return (self.host, self.port, self.username, self.use_tls, self.use_ssl)
+
+    def open(self):
+        """Borrow a pooled connection, or open a new one if none is idle"""
+        if self.connection:
+            return False
+
+        pooled = _pool.acquire(self.pool_key, self.idle_timeout)
+        if pooled:
+            self._pooled = pooled
+            self.connection = pooled.smtp
+            return True
+
+        return self._connect()
+
+    def close(self):
+        """Return the connection to the pool rather than closing it"""
+        if self.connection is None:
+            return
+
+        pooled, self._pooled = self._pooled, None
+        self.connection = None
+        if pooled and pooled.messages_sent < self.max_messages:
+            _pool.release(self.pool_key, pooled, self.pool_size)
+        elif pooled:
+            pooled.quit()
+
+    def _connect(self):
+        """Open and authenticate a new connection"""
+        self.connection = None
+        created = super().open()
+        if created:
+            _pool.record_open()
+            self._pooled = PooledConnection(self.connection)
+        return created
+
+    def _discard(self):
+        """Drop the current connection without returning it to the pool"""
+        if self._pooled:
+            self._pooled.quit()
+        self._pooled = None
+        self.connection = None
+
+    def _send(self, email_message):
+        """Send one message, reconnecting once if the pooled connection was dropped"""
+        if not email_message.recipients():
+            return False
+        encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        from_email = sanitize_address(email_message.from_email, encoding)
+        recipients = [sanitize_address(address, encoding) for address in email_message.recipients()]
+        message = email_message.message().as_bytes(linesep='\r\n')
+
+        try:
+            # Retire a connection that has reached its message budget mid-batch
+            if self._pooled is None or self._pooled.messages_sent >= self.max_messages:
+                self._discard()
+                if not self._connect():
+                    raise smtplib.SMTPServerDisconnected(f'Could not connect to {self.host}')
+
+            try:
+                self.connection.sendmail(from_email, recipients, message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                logger.info("SMTP connection to %s was dropped (%s); reconnecting", self.host, e)
+                self._discard()
+                if not self._connect():
+                    raise smtplib.SMTPServerDisconnected(f'Could not reconnect to {self.host}')
+                self.connection.sendmail(from_email, recipients, message)
+
+        except (smtplib.SMTPException, OSError):
+            # Never return a connection the server has closed to the pool
+            if self.connection is not None and getattr(self.connection, 'sock', None) is None:
+                self._discard()
+            if not self.fail_silently:
+                raise
+            return False
+
+        self._pooled.messages_sent += 1
+        return True
+
+
+def send_batch(email_messages, before_send=None):
+    """
+    Send many prepared EmailMessages over one connection.
+
+    Returns one entry per message: None if it was sent, otherwise the error
+    that stopped it; a failed message does not stop the rest. before_send, if
+    given, is called before each message (e.g. to pace the batch).
+    """
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        return [e] * len(email_messages)
+
+    errors = []
+    try:
+        for message in email_messages:
+            if before_send:
+                before_send()
+            try:
+                sent = connection.send_messages([message])
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None if sent else smtplib.SMTPException('Message was not sent'))
+    finally:
+        connection.close()
+    return errors
+
+
+def close_pool():
+    """Close every idle pooled SMTP connection"""
+    _pool.close_all()
@@ -0,0 +1,80 @@
+"""
+SMTP throughput benchmark.
+
+Starts a local SMTP sink and sends the same messages three ways: Django's
+stock SMTP backend (a new connection per email, as send_mail did before),
+the pooled backend one email at a time, and the pooled backend's batch API.
+Use --handshake-delay to model the TLS and login round trips of a real
+provider such as Gmail.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.management.base import BaseCommand
+from booking.fake_services import SMTPSink
+from booking.mail import close_pool
+
+STOCK_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+POOLED_BACKEND = 'booking.mail.PooledEmailBackend'
+
+
+class Command(BaseCommand):
+    help = 'Compare per-message, pooled and batched SMTP throughput against a local sink'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help='Emails sent in each mode')
+        parser.add_argument('--threads', type=int, default=4, help='Concurrent senders for the per-message modes')
+        parser.add_argument('--handshake-delay', type=float, default=0.05, help='Seconds added to each new connection')
+
+    def handle(self, *args, **options):
+        count = options['messages']
+
+        with SMTPSink(handshake_delay=options['handshake_delay']) as sink:
+            self.stdout.write(
+                f"SMTP sink on 127.0.0.1:{sink.port}, {count} messages per mode, "
+                f"{options['handshake_delay'] * 1000:.0f} ms handshake"
+            )
+
+            def connection(backend):
+                return get_connection(
+                    backend, host='127.0.0.1', port=sink.port, username='bench', password='bench',
+                    use_tls=False, use_ssl=False, timeout=10
+                )
+
+            def one_by_one(backend):
+                def send(index):
+                    connection(backend).send_messages([self.build_message(index)])
+                with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                    list(executor.map(send, range(count)))
+
+            def batch():
+                connection(POOLED_BACKEND).send_messages([self.build_message(index) for index in range(count)])
+
+            modes = [
+                ('stock backend, one per send', lambda: one_by_one(STOCK_BACKEND)),
+                ('pooled backend, one per send', lambda: one_by_one(POOLED_BACKEND)),
+                ('pooled backend, batch', batch),
+            ]
+            for label, run in modes:
+                close_pool()
+                connections_before, messages_before = sink.connections, sink.messages
+                started = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"{label:<30} {count / elapsed:8.1f} msg/s  "
+                    f"{sink.connections - connections_before:4d} connection(s)  "
+                    f"{sink.messages - messages_before} delivered"
+                )
+
+            close_pool()
+
+    def build_message(self, index):
+        message = EmailMultiAlternatives(
+            subject=f'Benchmark message {index}',
+            body='Appointment reminder benchmark.',
+            from_email='bench@fitblendz.local',
+            to=[f'customer{index}@example.com'],
+        )
+        message.attach_alternative('<p>Appointment reminder benchmark.</p>', 'text/html')
+        return message
@@ -0,0 +1,99 @@
+"""
+Concurrent HTTP throughput benchmark.
+
+Fires requests at a running server from many threads and reports throughput
+and latency percentiles. Run it once against the WSGI deployment and once
+against the ASGI one (see DEPLOYMENT_GUIDE.md) with the same options to
+compare them.
+"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    help = 'Measure concurrent request throughput and latency against a running server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='Server to benchmark')
+        parser.add_argument(
+            '--path', action='append', dest='paths',
+            help='Path to request (repeatable; requests rotate through them). '
+                 'Defaults to /api/available-times/ for tomorrow'
+        )
+        parser.add_argument('--method', default='GET', choices=['GET', 'POST'])
+        parser.add_argument('--body', help='JSON body sent with POST requests')
+        parser.add_argument('--requests', type=int, default=1000, help='Total number of requests')
+        parser.add_argument('--concurrency', type=int, default=50, help='Number of parallel clients')
+        parser.add_argument('--timeout', type=float, default=30.0, help='Per-request timeout in seconds')
+
+    def handle(self, *args, **options):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        base_url = options['base_url'].rstrip('/')
+        paths = options['paths'] or [f"/api/available-times/?date={timezone.localdate() + timedelta(days=1)}"]
+        total = options['requests']
+        headers = {'Content-Type': 'application/json'} if options['body'] else {}
+
+        local = threading.local()
+        latencies = []
+        statuses = Counter()
+        lock = threading.Lock()
+
+        def session():
+            # One keep-alive session per client thread
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return local.session
+
+        def fire(index):
+            url = base_url + paths[index % len(paths)]
+            started = time.perf_counter()
+            try:
+                response = session().request(
+                    options['method'], url, data=options['body'], headers=headers, timeout=options['timeout']
+                )
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+        try:
+            requests.get(base_url + paths[0], timeout=options['timeout'])
+        except requests.RequestException as e:
+            raise CommandError(f'Server at {base_url} is not reachable: {e}')
+
+        self.stdout.write(
+            f"{options['method']} {', '.join(paths)} on {base_url}: "
+            f"{total} requests, {options['concurrency']} concurrent"
+        )
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(fire, range(total)))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        self.stdout.write(f"Status codes: {dict(statuses)}")
+        self.stdout.write(
+            f"Latency ms: p50 {percentile(latencies, 0.50) * 1000:.1f}  "
+            f"p95 {percentile(latencies, 0.95) * 1000:.1f}  "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}  "
+            f"max {latencies[-1] * 1000:.1f}"
+        )
+        self.stdout.write(self.style.SUCCESS(f"Throughput: {total / elapsed:.1f} requests/s over {elapsed:.2f}s"))
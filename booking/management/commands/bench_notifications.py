@@ -0,0 +1,139 @@
+"""
+Notification throughput benchmark.
+
+Starts the fake WhatsApp Graph API and the SMTP sink, points the app at them
+and pushes the notifications of N bookings and their confirmations through
+the real senders: the pending email, the customer WhatsApp message and the
+barber's approval request for each booking, then the WhatsApp and email
+confirmations. Reports messages/second and p50/p95/p99 latency per phase
+and channel. Runs against the configured database using a temporary
+service, which is deleted (with its appointments) afterwards.
+"""
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import time as clock_time, timedelta
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test.utils import override_settings
+from django.utils import timezone
+from booking.fake_services import FakeGraphAPI, SMTPSink
+from booking.mail import close_pool
+from booking.models import Appointment, Service
+from booking.utils import send_pending_appointment_email, send_status_confirmation_email
+from booking.webhook_views import send_appointment_notification, send_approval_request_to_barber
+from booking.whatsapp import ClientMetrics, get_whatsapp_scheduler
+
+PHASES = [
+    ('booking', [
+        ('email', send_pending_appointment_email),
+        ('whatsapp', lambda appointment: send_appointment_notification(appointment, 'pending')),
+        ('whatsapp', send_approval_request_to_barber),
+    ]),
+    ('confirmation', [
+        ('whatsapp', lambda appointment: send_appointment_notification(appointment, 'confirmation')),
+        ('email', send_status_confirmation_email),
+    ]),
+]
+
+
+class Command(BaseCommand):
+    help = 'Measure notification throughput and latency against local Graph API and SMTP fakes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=100, help='Appointments to notify about')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent senders')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to each Graph API call')
+        parser.add_argument('--jitter', type=float, default=0.02, help='Extra random Graph API latency, in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of WhatsApp messages rejected with 131030')
+        parser.add_argument('--throughput', type=float, default=None, help='Graph API messages/second before 429s')
+        parser.add_argument('--handshake-delay', type=float, default=0.05, help='Seconds added to each new SMTP connection')
+
+    def handle(self, *args, **options):
+        graph = FakeGraphAPI(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            throughput=options['throughput'],
+        )
+        sink = SMTPSink(handshake_delay=options['handshake_delay'])
+
+        with graph, sink, override_settings(
+            WHATSAPP_API_BASE_URL=graph.url,
+            EMAIL_BACKEND='booking.mail.PooledEmailBackend',
+            EMAIL_HOST=sink.host,
+            EMAIL_PORT=sink.port,
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+        ):
+            service = Service.objects.create(
+                name=f"Notification Bench {uuid.uuid4().hex[:8]}",
+                description='Temporary service created by bench_notifications',
+                duration=30,
+                price=0,
+                is_active=False
+            )
+            try:
+                appointments = self.create_appointments(service, options['bookings'])
+                self.stdout.write(
+                    f"{len(appointments)} bookings, {options['workers']} workers, Graph API "
+                    f"{options['latency'] * 1000:.0f}+{options['jitter'] * 1000:.0f} ms"
+                    + (f", capped at {options['throughput']:g} msg/s" if options['throughput'] else '')
+                )
+
+                for phase, senders in PHASES:
+                    self.run_phase(phase, senders, appointments, options['workers'])
+            finally:
+                service.delete()
+                close_pool()
+
+            self.stdout.write(get_whatsapp_scheduler().describe())
+            self.stdout.write(
+                f"Fake Graph API: {graph.accepted} accepted, {graph.rejected} rejected, {graph.throttled} throttled | "
+                f"SMTP sink: {sink.messages} message(s) over {sink.connections} connection(s)"
+            )
+
+    def create_appointments(self, service, count):
+        day = timezone.localdate() + timedelta(days=1)
+        return Appointment.objects.bulk_create([
+            Appointment(
+                service=service,
+                name=f'Bench Customer {index}',
+                email=f'bench{index}@example.com',
+                phone=f'+91{9000000000 + index}',
+                date=day,
+                time=clock_time(9 + index % 8, 0),
+                duration=service.duration,
+                status='pending',
+            )
+            for index in range(count)
+        ])
+
+    def run_phase(self, phase, senders, appointments, workers):
+        """Send every message of a phase concurrently and report per-channel results"""
+        metrics = {channel: ClientMetrics(window=len(appointments) * len(senders)) for channel, _ in senders}
+        tasks = [(channel, send, appointment) for appointment in appointments for channel, send in senders]
+
+        def run(task):
+            channel, send, appointment = task
+            started = time.perf_counter()
+            try:
+                ok = bool(send(appointment))
+            finally:
+                close_old_connections()
+            metrics[channel].record('ok' if ok else 'failed', time.perf_counter() - started, ok)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run, tasks))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{phase}: {len(tasks)} message(s) in {elapsed:.2f}s ({len(tasks) / elapsed:.1f} msg/s)"
+        ))
+        for channel, channel_metrics in metrics.items():
+            stats = channel_metrics.snapshot()
+            self.stdout.write(
+                f"  {channel:<9} {stats['requests']:5d} sent, {stats['errors']:4d} failed  "
+                f"p50 {stats['p50_ms']:7.1f} ms  p95 {stats['p95_ms']:7.1f} ms  p99 {stats['p99_ms']:7.1f} ms"
+            )
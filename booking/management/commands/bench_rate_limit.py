@@ -0,0 +1,50 @@
+"""
+Rate limiter overhead benchmark.
+
+Times GCRA rate-limit checks against the configured rate-limit cache and
+compares them with a plain cache.get, which is the floor for one round trip.
+"""
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from booking.ratelimit import check_rate, parse_rate
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-request overhead of the rate limiter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000, help='Checks to time')
+        parser.add_argument('--clients', type=int, default=100, help='Distinct clients the checks are spread over')
+        parser.add_argument('--rate', default='1000000/m', help='Bucket rate used for the benchmark')
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        tokens, period = parse_rate(options['rate'])
+        cache = caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+        scope = f"bench-{uuid.uuid4().hex[:8]}"
+        clients = [f"10.0.{i // 256}.{i % 256}" for i in range(options['clients'])]
+
+        self.stdout.write(
+            f"Cache backend: {cache.__class__.__name__}  Iterations: {iterations}  Clients: {len(clients)}"
+        )
+
+        started = time.perf_counter()
+        for i in range(iterations):
+            cache.get(f"{scope}:baseline:{clients[i % len(clients)]}")
+        baseline = time.perf_counter() - started
+
+        allowed = 0
+        started = time.perf_counter()
+        for i in range(iterations):
+            ok, _ = check_rate(scope, clients[i % len(clients)], tokens, period)
+            allowed += ok
+        elapsed = time.perf_counter() - started
+
+        per_check = elapsed / iterations * 1e6
+        per_get = baseline / iterations * 1e6
+        self.stdout.write(f"cache.get baseline: {per_get:.1f} us/op")
+        self.stdout.write(f"rate limit check:   {per_check:.1f} us/op ({iterations / elapsed:,.0f} checks/s, {allowed} allowed)")
+        self.stdout.write(self.style.SUCCESS(f"Overhead per request: {per_check:.1f} us ({per_check / per_get:.1f}x one cache.get)"))
@@ -0,0 +1,119 @@
+"""
+Webhook acknowledgement benchmark.
+
+Starts the fake WhatsApp Graph API, points the app at it and posts N
+incoming 'help' messages to the webhook view from concurrent clients, once
+with WHATSAPP_WEBHOOK_PROCESSING = 'inline' (the handlers and their reply
+run before the 200) and once with 'worker' (the delivery is only stored).
+Reports requests/second and p50/p95/p99 acknowledgement latency for each
+mode, then drains the stored events with the event worker and reports its
+throughput. The events it stores are deleted afterwards.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from booking.fake_services import FakeGraphAPI
+from booking.inbound import process_inbound_events
+from booking.models import InboundEvent
+from booking.webhook_views import whatsapp_webhook
+from booking.whatsapp import ClientMetrics
+from booking.whatsapp_commands import COMMAND_ROUTER
+
+
+def message_delivery(index):
+    """A webhook delivery carrying one 'help' text from a distinct customer"""
+    sender = str(919000000000 + index)
+    return json.dumps({
+        'object': 'whatsapp_business_account',
+        'entry': [{
+            'id': 'bench',
+            'changes': [{
+                'field': 'messages',
+                'value': {
+                    'messaging_product': 'whatsapp',
+                    'contacts': [{'wa_id': sender, 'profile': {'name': f'Bench Customer {index}'}}],
+                    'messages': [{
+                        'from': sender,
+                        'id': f'wamid.bench.{index}.{time.time_ns()}',
+                        'timestamp': str(int(time.time())),
+                        'type': 'text',
+                        'text': {'body': 'help'},
+                    }],
+                },
+            }],
+        }],
+    })
+
+
+class Command(BaseCommand):
+    help = 'Measure webhook acknowledgement latency with inline and queued processing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Webhook deliveries per mode')
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent webhook clients')
+        parser.add_argument('--latency', type=float, default=0.1, help='Seconds added to each Graph API call')
+        parser.add_argument('--jitter', type=float, default=0.05, help='Extra random Graph API latency, in seconds')
+
+    def handle(self, *args, **options):
+        graph = FakeGraphAPI(latency=options['latency'], jitter=options['jitter'])
+        first_event = InboundEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+        with graph, override_settings(WHATSAPP_API_BASE_URL=graph.url, RATE_LIMIT_ENABLED=False):
+            self.stdout.write(
+                f"{options['requests']} deliveries per mode, {options['clients']} clients, Graph API "
+                f"{options['latency'] * 1000:.0f}+{options['jitter'] * 1000:.0f} ms"
+            )
+            try:
+                for mode in ('inline', 'worker'):
+                    with override_settings(WHATSAPP_WEBHOOK_PROCESSING=mode):
+                        self.run_mode(mode, options['requests'], options['clients'])
+
+                started = time.perf_counter()
+                processed = failed = 0
+                while True:
+                    batch = process_inbound_events()
+                    if not any(batch):
+                        break
+                    processed += batch[0]
+                    failed += batch[1]
+                elapsed = time.perf_counter() - started
+                self.stdout.write(self.style.SUCCESS(
+                    f"drain: {processed} event(s) processed, {failed} failed in {elapsed:.2f}s "
+                    f"({(processed + failed) / elapsed:.1f} events/s)"
+                ))
+            finally:
+                InboundEvent.objects.filter(id__gt=first_event).delete()
+
+            self.stdout.write(COMMAND_ROUTER.describe())
+            self.stdout.write(f"Fake Graph API: {graph.accepted} accepted, {graph.rejected} rejected")
+
+    def run_mode(self, mode, count, clients):
+        """Post count deliveries to the webhook concurrently and report acknowledgement latency"""
+        factory = RequestFactory()
+        metrics = ClientMetrics(window=count)
+
+        def post(index):
+            request = factory.post('/webhook/whatsapp/', data=message_delivery(index), content_type='application/json')
+            started = time.perf_counter()
+            try:
+                response = whatsapp_webhook(request)
+            finally:
+                close_old_connections()
+            metrics.record('webhook', time.perf_counter() - started, response.status_code == 200)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(post, range(count)))
+        elapsed = time.perf_counter() - started
+
+        stats = metrics.snapshot()
+        self.stdout.write(self.style.SUCCESS(
+            f"{mode}: {count} request(s) in {elapsed:.2f}s ({count / elapsed:.1f} req/s), {stats['errors']} failed"
+        ))
+        self.stdout.write(
+            f"  ack latency  p50 {stats['p50_ms']:7.1f} ms  p95 {stats['p95_ms']:7.1f} ms  p99 {stats['p99_ms']:7.1f} ms"
+        )
@@ -0,0 +1,70 @@
+"""
+Webhook event worker.
+
+Claims stored WhatsApp webhook deliveries oldest first and runs the message
+handlers for them, one sender at a time in arrival order and different
+senders in parallel. Needed with WHATSAPP_WEBHOOK_PROCESSING = 'worker';
+with 'thread' it also picks up events a web process left behind. Processed
+events older than INBOUND_EVENT_RETENTION_DAYS and handled message ids
+older than WHATSAPP_DEDUPE_TTL are deleted hourly. Failed events are
+retried with backoff; --retry-failed queues the ones that were parked after
+WHATSAPP_WEBHOOK_MAX_ATTEMPTS again.
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from booking.inbound import process_inbound_events, prune_if_due, retry_failed_events
+
+
+class Command(BaseCommand):
+    help = 'Process stored WhatsApp webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Events claimed per batch')
+        parser.add_argument('--workers', type=int, default=None, help='Senders handled in parallel (default WHATSAPP_WEBHOOK_WORKERS)')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when no events are due')
+        parser.add_argument('--once', action='store_true', help='Drain the due events once and exit')
+        parser.add_argument('--retry-failed', action='store_true', help='Queue parked (failed) events again before starting')
+
+    def handle(self, *args, **options):
+        total_processed = total_failed = 0
+        started = time.perf_counter()
+
+        if options['retry_failed']:
+            self.stdout.write(f"Queued {retry_failed_events()} failed event(s) for retry")
+
+        self.stdout.write(f"Webhook event worker started (batch size {options['batch_size']})")
+
+        try:
+            while True:
+                close_old_connections()
+
+                pruned = prune_if_due()
+                if pruned and any(pruned):
+                    self.stdout.write(f"Pruned {pruned[0]} processed event(s) and {pruned[1]} handled message id(s)")
+
+                batch_started = time.perf_counter()
+                processed, failed = process_inbound_events(batch_size=options['batch_size'], workers=options['workers'])
+                batch_elapsed = time.perf_counter() - batch_started
+
+                if processed or failed:
+                    total_processed += processed
+                    total_failed += failed
+                    self.stdout.write(
+                        f"Processed {processed} event(s), {failed} failed "
+                        f"in {batch_elapsed:.2f}s ({(processed + failed) / batch_elapsed:.1f} events/s)"
+                    )
+                    continue
+
+                if options['once']:
+                    break
+
+                time.sleep(options['poll_interval'])
+
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping webhook event worker')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Webhook event worker finished: {total_processed} processed, {total_failed} failed in {elapsed:.1f}s"
+        ))
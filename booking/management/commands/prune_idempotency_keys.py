@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from booking.idempotency import prune_expired_keys
+
+
+class Command(BaseCommand):
+    help = 'Delete booking idempotency keys past their TTL'
+
+    def handle(self, *args, **options):
+        deleted = prune_expired_keys()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency key(s)'))
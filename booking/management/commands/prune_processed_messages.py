@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from booking.dedupe import prune_processed_messages
+
+
+class Command(BaseCommand):
+    help = 'Delete handled WhatsApp message ids past WHATSAPP_DEDUPE_TTL'
+
+    def handle(self, *args, **options):
+        deleted = prune_processed_messages()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired message id(s)'))
@@ -0,0 +1,48 @@
+"""
+Run the local WhatsApp Graph API fake and SMTP sink in the foreground.
+
+Start the app in another shell with the printed environment to send every
+notification to them instead of Meta and Gmail, e.g. to try the webhook
+flows or run_outbox offline.
+"""
+import time
+from django.core.management.base import BaseCommand
+from booking.fake_services import FakeGraphAPI, SMTPSink
+
+
+class Command(BaseCommand):
+    help = 'Serve a fake WhatsApp Graph API and an SMTP sink for offline testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--graph-port', type=int, default=8099, help='Port for the fake Graph API')
+        parser.add_argument('--smtp-port', type=int, default=8025, help='Port for the SMTP sink')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to each Graph API call')
+        parser.add_argument('--jitter', type=float, default=0.02, help='Extra random latency, in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of messages rejected with 131030')
+        parser.add_argument('--throughput', type=float, default=None, help='Messages/second before answering 429 (130429)')
+        parser.add_argument('--handshake-delay', type=float, default=0.05, help='Seconds added to each new SMTP connection')
+
+    def handle(self, *args, **options):
+        graph = FakeGraphAPI(
+            port=options['graph_port'],
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            throughput=options['throughput'],
+        )
+        sink = SMTPSink(port=options['smtp_port'], handshake_delay=options['handshake_delay'])
+
+        with graph, sink:
+            self.stdout.write(self.style.SUCCESS('Fake services running. Start the app with:'))
+            self.stdout.write(
+                f"  WHATSAPP_API_BASE_URL={graph.url} EMAIL_HOST=127.0.0.1 EMAIL_PORT={sink.port} EMAIL_USE_TLS=False"
+            )
+            try:
+                while True:
+                    time.sleep(10)
+                    self.stdout.write(
+                        f"Graph API: {graph.accepted} accepted, {graph.rejected} rejected, {graph.throttled} throttled | "
+                        f"SMTP: {sink.messages} message(s) over {sink.connections} connection(s)"
+                    )
+            except KeyboardInterrupt:
+                self.stdout.write('Stopping fake services')
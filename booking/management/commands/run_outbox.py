@@ -0,0 +1,60 @@
+"""
+Notification outbox worker.
+
+Claims due NotificationOutbox rows in batches, delivers them and retries
+failures with exponential backoff. Several workers can run side by side;
+each batch is claimed atomically so no message is delivered twice.
+"""
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from booking.notifications import deliver_outbox_messages
+from booking.whatsapp import get_whatsapp_scheduler
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued email and WhatsApp notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Rows claimed per batch')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds to sleep when the outbox is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the due rows once and exit')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total_sent = total_failed = 0
+        started = time.perf_counter()
+
+        self.stdout.write(f"Outbox worker started (batch size {batch_size})")
+
+        try:
+            while True:
+                close_old_connections()
+
+                batch_started = time.perf_counter()
+                sent, failed = deliver_outbox_messages(batch_size=batch_size)
+                batch_elapsed = time.perf_counter() - batch_started
+
+                if sent or failed:
+                    total_sent += sent
+                    total_failed += failed
+                    self.stdout.write(
+                        f"Delivered {sent} message(s), {failed} failed "
+                        f"in {batch_elapsed:.2f}s ({(sent + failed) / batch_elapsed:.1f} msg/s)"
+                    )
+                    # More rows may already be due, so claim again straight away
+                    continue
+
+                if options['once']:
+                    break
+
+                time.sleep(options['poll_interval'])
+
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping outbox worker')
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Outbox worker finished: {total_sent} sent, {total_failed} failed in {elapsed:.1f}s"
+        ))
+        self.stdout.write(get_whatsapp_scheduler().describe())
@@ -0,0 +1,50 @@
+"""
+Send reminders for tomorrow's confirmed appointments.
+
+Meant to run once a day from cron. Each appointment's WhatsApp and email
+reminders are recorded in the notification outbox, so running the command
+again (or after a crash) only sends what has not gone out yet; failed sends
+are retried by run_outbox.
+"""
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from booking.reminders import reminder_date, send_reminders
+from booking.whatsapp import get_whatsapp_scheduler
+
+
+class Command(BaseCommand):
+    help = "Send WhatsApp and email reminders for tomorrow's confirmed appointments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Appointment date to remind (YYYY-MM-DD, default tomorrow)')
+        parser.add_argument('--workers', type=int, default=None, help='Concurrent sends (default REMINDER_WORKERS)')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Messages started per second, 0 for no limit (default REMINDER_MESSAGES_PER_SECOND)')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date format, expected YYYY-MM-DD')
+        else:
+            day = reminder_date()
+
+        workers = options['workers'] or getattr(settings, 'REMINDER_WORKERS', 8)
+        rate = options['rate'] if options['rate'] is not None else getattr(settings, 'REMINDER_MESSAGES_PER_SECOND', 20)
+
+        self.stdout.write(f"Sending reminders for {day} ({workers} workers, {rate or 'unlimited'} msg/s)")
+
+        started = time.perf_counter()
+        result = send_reminders(day, workers=workers, rate=rate)
+        elapsed = time.perf_counter() - started
+
+        delivered = result['sent'] + result['failed']
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['enqueued']} appointment(s) enqueued, {result['sent']} message(s) sent, "
+            f"{result['failed']} failed in {elapsed:.2f}s"
+            + (f" ({delivered / elapsed:.1f} msg/s)" if delivered else '')
+        ))
+        self.stdout.write(get_whatsapp_scheduler().describe())
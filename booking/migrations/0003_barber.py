@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-17 02:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0002_alter_appointment_phone_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Barber',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('is_active', models.BooleanField(default=True, help_text='Inactive barbers do not count towards capacity')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='barber',
+            field=models.ForeignKey(blank=True, help_text='Barber/chair assigned to this appointment', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='appointments', to='booking.barber'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0003_barber'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='email_sent',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='email_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0005_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('request_hash', models.CharField(help_text='Fingerprint of the request the key was first used with', max_length=64)),
+                ('response_status', models.PositiveSmallIntegerField(default=200)),
+                ('response_body', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_keys', to='booking.appointment')),
+            ],
+            options={
+                'verbose_name': 'Idempotency Key',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['expires_at'], name='booking_ide_expires_a6ca9b_idx')],
+            },
+        ),
+    ]
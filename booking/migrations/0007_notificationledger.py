@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('email', 'Email'), ('whatsapp', 'WhatsApp')], max_length=20)),
+                ('event', models.CharField(help_text="Message sent, e.g. 'confirmed' or 'reminder'", max_length=50)),
+                ('status', models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed')], default='sent', max_length=20)),
+                ('provider_message_id', models.CharField(blank=True, help_text='WhatsApp message ID, if any', max_length=128)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('appointment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_ledger', to='booking.appointment')),
+            ],
+            options={
+                'verbose_name': 'Notification Ledger Entry',
+                'verbose_name_plural': 'Notification Ledger',
+                'ordering': ['-updated_at'],
+                'indexes': [models.Index(fields=['provider_message_id'], name='booking_not_provide_a9f336_idx')],
+                'constraints': [models.UniqueConstraint(fields=('appointment', 'channel', 'event'), name='unique_notification_per_event')],
+            },
+        ),
+    ]
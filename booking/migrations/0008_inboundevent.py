@@ -0,0 +1,33 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_notificationledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('body', models.TextField(help_text='Webhook request body as received')),
+                ('sender', models.CharField(blank=True, help_text="WhatsApp number of the first message's sender", max_length=32)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('claimed_by', models.CharField(blank=True, max_length=64)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Inbound Webhook Event',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='booking_inb_status_5b54b6_idx'), models.Index(fields=['sender', 'status'], name='booking_inb_sender_524759_idx'), models.Index(fields=['received_at'], name='booking_inb_receive_be989b_idx')],
+            },
+        ),
+    ]
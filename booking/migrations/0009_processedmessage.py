@@ -0,0 +1,27 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0008_inboundevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=128, unique=True)),
+                ('sender', models.CharField(blank=True, max_length=32)),
+                ('processed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Processed WhatsApp Message',
+                'ordering': ['-processed_at'],
+                'indexes': [models.Index(fields=['processed_at'], name='booking_pro_process_ee6d19_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-17 03:53
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0009_processedmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboundevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -19,6 +19,19 @@ class Service(models.Model):
     def __str__(self):
         return f"{self.name} - ${self.price}"
 
+class Barber(models.Model):
+    """Barber/chair resource that appointments are assigned to"""
+    name = models.CharField(max_length=100, unique=True)
+    is_active = models.BooleanField(default=True, help_text="Inactive barbers do not count towards capacity")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
 class Appointment(models.Model):
     """Appointment booking model"""
     STATUS_CHOICES = [
@@ -47,6 +60,10 @@ class Appointment(models.Model):
     
     # Appointment details
     service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='appointments')
+    barber = models.ForeignKey(
+        Barber, on_delete=models.SET_NULL, null=True, blank=True, related_name='appointments',
+        help_text="Barber/chair assigned to this appointment"
+    )
     date = models.DateField()
     time = models.TimeField()
     duration = models.IntegerField(help_text="Duration in minutes", default=30)
@@ -65,6 +82,10 @@ class Appointment(models.Model):
     whatsapp_sent = models.BooleanField(default=False)
     whatsapp_sent_at = models.DateTimeField(null=True, blank=True)
     
+    # Email delivery (recorded by the background notification workers)
+    email_sent = models.BooleanField(default=False)
+    email_sent_at = models.DateTimeField(null=True, blank=True)
+    
     class Meta:
         ordering = ['-date', '-time']
         indexes = [
@@ -171,3 +192,155 @@ class Holiday(models.Model):
     def is_this_year(self):
         """Check if holiday is in current year"""
         return self.date.year == timezone.now().year
+
+class NotificationOutbox(models.Model):
+    """Durable queue of customer/barber notifications awaiting delivery"""
+    CHANNEL_CHOICES = [
+        ('email', 'Email'),
+        ('whatsapp', 'WhatsApp'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    template = models.CharField(max_length=50, help_text="Message template, e.g. 'pending' or 'confirmed'")
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='outbox_messages')
+    payload = models.JSONField(default=dict, blank=True)
+    
+    # Delivery state
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    
+    # Claim held by the worker currently delivering this message
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['next_attempt_at', 'id']
+        verbose_name = 'Outbox Message'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),  # Worker claim query
+            models.Index(fields=['claimed_by']),
+        ]
+
+    def __str__(self):
+        return f"{self.channel}/{self.template} for appointment {self.appointment_id} - {self.status}"
+
+class NotificationLedger(models.Model):
+    """Record of each notification sent for an appointment, one row per (appointment, channel, event)"""
+    CHANNEL_CHOICES = NotificationOutbox.CHANNEL_CHOICES
+    
+    STATUS_CHOICES = [
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, related_name='notification_ledger')
+    channel = models.CharField(max_length=20, choices=CHANNEL_CHOICES)
+    event = models.CharField(max_length=50, help_text="Message sent, e.g. 'confirmed' or 'reminder'")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='sent')
+    provider_message_id = models.CharField(max_length=128, blank=True, help_text="WhatsApp message ID, if any")
+    sent_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-updated_at']
+        verbose_name = 'Notification Ledger Entry'
+        verbose_name_plural = 'Notification Ledger'
+        constraints = [
+            # Also the index behind the duplicate check and the bulk prefilter
+            models.UniqueConstraint(fields=['appointment', 'channel', 'event'], name='unique_notification_per_event'),
+        ]
+        indexes = [
+            models.Index(fields=['provider_message_id']),  # Matching delivery status webhooks
+        ]
+
+    def __str__(self):
+        return f"{self.channel}/{self.event} for appointment {self.appointment_id} - {self.status}"
+
+class InboundEvent(models.Model):
+    """Raw WhatsApp webhook delivery, stored on receipt and processed in the background"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    body = models.TextField(help_text="Webhook request body as received")
+    sender = models.CharField(max_length=32, blank=True, help_text="WhatsApp number of the first message's sender")
+    
+    # Processing state; failed events are retried with backoff, then parked as 'failed'
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    claimed_by = models.CharField(max_length=64, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Timestamps
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Inbound Webhook Event'
+        indexes = [
+            models.Index(fields=['status', 'id']),  # Worker claim query, oldest first
+            models.Index(fields=['sender', 'status']),  # Senders with an event in progress
+            models.Index(fields=['received_at']),  # Pruning processed events
+        ]
+
+    def __str__(self):
+        return f"Webhook event {self.id} from {self.sender or 'unknown'} - {self.status}"
+
+class ProcessedMessage(models.Model):
+    """ID of an incoming WhatsApp message that was handled, so redeliveries are ignored"""
+    message_id = models.CharField(max_length=128, unique=True)
+    sender = models.CharField(max_length=32, blank=True)
+    processed_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-processed_at']
+        verbose_name = 'Processed WhatsApp Message'
+        indexes = [
+            models.Index(fields=['processed_at']),  # Pruning past the TTL
+        ]
+
+    def __str__(self):
+        return f"{self.message_id} from {self.sender or 'unknown'}"
+
+class IdempotencyKey(models.Model):
+    """Stored response for a client-supplied Idempotency-Key, replayed on retries"""
+    key = models.CharField(max_length=255, unique=True)
+    request_hash = models.CharField(max_length=64, help_text="Fingerprint of the request the key was first used with")
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, null=True, blank=True, related_name='idempotency_keys')
+    response_status = models.PositiveSmallIntegerField(default=200)
+    response_body = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Idempotency Key'
+        indexes = [
+            models.Index(fields=['expires_at']),  # Pruning expired keys
+        ]
+
+    def __str__(self):
+        return f"{self.key} -> {self.response_status}"
+
+    def is_expired(self):
+        """Check if the key is past its TTL"""
+        return self.expires_at <= timezone.now()
@@ -0,0 +1,147 @@
+"""
+Notification template registry.
+
+Every email and WhatsApp message is registered here under a (channel, event)
+key. Templates are compiled the first time they are used and then kept for
+the life of the process, and the context for an appointment is built once
+and shared by every template rendered for it. The batch helpers look a
+template up once and render it for many appointments (loaded with their
+services, e.g. by claim_messages()); the outbox delivers its email rows with
+build_emails() and booking.mail.send_batch().
+"""
+import threading
+from collections import namedtuple
+import logging
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import get_template
+
+logger = logging.getLogger(__name__)
+
+RenderedNotification = namedtuple('RenderedNotification', ['subject', 'text', 'html'])
+
+
+class NotificationTemplate:
+    """Subject line plus text (and optional HTML) templates for one message"""
+
+    def __init__(self, channel, event, text_template, html_template=None, subject=''):
+        self.channel = channel
+        self.event = event
+        self.text_template = text_template
+        self.html_template = html_template
+        self.subject = subject
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def compiled(self):
+        """Return the (text, html) Template objects, compiling them on first use"""
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._compiled = (
+                        get_template(self.text_template),
+                        get_template(self.html_template) if self.html_template else None,
+                    )
+        return self._compiled
+
+    def render(self, context):
+        """Render the message for a prepared context"""
+        text_template, html_template = self.compiled()
+        text = text_template.render(context)
+        if self.channel == 'whatsapp':
+            text = text.strip()
+        return RenderedNotification(
+            subject=self.subject.format(**context),
+            text=text,
+            html=html_template.render(context) if html_template else None,
+        )
+
+
+_registry = {}
+
+
+def register(channel, event, text_template, html_template=None, subject=''):
+    """Register the template for a (channel, event) pair"""
+    _registry[(channel, event)] = NotificationTemplate(channel, event, text_template, html_template, subject)
+
+
+def get_notification_template(channel, event):
+    try:
+        return _registry[(channel, event)]
+    except KeyError:
+        raise LookupError(f"No notification template registered for {channel}/{event}")
+
+
+def build_context(appointment):
+    """Template context for an appointment; its service should already be loaded"""
+    service = appointment.service
+    return {
+        'appointment': appointment,
+        'formatted_time': appointment.time.strftime('%I:%M %p'),
+        'service_name': service.name,
+        'service_price': service.price,
+        'service_duration': appointment.get_duration_display(),
+    }
+
+
+def render_notification(channel, event, appointment, context=None):
+    """Render one message; pass a context from build_context to reuse it"""
+    return get_notification_template(channel, event).render(context or build_context(appointment))
+
+
+def render_notifications(channel, event, appointments):
+    """Render the same message for many appointments"""
+    template = get_notification_template(channel, event)
+    return [template.render(build_context(appointment)) for appointment in appointments]
+
+
+def email_message(rendered, appointment):
+    """Wrap a rendered email in an EmailMultiAlternatives to the appointment's customer"""
+    message = EmailMultiAlternatives(
+        subject=rendered.subject,
+        body=rendered.text,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[appointment.email],
+    )
+    if rendered.html:
+        message.attach_alternative(rendered.html, 'text/html')
+    return message
+
+
+def build_email(event, appointment, context=None):
+    """Build the EmailMultiAlternatives for an appointment event"""
+    return email_message(render_notification('email', event, appointment, context), appointment)
+
+
+def build_emails(event, appointments):
+    """Build the emails for many appointments, ready for booking.mail.send_batch"""
+    return [
+        email_message(rendered, appointment)
+        for rendered, appointment in zip(render_notifications('email', event, appointments), appointments)
+    ]
+
+
+# Emails
+register('email', 'booked', 'booking/emails/appointment_confirmation.txt', 'booking/emails/appointment_confirmation.html',
+         subject='Appointment Confirmation - {service_name}')
+register('email', 'pending', 'booking/emails/appointment_pending.txt', 'booking/emails/appointment_pending.html',
+         subject='Appointment Request Submitted - {service_name}')
+register('email', 'confirmed', 'booking/emails/appointment_status_confirmed.txt', 'booking/emails/appointment_status_confirmed.html',
+         subject='Appointment Confirmed - {service_name}')
+register('email', 'cancelled', 'booking/emails/appointment_status_cancelled.txt', 'booking/emails/appointment_status_cancelled.html',
+         subject='Appointment Cancelled - {service_name}')
+register('email', 'completed', 'booking/emails/appointment_status_completed.txt', 'booking/emails/appointment_status_completed.html',
+         subject='Appointment Completed - {service_name}')
+register('email', 'reminder', 'booking/emails/appointment_reminder.txt', 'booking/emails/appointment_reminder.html',
+         subject='Appointment Reminder - {service_name}')
+register('email', 'cancellation', 'booking/emails/appointment_cancelled.txt', 'booking/emails/appointment_cancelled.html',
+         subject='Appointment Cancelled - {service_name}')
+
+# WhatsApp
+register('whatsapp', 'pending', 'booking/whatsapp/pending.txt')
+register('whatsapp', 'confirmed', 'booking/whatsapp/confirmed.txt')
+register('whatsapp', 'cancelled', 'booking/whatsapp/cancelled.txt')
+register('whatsapp', 'reminder', 'booking/whatsapp/reminder.txt')
+register('whatsapp', 'completed', 'booking/whatsapp/completed.txt')
+register('whatsapp', 'update', 'booking/whatsapp/update.txt')
+register('whatsapp', 'approval_request', 'booking/whatsapp/approval_request.txt')
@@ -0,0 +1,396 @@
+"""
+Notification outbox.
+
+Appointment changes write their emails and WhatsApp messages as
+NotificationOutbox rows in the same transaction as the change itself, so a
+committed change always has its notifications recorded and a rolled back one
+never does. Delivery happens outside the request:
+
+- After commit, the new rows are handed to a background thread pool
+  (NOTIFICATION_DISPATCH = 'thread', the default) or delivered inline
+  ('sync'). With 'worker', only the run_outbox command delivers.
+- ``manage.py run_outbox`` claims due rows in batches, delivers them and
+  retries failures with exponential backoff until NOTIFICATION_MAX_ATTEMPTS.
+- Bulk runs such as ``manage.py send_reminders`` deliver their rows with
+  deliver_concurrently(), a bounded thread pool paced to a messages-per-second
+  budget.
+- Email rows with the same template are rendered together and sent over one
+  SMTP connection (deliver_email_batch); other rows are sent one by one.
+
+Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED where the database
+supports it (PostgreSQL), followed by a conditional UPDATE that only succeeds
+for rows still unclaimed, so concurrent workers never deliver the same row.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.core.mail.message import make_msgid
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Messages sent for each appointment event, as (channel, template) pairs
+NOTIFICATION_PLAN = {
+    'pending': [('email', 'pending'), ('whatsapp', 'pending'), ('whatsapp', 'approval_request')],
+    'confirmed': [('whatsapp', 'confirmed'), ('email', 'confirmed')],
+    'cancelled': [('whatsapp', 'cancelled'), ('email', 'cancelled')],
+    'completed': [('whatsapp', 'completed'), ('email', 'completed')],
+    'reminder': [('whatsapp', 'reminder'), ('email', 'reminder')],
+}
+
+# Claims older than this are assumed to belong to a crashed worker
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+# Rows per background delivery task, so a large batch is spread over the pool
+DISPATCH_CHUNK_SIZE = 20
+
+# Emails rendered together and sent over one SMTP connection
+EMAIL_BATCH_SIZE = 50
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_sender(channel, template):
+    """Return the function that delivers a (channel, template) message"""
+    from . import utils, webhook_views
+
+    senders = {
+        ('email', 'pending'): utils.send_pending_appointment_email,
+        ('email', 'confirmed'): utils.send_status_confirmation_email,
+        ('email', 'cancelled'): utils.send_status_cancellation_email,
+        ('email', 'completed'): utils.send_status_completion_email,
+        ('email', 'reminder'): utils.send_reminder_email,
+        ('whatsapp', 'pending'): lambda appointment: webhook_views.send_appointment_notification(appointment, 'pending'),
+        ('whatsapp', 'confirmed'): lambda appointment: webhook_views.send_appointment_notification(appointment, 'confirmation'),
+        ('whatsapp', 'cancelled'): lambda appointment: webhook_views.send_appointment_notification(appointment, 'cancellation'),
+        ('whatsapp', 'completed'): lambda appointment: webhook_views.send_appointment_notification(appointment, 'completion'),
+        ('whatsapp', 'reminder'): lambda appointment: webhook_views.send_appointment_notification(appointment, 'reminder'),
+        ('whatsapp', 'approval_request'): webhook_views.send_approval_request_to_barber,
+    }
+    return senders[(channel, template)]
+
+
+def get_executor():
+    """Return the shared notification thread pool"""
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'NOTIFICATION_WORKERS', 4),
+                    thread_name_prefix='notifications'
+                )
+    return _executor
+
+
+def worker_id():
+    """Unique claim token for one delivery pass"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _recipient(appointment, channel, template):
+    """Address a message goes to, kept in the payload for auditing"""
+    if channel == 'email':
+        return appointment.email
+    if template == 'approval_request':
+        return str(settings.BARBER_WHATSAPP)
+    return appointment.phone
+
+
+def build_outbox_messages(appointment, event, channels=None):
+    """Build (unsaved) outbox rows for every message planned for an event, optionally only on some channels"""
+    from .models import NotificationOutbox
+
+    return [
+        NotificationOutbox(
+            channel=channel,
+            template=template,
+            appointment=appointment,
+            payload={'event': event, 'recipient': _recipient(appointment, channel, template)},
+        )
+        for channel, template in NOTIFICATION_PLAN.get(event, [])
+        if channels is None or channel in channels
+    ]
+
+
+def dispatch_on_commit(message_ids):
+    """Start delivering outbox rows once the current transaction commits"""
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+
+    mode = getattr(settings, 'NOTIFICATION_DISPATCH', 'thread')
+    if mode == 'sync':
+        transaction.on_commit(lambda: deliver_outbox_messages(message_ids))
+    elif mode == 'thread':
+        for start in range(0, len(message_ids), DISPATCH_CHUNK_SIZE):
+            chunk = message_ids[start:start + DISPATCH_CHUNK_SIZE]
+            transaction.on_commit(lambda chunk=chunk: get_executor().submit(_deliver_in_worker, chunk))
+
+
+def enqueue_notifications(appointment, event):
+    """
+    Record the notifications for an appointment event in the outbox.
+
+    Call inside the transaction that changes the appointment; delivery
+    starts after that transaction commits.
+    """
+    from .models import NotificationOutbox
+
+    messages = NotificationOutbox.objects.bulk_create(build_outbox_messages(appointment, event))
+    dispatch_on_commit(message.pk for message in messages)
+    return messages
+
+
+def enqueue_bulk_notifications(appointments, event, channels=None):
+    """
+    Record an event's notifications for many appointments with one INSERT.
+
+    Like enqueue_notifications, call inside the transaction that changes the
+    appointments. Only the appointments' pk, email and phone are used.
+    """
+    from .models import NotificationOutbox
+
+    messages = NotificationOutbox.objects.bulk_create([
+        message
+        for appointment in appointments
+        for message in build_outbox_messages(appointment, event, channels)
+    ])
+    dispatch_on_commit(message.pk for message in messages)
+    return messages
+
+
+def claim_messages(batch_size=50, message_ids=None, claimed_by=None):
+    """
+    Claim due outbox rows for delivery and return them.
+
+    Pass message_ids to claim only those rows (the post-commit fast path);
+    otherwise every due or abandoned row is eligible.
+    """
+    from .models import NotificationOutbox
+
+    claimed_by = claimed_by or worker_id()
+    now = timezone.now()
+
+    due = Q(status='pending', next_attempt_at__lte=now) | Q(status='processing', claimed_at__lt=now - CLAIM_TIMEOUT)
+    if message_ids is not None:
+        due &= Q(pk__in=message_ids)
+
+    with transaction.atomic():
+        candidates = NotificationOutbox.objects.filter(due).order_by('next_attempt_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('pk', flat=True)[:batch_size])
+
+        if not ids:
+            return []
+
+        # Only rows nobody else claimed in the meantime are updated
+        NotificationOutbox.objects.filter(due, pk__in=ids).update(
+            status='processing',
+            claimed_by=claimed_by,
+            claimed_at=now
+        )
+
+    return list(
+        NotificationOutbox.objects.filter(claimed_by=claimed_by, status='processing')
+        .select_related('appointment__service')
+        .order_by('next_attempt_at', 'id')
+    )
+
+
+def retry_delay(attempts):
+    """Exponential backoff before the next delivery attempt"""
+    base = getattr(settings, 'NOTIFICATION_RETRY_BASE_SECONDS', 30)
+    cap = getattr(settings, 'NOTIFICATION_RETRY_MAX_SECONDS', 3600)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), cap))
+
+
+def deliver_message(message):
+    """Deliver one claimed outbox row and record the outcome; returns True on success"""
+    from .webhook_views import send_immediately
+
+    appointment = message.appointment
+    error = ''
+    try:
+        # Delivered synchronously from a webhook's transaction, a WhatsApp send
+        # would otherwise only be collected as a reply and not sent yet
+        with send_immediately():
+            sent = bool(get_sender(message.channel, message.template)(appointment))
+        if not sent:
+            error = 'Sender reported failure'
+    except Exception as e:
+        logger.error("Failed to send %s %s notification for appointment %s: %s", message.channel, message.template, appointment.id, e)
+        sent = False
+        error = str(e)
+
+    return settle_message(message, sent, error)
+
+
+def settle_message(message, sent, error=''):
+    """Record the outcome of a delivery attempt on a claimed outbox row; returns sent"""
+    from .models import Appointment, NotificationOutbox
+
+    now = timezone.now()
+    attempts = message.attempts + 1
+    updates = {'attempts': attempts, 'claimed_by': '', 'claimed_at': None, 'last_error': error}
+
+    if sent:
+        updates.update(status='sent', sent_at=now)
+        if message.channel == 'email':
+            Appointment.objects.filter(pk=message.appointment_id).update(email_sent=True, email_sent_at=now)
+    elif attempts >= getattr(settings, 'NOTIFICATION_MAX_ATTEMPTS', 5):
+        updates.update(status='failed')
+        logger.warning("Giving up on %s %s notification %s after %s attempts", message.channel, message.template, message.pk, attempts)
+    else:
+        updates.update(status='pending', next_attempt_at=now + retry_delay(attempts))
+
+    NotificationOutbox.objects.filter(pk=message.pk).update(**updates)
+    for field, value in updates.items():
+        setattr(message, field, value)
+    return sent
+
+
+def deliver_email_batch(messages, before_send=None):
+    """
+    Deliver claimed email rows that share a template; returns whether each was sent.
+
+    The template is looked up once and rendered for every appointment (the
+    claimed rows carry their appointments and services), and the emails go
+    out over one connection with booking.mail.send_batch(). Appointments the
+    ledger shows were already emailed are settled without sending again.
+    """
+    from .ledger import notified_appointment_ids, record_failed, record_sent
+    from .mail import send_batch
+    from .notification_templates import build_emails
+
+    template = messages[0].template
+    notified = notified_appointment_ids([message.appointment_id for message in messages], 'email', template)
+    to_send = [message for message in messages if message.appointment_id not in notified]
+
+    errors = {}
+    if to_send:
+        try:
+            emails = build_emails(template, [message.appointment for message in to_send])
+        except Exception as e:
+            logger.error("Failed to render %s emails: %s", template, e)
+            emails, errors = [], {message.pk: e for message in to_send}
+
+        for email in emails:
+            email.extra_headers['Message-ID'] = make_msgid()
+        for message, email, error in zip(to_send, emails, send_batch(emails, before_send)):
+            if error is None:
+                record_sent(message.appointment_id, 'email', template, email.extra_headers['Message-ID'])
+            else:
+                logger.error("Failed to send %s email for appointment %s: %s", template, message.appointment_id, error)
+                record_failed(message.appointment_id, 'email', template)
+                errors[message.pk] = error
+
+    if to_send:
+        logger.info("Sent %s of %s %s email(s) in one batch", len(to_send) - len(errors), len(to_send), template)
+    return [
+        settle_message(message, message.pk not in errors, str(errors.get(message.pk, '')))
+        for message in messages
+    ]
+
+
+def batch_messages(messages):
+    """
+    Split claimed rows into units of delivery: lists of email rows sharing a
+    template (at most EMAIL_BATCH_SIZE each) and single rows for other channels.
+    """
+    emails = {}
+    units = []
+    for message in messages:
+        if message.channel == 'email':
+            emails.setdefault(message.template, []).append(message)
+        else:
+            units.append([message])
+    for rows in emails.values():
+        units.extend(rows[start:start + EMAIL_BATCH_SIZE] for start in range(0, len(rows), EMAIL_BATCH_SIZE))
+    return units
+
+
+def deliver_unit(unit, before_send=None):
+    """Deliver one unit from batch_messages(); returns whether each row was sent"""
+    if unit[0].channel == 'email':
+        return deliver_email_batch(unit, before_send)
+    if before_send:
+        before_send()
+    return [deliver_message(unit[0])]
+
+
+def deliver_outbox_messages(message_ids=None, batch_size=50):
+    """Claim and deliver one batch of outbox rows; returns (sent, failed) counts"""
+    results = [
+        sent
+        for unit in batch_messages(claim_messages(batch_size=batch_size, message_ids=message_ids))
+        for sent in deliver_unit(unit)
+    ]
+    sent = sum(results)
+    return sent, len(results) - sent
+
+
+def _deliver_in_worker(message_ids):
+    """Run deliver_outbox_messages on a pool thread and release its DB connection"""
+    try:
+        deliver_outbox_messages(message_ids, batch_size=len(message_ids))
+    except Exception as e:
+        logger.error("Error delivering outbox messages %s: %s", message_ids, e)
+    finally:
+        close_old_connections()
+
+
+class SendPacer:
+    """Spaces calls out so that, across all threads, at most ``rate`` start per second"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller's slot in the budget comes up"""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def deliver_concurrently(messages, workers=None, rate=None):
+    """
+    Deliver claimed outbox rows on a bounded thread pool; returns (sent, failed).
+
+    Email rows go out in per-template batches, each rendered together and
+    sent over one SMTP connection. ``workers`` caps the batches and WhatsApp
+    sends in flight and ``rate`` the messages started per second (None for no
+    limit).
+    """
+    pacer = SendPacer(rate)
+    workers = workers or getattr(settings, 'NOTIFICATION_WORKERS', 4)
+
+    def deliver(unit):
+        try:
+            return deliver_unit(unit, pacer.wait)
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-notifications') as executor:
+        results = [sent for unit_results in executor.map(deliver, batch_messages(messages)) for sent in unit_results]
+
+    sent = sum(results)
+    return sent, len(results) - sent
@@ -0,0 +1,228 @@
+"""
+Cache-backed rate limiting with the generic cell rate algorithm (GCRA).
+
+Each (scope, client) pair is a bucket that drains evenly over the rate's
+period, so '5/m' allows a burst of five requests and then one more every
+twelve seconds, with no window boundary at which the allowance resets. The
+bucket is a single cache key holding its theoretical arrival time (TAT): the
+moment, in milliseconds, at which it will be empty again. The TAT carries
+both the time of the last accepted request and the bucket's level (how far
+the TAT is ahead of now).
+
+A check reads the TAT and, if the request is accepted, moves it forward. That
+read-modify-write is done atomically in one round trip:
+
+- Redis: a Lua script run by the server (EVALSHA), so concurrent workers
+  never lose updates.
+- Local-memory cache: under a process-wide lock, with no network round trip
+  at all. The buckets are private to each process (see booking.W001).
+
+Other backends (Memcached, the database cache) have no atomic
+read-modify-write, so checks there are only serialized within a process and
+booking.W002 recommends Redis.
+
+Limits are configured per scope in settings.RATE_LIMITS and applied with the
+``rate_limit`` decorator. Requests over the limit get a 429 response with a
+Retry-After header.
+"""
+import math
+import threading
+import time
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+import logging
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.http import JsonResponse
+
+logger = logging.getLogger(__name__)
+
+BUCKET_KEY = 'ratelimit:{scope}:{client}'
+
+PERIOD_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# GCRA on the server: KEYS[1] holds the TAT; ARGV is now, interval and period
+# in milliseconds. Returns 0 when accepted, else the milliseconds to wait.
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(ARGV[2])
+local period = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+local new_tat = math.max(tat, now) + interval
+local excess = new_tat - now - period
+if excess > 0 then
+    return math.ceil(excess)
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil(new_tat - now) + 1000)
+return 0
+"""
+
+# Serializes read-modify-write checks on backends without a server-side script
+_bucket_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """Parse 'N/unit' (e.g. '5/m' or '100/h') into (tokens, period_seconds)"""
+    try:
+        count, unit = rate.split('/')
+        return int(count), PERIOD_SECONDS[unit.strip().lower()[0]]
+    except (ValueError, KeyError, IndexError):
+        raise ValueError(f"Invalid rate '{rate}'; expected e.g. '5/m'")
+
+
+def get_rate(scope):
+    """Return the configured (tokens, period_seconds) for a scope, or None if unlimited"""
+    rate = getattr(settings, 'RATE_LIMITS', {}).get(scope)
+    return parse_rate(rate) if rate else None
+
+
+def client_ip(request):
+    """Identify the client, honouring X-Forwarded-For only behind a trusted proxy"""
+    if getattr(settings, 'RATE_LIMIT_TRUST_X_FORWARDED_FOR', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', 'unknown')
+
+
+def _bucket(scope, client, tokens, period):
+    """Return (key, interval_ms, period_ms) for a client's bucket"""
+    period_ms = period * 1000
+    return BUCKET_KEY.format(scope=scope, client=client), period_ms / tokens, period_ms
+
+
+def _excess(tat_ms, interval_ms, period_ms, now_ms):
+    """
+    Apply GCRA to a bucket's stored TAT (None if it has none).
+
+    Returns (excess_ms, new_tat_ms): excess_ms is how long the request would
+    have to wait, 0 when it is accepted and the TAT moves to new_tat_ms.
+    """
+    new_tat_ms = max(tat_ms or now_ms, now_ms) + interval_ms
+    # The bucket may be at most one period ahead of now, which is the burst of N requests
+    return max(new_tat_ms - now_ms - period_ms, 0), new_tat_ms
+
+
+def _verdict(excess_ms):
+    """Turn the wait a request would need into (allowed, retry_after_seconds)"""
+    if excess_ms > 0:
+        return False, max(1, math.ceil(excess_ms / 1000))
+    return True, 0
+
+
+def _cache():
+    return caches[getattr(settings, 'RATE_LIMIT_CACHE', 'default')]
+
+
+def _run_script(cache, key, interval_ms, period_ms, now_ms):
+    """Run GCRA_SCRIPT on the Redis server behind a RedisCache"""
+    key = cache.make_and_validate_key(key)
+    client = cache._cache.get_client(key, write=True)
+    return client.register_script(GCRA_SCRIPT)(keys=[key], args=[now_ms, interval_ms, period_ms])
+
+
+def check_rate(scope, client, tokens, period, now=None):
+    """
+    Take one request from a client's bucket.
+
+    Returns (allowed, retry_after_seconds). Rejected requests do not fill the
+    bucket, so a client that keeps retrying is let through again as soon as
+    it drains.
+    """
+    cache = _cache()
+    key, interval_ms, period_ms = _bucket(scope, client, tokens, period)
+    now_ms = (time.time() if now is None else now) * 1000
+
+    if isinstance(cache, RedisCache):
+        return _verdict(_run_script(cache, key, interval_ms, period_ms, now_ms))
+
+    with _bucket_lock:
+        excess_ms, new_tat_ms = _excess(cache.get(key), interval_ms, period_ms, now_ms)
+        if not excess_ms:
+            cache.set(key, new_tat_ms, math.ceil((new_tat_ms - now_ms) / 1000) + 1)
+    return _verdict(excess_ms)
+
+
+async def acheck_rate(scope, client, tokens, period, now=None):
+    """Async version of check_rate; only network-backed caches leave the event loop"""
+    if isinstance(_cache(), LocMemCache):
+        return check_rate(scope, client, tokens, period, now)
+    return await sync_to_async(check_rate)(scope, client, tokens, period, now)
+
+
+def rate_limit(scope, key=client_ip, exempt=None):
+    """
+    Limit a view to the rate configured for ``scope`` in settings.RATE_LIMITS.
+
+    Works on both sync and async views. ``key`` maps the request to the client
+    the bucket belongs to; requests for which ``exempt(request)`` is true are
+    never limited. If the cache is unavailable the request is let through
+    rather than failing.
+    """
+    def enabled(request):
+        """The (tokens, period) to check the request against, or None"""
+        rate = get_rate(scope)
+        if not rate or not getattr(settings, 'RATE_LIMIT_ENABLED', True):
+            return None
+        if exempt is not None and exempt(request):
+            return None
+        return rate
+
+    def limited(request):
+        """Return the 429 response if the request is over its limit, else None"""
+        rate = enabled(request)
+        if not rate:
+            return None
+        try:
+            allowed, retry_after = check_rate(scope, key(request), *rate)
+        except Exception as e:
+            logger.error("Rate limit check failed for %s: %s", scope, e)
+            return None
+        return None if allowed else rejected(request, retry_after)
+
+    async def alimited(request):
+        """Async version of limited"""
+        rate = enabled(request)
+        if not rate:
+            return None
+        try:
+            allowed, retry_after = await acheck_rate(scope, key(request), *rate)
+        except Exception as e:
+            logger.error("Rate limit check failed for %s: %s", scope, e)
+            return None
+        return None if allowed else rejected(request, retry_after)
+
+    def rejected(request, retry_after):
+        logger.warning("Rate limit exceeded for %s by %s", scope, key(request))
+        return too_many_requests(retry_after)
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped(request, *args, **kwargs):
+                response = await alimited(request)
+                if response is not None:
+                    return response
+                return await view_func(request, *args, **kwargs)
+            return async_wrapped
+
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            response = limited(request)
+            if response is not None:
+                return response
+            return view_func(request, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def too_many_requests(retry_after):
+    """429 response telling the client when to retry"""
+    response = JsonResponse({
+        'success': False,
+        'error': 'Too many requests. Please wait a moment and try again.'
+    }, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
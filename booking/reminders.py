@@ -0,0 +1,106 @@
+"""
+Appointment reminders.
+
+Reminders for a day's confirmed appointments are recorded in the
+notification outbox like any other message, so the outbox row for each
+(appointment, channel) is the record of whether that reminder went out:
+a re-run only enqueues the channels that have no live reminder row (or
+ledger entry) yet, and only delivers rows still pending. Rows that failed
+for good do not count, so the next run queues those reminders again.
+Sending uses deliver_concurrently(), which keeps REMINDER_WORKERS sends in
+flight at no more than REMINDER_MESSAGES_PER_SECOND and renders and sends
+the reminder emails in batches over one SMTP connection each.
+"""
+from datetime import timedelta
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .ledger import sent_entries
+from .notifications import NOTIFICATION_PLAN, build_outbox_messages, claim_messages, deliver_concurrently
+
+logger = logging.getLogger(__name__)
+
+REMINDER_CHANNELS = [channel for channel, _ in NOTIFICATION_PLAN['reminder']]
+
+# Outbox rows that still count as a reminder; a failed row is queued again
+QUEUED_STATUSES = ('pending', 'processing', 'sent')
+
+
+def reminder_date():
+    """Reminders go out the day before the appointment"""
+    return timezone.localdate() + timedelta(days=1)
+
+
+def appointments_needing_reminders(day):
+    """
+    Confirmed appointments on a day still missing a reminder on some channel.
+
+    Each appointment is annotated with ``reminded_<channel>``, true when that
+    channel's reminder is queued or sent in the outbox or recorded as sent in
+    the ledger (e.g. queued from the admin or sent by an earlier run). A
+    reminder whose outbox row gave up is picked up again.
+    """
+    from .models import Appointment, NotificationOutbox
+
+    # Served by the (status, date) index; each check is an EXISTS subquery
+    queryset = Appointment.objects.filter(status='confirmed', date=day)
+    reminded = Q()
+    for channel in REMINDER_CHANNELS:
+        queued = NotificationOutbox.objects.filter(
+            appointment=OuterRef('pk'), channel=channel, template='reminder', status__in=QUEUED_STATUSES
+        )
+        queryset = queryset.annotate(**{
+            f'reminded_{channel}': Exists(queued) | Exists(sent_entries(channel, 'reminder'))
+        })
+        reminded &= Q(**{f'reminded_{channel}': True})
+
+    return queryset.exclude(reminded).select_related('service').order_by('time')
+
+
+def enqueue_reminders(day):
+    """Add missing reminder rows to the outbox for a day's appointments; returns how many appointments"""
+    from .models import NotificationOutbox
+
+    with transaction.atomic():
+        appointments = list(appointments_needing_reminders(day))
+        NotificationOutbox.objects.bulk_create([
+            message
+            for appointment in appointments
+            for message in build_outbox_messages(
+                appointment, 'reminder',
+                channels=[channel for channel in REMINDER_CHANNELS if not getattr(appointment, f'reminded_{channel}')]
+            )
+        ])
+    return len(appointments)
+
+
+def pending_reminder_ids(day):
+    """Reminder rows for a day that are still waiting to be delivered"""
+    from .models import NotificationOutbox
+
+    return list(
+        NotificationOutbox.objects.filter(template='reminder', status='pending', appointment__date=day)
+        .values_list('pk', flat=True)
+    )
+
+
+def send_reminders(day=None, workers=None, rate=None):
+    """
+    Enqueue and deliver the reminders for a day (tomorrow by default).
+
+    Returns a dict with the number of appointments enqueued and of messages
+    sent and failed.
+    """
+    day = day or reminder_date()
+    workers = workers or getattr(settings, 'REMINDER_WORKERS', 8)
+    rate = getattr(settings, 'REMINDER_MESSAGES_PER_SECOND', 20) if rate is None else rate
+
+    enqueued = enqueue_reminders(day)
+    message_ids = pending_reminder_ids(day)
+    messages = claim_messages(batch_size=len(message_ids), message_ids=message_ids) if message_ids else []
+
+    sent, failed = deliver_concurrently(messages, workers=workers, rate=rate)
+    logger.info("Reminders for %s: %s appointment(s) enqueued, %s message(s) sent, %s failed", day, enqueued, sent, failed)
+    return {'enqueued': enqueued, 'sent': sent, 'failed': failed}
@@ -0,0 +1,94 @@
+"""
+Race-free appointment reservation.
+
+Checking a slot and inserting the appointment happen inside one transaction
+that holds a per-date lock, so concurrent bookings for the same day are
+serialized and only the ones that still fit the remaining capacity succeed.
+
+- PostgreSQL: a transaction-scoped advisory lock keyed by the date, so
+  bookings for different days never wait on each other.
+- SQLite (and other backends): a process-wide lock around the whole
+  transaction. Across processes, SQLite's database write lock serializes
+  the transactions (see DATABASES['default']['OPTIONS']['transaction_mode']).
+"""
+import threading
+from contextlib import contextmanager
+import logging
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# First key of the two-key PostgreSQL advisory lock, reserved for bookings
+ADVISORY_LOCK_NAMESPACE = 0x46425a  # "FBZ"
+
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def locked_booking_transaction(date, using=DEFAULT_DB_ALIAS):
+    """
+    Open a transaction that holds the booking lock for a date until commit.
+
+    Must be entered outside any other transaction, otherwise the lock would
+    be released before the outer transaction commits.
+    """
+    connection = connections[using]
+
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT pg_advisory_xact_lock(%s, %s)',
+                    [ADVISORY_LOCK_NAMESPACE, date.toordinal()]
+                )
+            yield
+    else:
+        with _write_lock:
+            with transaction.atomic(using=using):
+                yield
+
+
+def reserve_appointment(service, date, time, notify_event=None, on_reserved=None, **fields):
+    """
+    Atomically check capacity for a slot and create the appointment.
+
+    Overlapping intervals (not just equal start times) count against the
+    shop's capacity. If notify_event is given, its notifications are written
+    to the outbox in the same transaction; on_reserved, if given, is called
+    with the new appointment before commit. Returns the new Appointment, or
+    None if the slot is already taken.
+    """
+    from .models import Appointment
+    from .availability import find_slot_barber, load_day_appointments
+    from .notifications import enqueue_notifications
+    from .schedule import get_schedule
+
+    schedule = get_schedule()
+
+    with locked_booking_transaction(date):
+        slot_available, barber_id = find_slot_barber(
+            load_day_appointments(date),
+            time,
+            service.duration,
+            schedule.capacity,
+            schedule.barber_ids
+        )
+        if not slot_available:
+            return None
+
+        appointment = Appointment.objects.create(
+            service=service,
+            barber_id=barber_id,
+            date=date,
+            time=time,
+            duration=service.duration,
+            **fields
+        )
+
+        if notify_event:
+            enqueue_notifications(appointment, notify_event)
+
+        if on_reserved:
+            on_reserved(appointment)
+
+        return appointment
@@ -0,0 +1,100 @@
+"""
+Process-wide cache of the shop schedule.
+
+WorkingHours, Holiday and the active Barber list change a few times a year
+but are checked on every booking and availability request. They are
+compiled once into a Schedule object and kept in memory until a
+post_save/post_delete signal invalidates it (see booking.signals).
+SCHEDULE_CACHE_TIMEOUT bounds how long other worker processes, which do not
+see those signals, can serve a stale copy.
+"""
+import threading
+import time as time_module
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_schedule = None
+_schedule_loaded_at = 0.0
+_schedule_lock = threading.Lock()
+
+
+class Schedule:
+    """Compiled view of the working hours, holidays and barber capacity"""
+
+    def __init__(self, working_hours, holidays, barber_ids=()):
+        # WorkingHours rows keyed by weekday (0=Monday, 6=Sunday)
+        self.working_hours = {wh.day: wh for wh in working_hours}
+
+        # Active barbers; with none configured the shop runs a single chair
+        self.barber_ids = tuple(barber_ids)
+        self.capacity = max(len(self.barber_ids), 1)
+
+        # Exact holiday dates plus (month, day) pairs for recurring holidays
+        self.holiday_dates = frozenset(holiday.date for holiday in holidays)
+        self.recurring_holidays = frozenset(
+            (holiday.date.month, holiday.date.day)
+            for holiday in holidays if holiday.is_recurring
+        )
+
+    @classmethod
+    def load(cls):
+        """Build a schedule with one WorkingHours, Holiday and Barber query each"""
+        from .models import WorkingHours, Holiday, Barber
+
+        return cls(
+            list(WorkingHours.objects.all()),
+            list(Holiday.objects.only('date', 'is_recurring')),
+            Barber.objects.filter(is_active=True).order_by('id').values_list('id', flat=True),
+        )
+
+    def hours_for(self, date):
+        """Return the WorkingHours row for a date's weekday, or None"""
+        return self.working_hours.get(date.weekday())
+
+    def is_holiday(self, date):
+        """Check if given date is a holiday"""
+        return date in self.holiday_dates or (date.month, date.day) in self.recurring_holidays
+
+    def is_open(self, date):
+        """Check if the shop opens at all on the given date"""
+        working_hours = self.hours_for(date)
+        return bool(working_hours and working_hours.is_open and not self.is_holiday(date))
+
+    def is_working_hours(self, date, time):
+        """Check if given date and time are within working hours"""
+        working_hours = self.hours_for(date)
+        if not working_hours or not working_hours.is_open:
+            return False
+        if not working_hours.open_time or not working_hours.close_time:
+            return False
+        return working_hours.open_time <= time <= working_hours.close_time
+
+
+def get_schedule():
+    """Return the cached schedule, rebuilding it if invalidated or expired"""
+    global _schedule, _schedule_loaded_at
+
+    timeout = getattr(settings, 'SCHEDULE_CACHE_TIMEOUT', 300)
+    schedule = _schedule
+    if schedule is not None and time_module.monotonic() - _schedule_loaded_at < timeout:
+        return schedule
+
+    with _schedule_lock:
+        # Another thread may have rebuilt it while we waited
+        if _schedule is not None and time_module.monotonic() - _schedule_loaded_at < timeout:
+            return _schedule
+
+        _schedule = Schedule.load()
+        _schedule_loaded_at = time_module.monotonic()
+        logger.debug("Schedule cache rebuilt")
+        return _schedule
+
+
+def invalidate_schedule():
+    """Drop the cached schedule so the next lookup reloads it"""
+    global _schedule
+
+    with _schedule_lock:
+        _schedule = None
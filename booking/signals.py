@@ -0,0 +1,39 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from .models import Appointment, Barber, WorkingHours, Holiday
+from .schedule import invalidate_schedule
+from .availability_cache import bump_availability_version, bump_schedule_version
+
+
+def schedule_invalidated():
+    """Drop the compiled schedule and every availability built from it"""
+    invalidate_schedule()
+    bump_schedule_version()
+
+
+@receiver(post_save, sender=WorkingHours)
+@receiver(post_delete, sender=WorkingHours)
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+@receiver(post_save, sender=Barber)
+@receiver(post_delete, sender=Barber)
+def schedule_changed(sender, **kwargs):
+    """Rebuild the schedule cache once the change is committed"""
+    transaction.on_commit(schedule_invalidated)
+
+
+@receiver(post_init, sender=Appointment)
+def remember_appointment_date(sender, instance, **kwargs):
+    """Keep the loaded date so a rescheduled appointment frees its old day"""
+    # Read from __dict__ so deferred fields are not fetched
+    instance._loaded_date = instance.__dict__.get('date')
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def appointment_changed(sender, instance, **kwargs):
+    """Invalidate cached availability for the dates an appointment touches"""
+    dates = (instance.date, getattr(instance, '_loaded_date', None))
+    instance._loaded_date = instance.date
+    transaction.on_commit(lambda: bump_availability_version(*dates))
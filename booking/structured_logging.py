@@ -0,0 +1,161 @@
+"""
+Logging helpers for the webhook and notification hot paths.
+
+Log messages here are built only when a handler will actually emit them:
+
+- log_event() writes one ``event key=value ...`` line. The fields also travel
+  on the record (``record.event`` and ``record.event_fields``) for
+  structured formatters. Nothing is formatted when the level is disabled.
+- Lazy wraps a callable whose result is only computed when the message is
+  formatted. It is meant for costly arguments such as ``queryset.count()``.
+- log_payload() writes a bulky payload (webhook bodies, Graph API requests,
+  headers) for only a LOG_PAYLOAD_SAMPLE_RATE share of calls, compact,
+  truncated to LOG_PAYLOAD_MAX_CHARS and with secrets and phone numbers
+  masked.
+
+Each subsystem's verbosity is set in settings.LOG_SUBSYSTEMS and the
+LOG_LEVEL_<SUBSYSTEM> environment variables. QueuedFileHandler moves log
+file writes off the request threads.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from collections.abc import Mapping
+
+# Keys whose values are never logged
+SECRET_KEYS = {'authorization', 'cookie', 'token', 'access_token', 'verify_token', 'hub.verify_token',
+               'password', 'x-hub-signature', 'x-hub-signature-256'}
+
+# Keys holding phone numbers, logged with all but the last four digits masked
+PHONE_KEYS = {'from', 'to', 'wa_id', 'phone', 'recipient_id', 'display_phone_number'}
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_MAX_CHARS = 1000
+
+
+class Lazy:
+    """Defers a call until the log message is formatted"""
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class StructuredMessage:
+    """``event key=value ...`` log message, rendered on first use"""
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        parts = [self.event]
+        for key, value in self.fields.items():
+            value = str(value)
+            parts.append(f'{key}={json.dumps(value) if not value or " " in value else value}')
+        return ' '.join(parts)
+
+
+def log_event(logger, level, event, **fields):
+    """Log a named event with key/value fields, if the level is enabled"""
+    if logger.isEnabledFor(level):
+        logger.log(level, StructuredMessage(event, fields), extra={'event': event, 'event_fields': fields}, stacklevel=2)
+
+
+def mask_phone(value):
+    """Keep the last four digits of a phone number"""
+    value = str(value)
+    return '*' * max(len(value) - 4, 0) + value[-4:]
+
+
+def redact(value):
+    """Copy of a JSON-like value with secrets removed and phone numbers masked"""
+    if isinstance(value, Mapping):
+        redacted = {}
+        for key, item in value.items():
+            name = str(key).lower()
+            if name in SECRET_KEYS:
+                redacted[key] = '[redacted]'
+            elif name in PHONE_KEYS and isinstance(item, (str, int)):
+                redacted[key] = mask_phone(item)
+            else:
+                redacted[key] = redact(item)
+        return redacted
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def truncate(text, max_chars=None):
+    """Shorten text to max_chars (LOG_PAYLOAD_MAX_CHARS by default)"""
+    text = str(text)
+    max_chars = max_chars or payload_max_chars()
+    if len(text) <= max_chars:
+        return text
+    return f'{text[:max_chars]}... ({len(text) - max_chars} more chars)'
+
+
+def render_payload(payload):
+    """Compact, redacted and truncated form of a payload"""
+    return truncate(json.dumps(redact(payload), separators=(',', ':'), ensure_ascii=False, default=str))
+
+
+def payload_sample_rate():
+    from django.conf import settings
+    return getattr(settings, 'LOG_PAYLOAD_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+
+
+def payload_max_chars():
+    from django.conf import settings
+    return getattr(settings, 'LOG_PAYLOAD_MAX_CHARS', DEFAULT_MAX_CHARS)
+
+
+def sampled(rate=None):
+    """True for a ``rate`` share of calls (LOG_PAYLOAD_SAMPLE_RATE by default)"""
+    rate = payload_sample_rate() if rate is None else rate
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def log_payload(logger, label, payload, level=logging.DEBUG, sample_rate=None):
+    """Log a sample of bulky payloads, redacted and truncated, if the level is enabled"""
+    if logger.isEnabledFor(level) and sampled(sample_rate):
+        logger.log(level, '%s: %s', label, Lazy(render_payload, payload), stacklevel=2)
+
+
+class QueuedFileHandler(logging.handlers.QueueHandler):
+    """
+    Log file handler that writes from a background thread.
+
+    Records are formatted by this handler in the logging thread (so deferred
+    arguments see the state they were logged with) and appended to the file
+    by a QueueListener, which is flushed and stopped at exit.
+    """
+
+    def __init__(self, filename, mode='a', encoding='utf-8'):
+        super().__init__(queue.SimpleQueue())
+        target = logging.FileHandler(filename, mode=mode, encoding=encoding)
+        target.setFormatter(logging.Formatter('%(message)s'))
+        self.listener = logging.handlers.QueueListener(self.queue, target)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+    def close(self):
+        self.stop()
+        super().close()
@@ -1,3 +1,1779 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import smtplib
+from io import StringIO
+import tempfile
+import threading
+import time as time_module
+from datetime import time, timedelta
+from unittest import mock, skipUnless
+import requests
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection
+from django.contrib import admin
+from django.test import (
+    AsyncClient, Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+from . import async_views
+from .admin import AppointmentAdmin
+from .availability import BOOKING_HORIZON_DAYS, compute_free_slots, find_slot_barber, full_intervals, load_day_appointments
+from .availability_cache import bump_availability_version, bump_schedule_version, get_cached_availability
+from .checks import check_rate_limit_cache, check_shared_cache
+from .dedupe import get_recent_ids
+from .fake_services import FakeGraphAPI
+from .inbound import claim_events, process_inbound_events, retry_failed_events
+from .mail import PooledEmailBackend, SMTPConnectionPool
+from .ledger import record_sent
+from .models import (
+    Appointment, Barber, Holiday, IdempotencyKey, InboundEvent, NotificationLedger, NotificationOutbox, ProcessedMessage,
+    Service, WorkingHours,
+)
+from .notification_templates import get_notification_template
+from .notifications import (
+    CLAIM_TIMEOUT, claim_messages, deliver_message, deliver_outbox_messages, enqueue_bulk_notifications,
+)
+from .ratelimit import acheck_rate, check_rate
+from .reminders import appointments_needing_reminders, enqueue_reminders, send_reminders
+from .reservations import ADVISORY_LOCK_NAMESPACE, _write_lock, locked_booking_transaction, reserve_appointment
+from .schedule import get_schedule, invalidate_schedule
+from .structured_logging import Lazy, QueuedFileHandler, log_event, log_payload, redact
+from .utils import get_available_slots
+from .webhook_batch import Reply, WebhookBatch, coalesce_replies
+from .whatsapp import AdaptiveRateLimiter, GraphResponse as GraphResult, WhatsAppClient, WhatsAppScheduler, is_throttled
+from .whatsapp_commands import BARBER, COMMAND_ROUTER, CUSTOMER, role_for
+from .webhook_views import (
+    REPLY_PENDING, collect_replies, process_webhook_payload, send_appointment_notification, send_replies,
+    send_whatsapp_message,
+)
 
-# Create your tests here.
+# URLs with the async public endpoints, as served when ASYNC_VIEWS is enabled
+urlpatterns = [
+    path('book/', async_views.booking_page),
+    path('status/<uuid:appointment_id>/', async_views.appointment_status),
+    path('api/available-times/', async_views.get_available_times),
+    path('webhook/', async_views.whatsapp_webhook),
+    path('', include('booking.urls')),
+]
+
+
+class BookingFixtureMixin:
+    """A one-hour service and a shop open 09:00-17:00 every day"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        get_recent_ids().clear()
+        invalidate_schedule()
+        self.service = Service.objects.create(name='Haircut', duration=60, price=25)
+        for day in range(7):
+            WorkingHours.objects.create(day=day, open_time=time(9), close_time=time(17))
+        self.date = timezone.localdate() + timedelta(days=3)
+
+    def tearDown(self):
+        invalidate_schedule()
+        super().tearDown()
+
+    def booking_body(self, **fields):
+        body = {
+            'name': 'Alex Smith',
+            'email': 'alex@example.com',
+            'phone': '+15550001234',
+            'service': self.service.id,
+            'date': self.date.isoformat(),
+            'time': '09:00',
+        }
+        body.update(fields)
+        return json.dumps(body)
+
+    def book(self, client=None, key=None, **fields):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return (client or self.client).post('/book/', data=self.booking_body(**fields),
+                                            content_type='application/json', **headers)
+
+
+class GraphResponse:
+    """Accepted Graph API send"""
+    status_code = 200
+    headers = {}
+    text = '{}'
+
+    def json(self):
+        return {'messages': [{'id': 'wamid.test'}]}
+
+
+class GraphError(GraphResponse):
+    """Send rejected by the Graph API"""
+    status_code = 400
+
+    def json(self):
+        return {'error': {'code': 131030, 'message': 'Recipient phone number not in allowed list'}}
+
+
+def text_delivery(sender, *texts, message_ids=None):
+    """Webhook body with one text message per text"""
+    message_ids = message_ids or [f'wamid.in.{sender}.{index}' for index in range(len(texts))]
+    return {'entry': [{'changes': [{'value': {'messages': [
+        {'from': sender, 'id': message_id, 'type': 'text', 'text': {'body': text}}
+        for message_id, text in zip(message_ids, texts)
+    ]}}]}]}
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class IdempotentBookingTests(BookingFixtureMixin, TestCase):
+
+    def test_retry_replays_stored_response(self):
+        first = self.book(key='retry-1')
+        self.assertEqual(first.status_code, 200)
+
+        retry = self.book(key='retry-1')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['appointment_id'], first.json()['appointment_id'])
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.book(key='retry-2')
+        response = self.book(key='retry-2', time='11:00')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', RATE_LIMITS={'booking': '1/m'})
+class IdempotentReplayRateLimitTests(BookingFixtureMixin, TestCase):
+
+    def test_keyed_retries_replayed_past_rate_limit(self):
+        self.assertEqual(self.book(key='retry-limited').status_code, 200)
+
+        for _ in range(3):
+            retry = self.book(key='retry-limited')
+            self.assertEqual(retry.status_code, 200)
+            self.assertEqual(retry['Idempotent-Replayed'], 'true')
+
+        # Anything that is not a replay still counts against the limit
+        self.assertEqual(self.book(key='another-booking', time='11:00').status_code, 429)
+        self.assertEqual(self.book(time='12:00').status_code, 429)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class ConcurrentIdempotentBookingTests(BookingFixtureMixin, TransactionTestCase):
+
+    def test_racing_retry_replays_instead_of_slot_taken(self):
+        """Both copies of a request pass the replay check before either books the one-chair slot"""
+        responses = []
+
+        def submit():
+            try:
+                responses.append(self.book(client=Client(), key='race-1'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=submit) for _ in range(2)]
+        # Hold the booking lock until both requests are waiting on it
+        with _write_lock:
+            for thread in threads:
+                thread.start()
+            time_module.sleep(0.5)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(len({response.json()['appointment_id'] for response in responses}), 1)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+
+class AvailabilityCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.date = '2030-01-07'
+        self.calls = []
+
+    def compute(self, date):
+        self.calls.append(date)
+        return {'date': date, 'computed': len(self.calls)}
+
+    def test_hit_until_date_version_bumped(self):
+        self.assertEqual(get_cached_availability(self.date, self.compute)['computed'], 1)
+        self.assertEqual(get_cached_availability(self.date, self.compute)['computed'], 1)
+
+        bump_availability_version(self.date)
+        self.assertEqual(get_cached_availability(self.date, self.compute)['computed'], 2)
+
+    def test_schedule_version_invalidates_every_date(self):
+        get_cached_availability(self.date, self.compute)
+        bump_schedule_version()
+        self.assertEqual(get_cached_availability(self.date, self.compute)['computed'], 2)
+
+    def test_stale_entry_recomputed_inline_by_default(self):
+        get_cached_availability(self.date, self.compute)
+        bump_availability_version(self.date)
+        self.assertEqual(get_cached_availability(self.date, self.compute)['computed'], 2)
+        self.assertEqual(self.calls, [self.date, self.date])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_deploy_check_flags_process_local_cache(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['booking.W001'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                           'LOCATION': 'cache_table'}})
+    def test_deploy_check_accepts_shared_cache(self):
+        self.assertEqual(check_shared_cache(None), [])
+
+
+class ScheduleCacheTests(BookingFixtureMixin, TestCase):
+
+    def test_cached_until_invalidated(self):
+        schedule = get_schedule()
+        with self.assertNumQueries(0):
+            self.assertIs(get_schedule(), schedule)
+
+        invalidate_schedule()
+        with self.assertNumQueries(3):
+            self.assertIsNot(get_schedule(), schedule)
+
+    def test_working_hours_change_applies_after_commit(self):
+        self.assertTrue(get_schedule().is_open(self.date))
+        hours = WorkingHours.objects.get(day=self.date.weekday())
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            hours.is_open = False
+            hours.save()
+            # Still the old schedule until the change commits
+            self.assertTrue(get_schedule().is_open(self.date))
+
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(get_schedule().is_open(self.date))
+
+    def test_barber_changes_update_capacity(self):
+        self.assertEqual(get_schedule().capacity, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sam = Barber.objects.create(name='Sam')
+            Barber.objects.create(name='Kai')
+        self.assertEqual(get_schedule().capacity, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sam.is_active = False
+            sam.save()
+        self.assertEqual(get_schedule().barber_ids, (Barber.objects.get(name='Kai').pk,))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Barber.objects.all().delete()
+        self.assertEqual(get_schedule().capacity, 1)
+
+    def test_schedule_change_invalidates_cached_availability(self):
+        day = self.date.isoformat()
+        get_cached_availability(day, lambda date: {'computed': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Holiday.objects.create(date=self.date, description='Closed')
+
+        self.assertTrue(get_schedule().is_holiday(self.date))
+        self.assertEqual(get_cached_availability(day, lambda date: {'computed': 2}), {'computed': 2})
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', BARBER_WHATSAPP='+15550009999')
+class BarberCommandTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='pending'
+        )
+
+    def handle(self, sender, *texts):
+        with mock.patch('requests.Session.post', return_value=GraphResponse()) as post, \
+                self.captureOnCommitCallbacks(execute=True):
+            process_webhook_payload(text_delivery(sender, *texts))
+        return post
+
+    def test_approval_queues_customer_notifications(self):
+        self.handle('15550009999', 'approve')
+
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, 'confirmed')
+        self.assertEqual(
+            sorted(NotificationOutbox.objects.values_list('channel', 'template')),
+            [('email', 'confirmed'), ('whatsapp', 'confirmed')]
+        )
+
+    def test_rejection_queues_customer_notifications(self):
+        self.handle('15550009999', 'reject')
+
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, 'cancelled')
+        self.assertEqual(
+            sorted(NotificationOutbox.objects.values_list('channel', 'template')),
+            [('email', 'cancelled'), ('whatsapp', 'cancelled')]
+        )
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', BARBER_WHATSAPP='+15550009999', WHATSAPP_WEBHOOK_PROCESSING='inline')
+class RedeliveryTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='pending'
+        )
+
+    def deliver(self, body):
+        with mock.patch('requests.Session.post', return_value=GraphResponse()) as post, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/whatsapp-webhook/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return post
+
+    def test_redelivered_message_is_handled_once(self):
+        body = text_delivery('15550009999', 'approve', message_ids=['wamid.approve'])
+        self.assertEqual(self.deliver(body).call_count, 1)
+
+        self.assertEqual(self.deliver(body).call_count, 0)
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+        self.assertEqual(ProcessedMessage.objects.filter(message_id='wamid.approve').count(), 1)
+
+    def test_redelivery_recognised_from_table_after_restart(self):
+        body = text_delivery('15550009999', 'approve', message_ids=['wamid.approve'])
+        self.deliver(body)
+        get_recent_ids().clear()
+
+        self.assertEqual(self.deliver(body).call_count, 0)
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+
+    def test_only_new_messages_of_partial_redelivery_are_handled(self):
+        self.deliver(text_delivery('15550001234', 'status', message_ids=['wamid.first']))
+
+        post = self.deliver(text_delivery('15550001234', 'status', 'help', message_ids=['wamid.first', 'wamid.second']))
+
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(ProcessedMessage.objects.count(), 2)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', BARBER_WHATSAPP='+15550009999')
+class WebhookBatchTests(BookingFixtureMixin, TestCase):
+    """A delivery with several entries, changes and messages, as Meta sends under load"""
+
+    def setUp(self):
+        super().setUp()
+        self.appointments = {
+            phone: Appointment.objects.create(
+                service=self.service, name=f'Customer {phone[-4:]}', email=f'{phone}@example.com', phone=phone,
+                date=self.date, time=time(9 + index), duration=60, status='confirmed'
+            )
+            for index, phone in enumerate(('15550001111', '15550002222'))
+        }
+
+    def message(self, sender, message_id, text):
+        return {'from': sender, 'id': message_id, 'type': 'text', 'text': {'body': text}}
+
+    def payload(self):
+        pending = self.appointments['15550002222']
+        return {'entry': [
+            {'changes': [
+                {'value': {'messages': [
+                    self.message('15550001111', 'wamid.1', 'status'),
+                    self.message('15550001111', 'wamid.2', 'help'),
+                ]}},
+                {'value': {
+                    'messages': [{
+                        'from': '15550009999', 'id': 'wamid.3', 'type': 'interactive',
+                        'interactive': {'type': 'button_reply', 'button_reply': {'id': f'approve_{pending.appointment_id}'}},
+                    }],
+                    'statuses': [{'id': 'wamid.out.1', 'status': 'delivered'}],
+                }},
+            ]},
+            {'changes': [
+                {'value': {'messages': [
+                    self.message('15550002222', 'wamid.4', 'status'),
+                    self.message('15550001111', 'wamid.5', 'status'),
+                ]}},
+            ]},
+        ]}
+
+    def test_preload_loads_every_referenced_appointment_in_one_query(self):
+        batch = WebhookBatch(self.payload())
+        self.assertEqual(len(batch.messages), 5)
+        self.assertEqual(len(batch.statuses), 1)
+
+        with self.assertNumQueries(1):
+            batch.preload()
+
+        pending = self.appointments['15550002222']
+        with self.assertNumQueries(0):
+            self.assertEqual(batch.appointment(str(pending.appointment_id)).pk, pending.pk)
+            self.assertEqual(batch.latest_for_phone('15550001111').pk, self.appointments['15550001111'].pk)
+            self.assertEqual(batch.latest_for_phone('15550002222').service.name, 'Haircut')
+
+    def test_replies_coalesced_per_recipient(self):
+        payload = self.payload()
+        # Leave out the button reply, whose confirmation is covered by BarberCommandTests
+        del payload['entry'][0]['changes'][1]['value']['messages']
+
+        with mock.patch('requests.Session.post', return_value=GraphResponse()) as post, \
+                CaptureQueriesContext(connection) as queries, \
+                self.captureOnCommitCallbacks(execute=True):
+            process_webhook_payload(payload)
+
+        appointment_queries = [query['sql'] for query in queries.captured_queries
+                               if query['sql'].startswith('SELECT') and 'FROM "booking_appointment"' in query['sql']]
+        self.assertEqual(len(appointment_queries), 1)
+
+        bodies = {call.kwargs['json']['to']: call.kwargs['json']['text']['body'] for call in post.call_args_list}
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(set(bodies), {'+15550001111', '+15550002222'})
+        # status + help + a repeated status: one message, the repeat sent once
+        self.assertEqual(bodies['+15550001111'].count('Your latest appointment'), 1)
+        self.assertIn('Customer Commands', bodies['+15550001111'])
+        self.assertIn('Your latest appointment', bodies['+15550002222'])
+
+    def test_coalescing_keeps_order_around_interactive_replies(self):
+        def text(to, body):
+            return Reply({'to': to, 'type': 'text', 'text': {'body': body}})
+
+        buttons = Reply({'to': '1', 'type': 'interactive'})
+        merged = coalesce_replies([text('1', 'a'), text('2', 'x'), text('1', 'b'), buttons, text('1', 'c'), text('1', 'c')])
+
+        self.assertEqual(
+            [(reply.payload['to'], reply.payload.get('text', {}).get('body')) for reply in merged],
+            [('1', 'a\n\nb'), ('2', 'x'), ('1', None), ('1', 'c')]
+        )
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class CollectedNotificationTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='confirmed'
+        )
+
+    def collect_confirmation(self):
+        with collect_replies() as replies:
+            result = send_appointment_notification(self.appointment, 'confirmation')
+        self.assertIs(result, REPLY_PENDING)
+        self.assertEqual(len(replies), 1)
+        return replies
+
+    def test_collected_reply_marked_sent_only_once_delivered(self):
+        replies = self.collect_confirmation()
+        self.appointment.refresh_from_db()
+        self.assertFalse(self.appointment.whatsapp_sent)
+
+        with mock.patch('requests.Session.post', return_value=GraphResponse()):
+            self.assertEqual(send_replies(replies), 1)
+
+        self.appointment.refresh_from_db()
+        self.assertTrue(self.appointment.whatsapp_sent)
+        self.assertTrue(NotificationLedger.objects.filter(
+            appointment=self.appointment, channel='whatsapp', event='confirmed', status='sent'
+        ).exists())
+
+    def test_failed_collected_reply_not_marked_sent(self):
+        replies = self.collect_confirmation()
+        with mock.patch('requests.Session.post', return_value=GraphError()):
+            self.assertEqual(send_replies(replies), 0)
+
+        self.appointment.refresh_from_db()
+        self.assertFalse(self.appointment.whatsapp_sent)
+        self.assertIsNone(self.appointment.whatsapp_sent_at)
+        self.assertFalse(NotificationLedger.objects.filter(status='sent').exists())
+
+
+class CompletedNotificationTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='completed'
+        )
+
+    def test_completed_notification_tracked_and_sent_once(self):
+        with mock.patch('requests.Session.post', return_value=GraphResponse()) as post:
+            self.assertTrue(send_appointment_notification(self.appointment, 'completion'))
+            self.assertTrue(send_appointment_notification(self.appointment, 'completion'))
+
+        self.assertEqual(post.call_count, 1)
+        self.assertIn('Appointment Completed', post.call_args.kwargs['json']['text']['body'])
+        self.assertTrue(NotificationLedger.objects.filter(
+            appointment=self.appointment, channel='whatsapp', event='completed', status='sent'
+        ).exists())
+
+
+@override_settings(NOTIFICATION_DISPATCH='sync', BARBER_WHATSAPP='+15550009999')
+class SyncOutboxFromWebhookTests(BookingFixtureMixin, TransactionTestCase):
+    """Outbox rows delivered from the commit of a webhook's own transaction"""
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='pending'
+        )
+
+    def approve(self, response):
+        with mock.patch('requests.Session.post', return_value=response):
+            process_webhook_payload(text_delivery('15550009999', 'approve'))
+        return NotificationOutbox.objects.get(channel='whatsapp', template='confirmed')
+
+    def test_rejected_send_is_retried(self):
+        message = self.approve(GraphError())
+
+        self.assertEqual((message.status, message.attempts), ('pending', 1))
+        self.assertFalse(NotificationLedger.objects.filter(channel='whatsapp', status='sent').exists())
+
+    def test_accepted_send_is_settled(self):
+        message = self.approve(GraphResponse())
+
+        self.assertEqual((message.status, message.attempts), ('sent', 1))
+        self.assertTrue(NotificationLedger.objects.filter(
+            appointment=self.appointment, channel='whatsapp', event='confirmed', status='sent'
+        ).exists())
+
+
+class ReminderTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='confirmed'
+        )
+
+    def reminder_rows(self, **filters):
+        return sorted(NotificationOutbox.objects.filter(template='reminder', **filters)
+                      .values_list('channel', flat=True))
+
+    def test_rerun_does_not_queue_twice(self):
+        self.assertEqual(enqueue_reminders(self.date), 1)
+        self.assertEqual(enqueue_reminders(self.date), 0)
+        self.assertEqual(self.reminder_rows(), ['email', 'whatsapp'])
+
+    def test_failed_reminder_is_queued_again(self):
+        enqueue_reminders(self.date)
+        NotificationOutbox.objects.filter(channel='whatsapp').update(status='failed')
+
+        needing = list(appointments_needing_reminders(self.date))
+        self.assertEqual(needing, [self.appointment])
+        self.assertFalse(needing[0].reminded_whatsapp)
+        self.assertTrue(needing[0].reminded_email)
+
+        self.assertEqual(enqueue_reminders(self.date), 1)
+        self.assertEqual(self.reminder_rows(status='pending'), ['email', 'whatsapp'])
+
+    def test_ledger_entry_counts_as_reminded(self):
+        for channel in ('email', 'whatsapp'):
+            NotificationLedger.objects.create(appointment=self.appointment, channel=channel,
+                                              event='reminder', status='sent')
+        self.assertEqual(enqueue_reminders(self.date), 0)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', NOTIFICATION_MAX_ATTEMPTS=3, NOTIFICATION_RETRY_BASE_SECONDS=30)
+class OutboxDeliveryTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointment = Appointment.objects.create(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60, status='confirmed'
+        )
+
+    def outbox(self, **fields):
+        return NotificationOutbox.objects.create(appointment=self.appointment, channel='email', template='confirmed', **fields)
+
+    def deliver(self, message, result):
+        sender = mock.Mock(side_effect=result) if isinstance(result, Exception) else mock.Mock(return_value=result)
+        with mock.patch('booking.notifications.get_sender', return_value=sender):
+            return deliver_message(message)
+
+    def test_claimed_rows_are_not_claimed_again(self):
+        message = self.outbox()
+
+        self.assertEqual([m.pk for m in claim_messages(claimed_by='first')], [message.pk])
+        self.assertEqual(claim_messages(claimed_by='second'), [])
+
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.claimed_by), ('processing', 'first'))
+
+    def test_only_due_or_abandoned_rows_are_claimed(self):
+        now = timezone.now()
+        self.outbox(next_attempt_at=now + timedelta(minutes=5))
+        self.outbox(status='processing', claimed_by='busy', claimed_at=now)
+        abandoned = self.outbox(status='processing', claimed_by='crashed', claimed_at=now - CLAIM_TIMEOUT - timedelta(seconds=1))
+        self.outbox(status='sent')
+
+        self.assertEqual([m.pk for m in claim_messages(claimed_by='worker')], [abandoned.pk])
+
+    def test_claim_limited_to_given_ids(self):
+        first, second = self.outbox(), self.outbox()
+        self.assertEqual([m.pk for m in claim_messages(message_ids=[second.pk], claimed_by='worker')], [second.pk])
+        first.refresh_from_db()
+        self.assertEqual(first.status, 'pending')
+
+    def test_successful_delivery(self):
+        message, = claim_messages(message_ids=[self.outbox().pk], claimed_by='worker')
+        self.assertTrue(self.deliver(message, True))
+
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.claimed_by), ('sent', 1, ''))
+        self.appointment.refresh_from_db()
+        self.assertTrue(self.appointment.email_sent)
+
+    def test_failed_delivery_backs_off(self):
+        message, = claim_messages(message_ids=[self.outbox().pk], claimed_by='worker')
+        before = timezone.now()
+        self.assertFalse(self.deliver(message, RuntimeError('SMTP down')))
+
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.claimed_by), ('pending', 1, ''))
+        self.assertEqual(message.last_error, 'SMTP down')
+        self.assertGreaterEqual(message.next_attempt_at, before + timedelta(seconds=30))
+        self.assertEqual(claim_messages(claimed_by='worker'), [])
+
+        # The second failure waits twice as long
+        message.status, message.next_attempt_at = 'processing', timezone.now()
+        before = timezone.now()
+        self.deliver(message, False)
+        message.refresh_from_db()
+        self.assertEqual(message.attempts, 2)
+        self.assertGreaterEqual(message.next_attempt_at, before + timedelta(seconds=60))
+
+    def test_gives_up_after_max_attempts(self):
+        message = self.outbox(attempts=2)
+        message, = claim_messages(message_ids=[message.pk], claimed_by='worker')
+        self.assertFalse(self.deliver(message, False))
+
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('failed', 3))
+        self.assertEqual(claim_messages(claimed_by='worker'), [])
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class EmailBatchDeliveryTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.appointments = [
+            Appointment.objects.create(
+                service=self.service, name=f'Customer {index}', email=f'customer{index}@example.com',
+                phone='+15550001234', date=self.date, time=time(9 + index), duration=60, status='confirmed'
+            )
+            for index in range(3)
+        ]
+        enqueue_bulk_notifications(self.appointments, 'confirmed', channels=['email'])
+
+    def statuses(self):
+        return list(NotificationOutbox.objects.order_by('appointment__time').values_list('status', 'attempts'))
+
+    def test_rows_rendered_and_sent_over_one_connection(self):
+        with mock.patch('booking.mail.get_connection', wraps=mail.get_connection) as get_connection, \
+                mock.patch('booking.notification_templates.get_notification_template',
+                           wraps=get_notification_template) as get_template:
+            self.assertEqual(deliver_outbox_messages(), (3, 0))
+
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(get_template.call_count, 1)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['customer0@example.com', 'customer1@example.com', 'customer2@example.com'])
+        self.assertEqual(self.statuses(), [('sent', 1)] * 3)
+        self.assertEqual(NotificationLedger.objects.filter(channel='email', event='confirmed', status='sent').count(), 3)
+
+    def test_already_emailed_appointment_is_skipped(self):
+        record_sent(self.appointments[0], 'email', 'confirmed')
+
+        self.assertEqual(deliver_outbox_messages(), (3, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(self.statuses(), [('sent', 1)] * 3)
+
+    def test_failed_email_is_retried_alone(self):
+        with mock.patch('booking.mail.send_batch', return_value=[None, ConnectionError('dropped'), None]):
+            self.assertEqual(deliver_outbox_messages(), (2, 1))
+
+        self.assertEqual(self.statuses(), [('sent', 1), ('pending', 1), ('sent', 1)])
+        self.assertTrue(NotificationLedger.objects.filter(appointment=self.appointments[1], status='failed').exists())
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class ReminderRunTests(BookingFixtureMixin, TransactionTestCase):
+
+    def test_reminder_emails_sent_in_one_batch(self):
+        for index in range(3):
+            Appointment.objects.create(
+                service=self.service, name=f'Customer {index}', email=f'customer{index}@example.com',
+                phone=f'+1555000{index:04d}', date=self.date, time=time(9 + index), duration=60, status='confirmed'
+            )
+
+        with mock.patch('requests.Session.post', return_value=GraphResponse()), \
+                mock.patch('booking.mail.get_connection', wraps=mail.get_connection) as get_connection:
+            result = send_reminders(self.date, workers=2, rate=0)
+
+        self.assertEqual(result, {'enqueued': 3, 'sent': 6, 'failed': 0})
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker')
+class AppointmentAdminActionTests(BookingFixtureMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.model_admin = AppointmentAdmin(Appointment, admin.site)
+        self.request = RequestFactory().post('/admin/booking/appointment/')
+        self.appointments = [
+            Appointment.objects.create(
+                service=self.service, name=f'Customer {hour}', email=f'customer{hour}@example.com',
+                phone=f'+155500012{hour:02d}', date=self.date, time=time(hour), duration=60, status='pending'
+            )
+            for hour in (9, 10, 11)
+        ]
+
+    def run_action(self, action, queryset):
+        with mock.patch.object(self.model_admin, 'message_user'), \
+                CaptureQueriesContext(connection) as queries:
+            getattr(self.model_admin, action)(self.request, queryset)
+        return [query['sql'] for query in queries.captured_queries]
+
+    def writes(self, statements, prefix):
+        return [sql for sql in statements if sql.startswith(prefix)]
+
+    def test_confirm_uses_one_update_and_one_outbox_insert(self):
+        already = self.appointments[0]
+        Appointment.objects.filter(pk=already.pk).update(status='confirmed')
+
+        statements = self.run_action('confirm_appointments', Appointment.objects.all())
+
+        self.assertEqual(len(self.writes(statements, 'UPDATE "booking_appointment"')), 1)
+        self.assertEqual(len(self.writes(statements, 'INSERT INTO "booking_notificationoutbox"')), 1)
+        self.assertFalse(Appointment.objects.exclude(status='confirmed').exists())
+        changed = self.appointments[1:]
+        self.assertTrue(all(Appointment.objects.get(pk=appointment.pk).confirmed_at for appointment in changed))
+        self.assertEqual(
+            sorted(NotificationOutbox.objects.values_list('appointment_id', 'channel', 'template')),
+            sorted((appointment.pk, channel, 'confirmed') for appointment in changed for channel in ('email', 'whatsapp'))
+        )
+
+    def test_mark_completed_queues_completed_notifications(self):
+        self.run_action('mark_completed', Appointment.objects.filter(pk=self.appointments[0].pk))
+
+        self.appointments[0].refresh_from_db()
+        self.assertEqual(self.appointments[0].status, 'completed')
+        self.assertIsNotNone(self.appointments[0].completed_at)
+        self.assertEqual(set(NotificationOutbox.objects.values_list('template', flat=True)), {'completed'})
+        self.assertEqual(NotificationOutbox.objects.count(), 2)
+
+    def test_whatsapp_reminders_skip_already_notified(self):
+        reminded = self.appointments[0]
+        record_sent(reminded, 'whatsapp', 'reminder', 'wamid.earlier')
+
+        statements = self.run_action('send_whatsapp_reminders', Appointment.objects.all())
+
+        self.assertEqual(len(self.writes(statements, 'INSERT INTO "booking_notificationoutbox"')), 1)
+        self.assertEqual(
+            sorted(NotificationOutbox.objects.values_list('appointment_id', 'channel', 'template')),
+            [(appointment.pk, 'whatsapp', 'reminder') for appointment in self.appointments[1:]]
+        )
+
+
+class FakeSMTP:
+    """Stands in for smtplib.SMTP, recording what is sent over each connection"""
+
+    opened = []
+
+    def __init__(self, host, port, **kwargs):
+        self.sock = object()
+        self.sent = []
+        self.closed = False
+        FakeSMTP.opened.append(self)
+
+    def sendmail(self, from_email, recipients, message):
+        if self.sock is None:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append(recipients)
+
+    def drop(self):
+        """Simulate the server closing the connection"""
+        self.sock = None
+
+    def quit(self):
+        self.closed = True
+
+    close = quit
+
+
+class PooledEmailBackendTests(SimpleTestCase):
+
+    def setUp(self):
+        FakeSMTP.opened = []
+        self.clock = mock.Mock()
+        self.clock.monotonic.return_value = 1000.0
+        self.pool = SMTPConnectionPool()
+        for patcher in (mock.patch('smtplib.SMTP', FakeSMTP), mock.patch('booking.mail._pool', self.pool),
+                        mock.patch('booking.mail.time', self.clock)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, count=1, **options):
+        backend = PooledEmailBackend(host='smtp.example.com', port=25, username='', password='',
+                                     use_tls=False, use_ssl=False, **options)
+        messages = [EmailMessage('Hi', 'Body', 'shop@example.com', [f'customer{index}@example.com'])
+                    for index in range(count)]
+        return backend.send_messages(messages)
+
+    def test_connection_reused_between_sends(self):
+        self.assertEqual(self.send(), 1)
+        self.assertEqual(self.send(), 1)
+
+        self.assertEqual(len(FakeSMTP.opened), 1)
+        self.assertEqual(self.pool.opened, 1)
+        self.assertEqual(len(FakeSMTP.opened[0].sent), 2)
+        self.assertFalse(FakeSMTP.opened[0].closed)
+
+    def test_reconnects_after_dropped_connection(self):
+        self.send()
+        FakeSMTP.opened[0].drop()
+
+        self.assertEqual(self.send(), 1)
+        first, second = FakeSMTP.opened
+        self.assertTrue(first.closed)
+        self.assertEqual(second.sent, [['customer0@example.com']])
+
+        # The replacement connection is the one returned to the pool
+        self.send()
+        self.assertEqual(len(FakeSMTP.opened), 2)
+        self.assertEqual(len(second.sent), 2)
+
+    def test_idle_connection_retired(self):
+        self.send(idle_timeout=60)
+        self.clock.monotonic.return_value += 61
+
+        self.send(idle_timeout=60)
+        first, second = FakeSMTP.opened
+        self.assertTrue(first.closed)
+        self.assertEqual(len(second.sent), 1)
+
+    def test_connection_retired_after_max_messages(self):
+        self.assertEqual(self.send(count=3, max_messages=2), 3)
+
+        first, second = FakeSMTP.opened
+        self.assertEqual(len(first.sent), 2)
+        self.assertTrue(first.closed)
+        self.assertEqual(len(second.sent), 1)
+        self.assertFalse(second.closed)
+
+
+@override_settings(WHATSAPP_WEBHOOK_MAX_ATTEMPTS=2, NOTIFICATION_RETRY_BASE_SECONDS=30)
+class InboundEventRetryTests(TransactionTestCase):
+
+    def setUp(self):
+        get_recent_ids().clear()
+
+    def test_concurrent_workers_never_share_a_sender(self):
+        for index in range(20):
+            InboundEvent.objects.create(body='{}', sender=f'1555000{index % 4}')
+        claims, gate = [], threading.Barrier(4)
+
+        def claim(worker):
+            try:
+                gate.wait()
+                claims.extend((worker, event.sender) for event in claim_events(claimed_by=worker))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(f'worker-{index}',)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        senders = [sender for _, sender in claims]
+        self.assertEqual(sorted(senders), sorted(set(senders)))
+        self.assertEqual(len(senders), 4)
+
+    def make_due(self):
+        InboundEvent.objects.update(next_attempt_at=timezone.now())
+
+    def test_failed_event_backs_off_then_parks(self):
+        event = InboundEvent.objects.create(body='not json', sender='15550001234')
+
+        self.assertEqual(process_inbound_events(), (0, 1))
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+        self.assertGreater(event.next_attempt_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(claim_events(), [])
+
+        self.make_due()
+        self.assertEqual(process_inbound_events(), (0, 1))
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('failed', 2))
+        self.assertTrue(event.last_error)
+
+        self.make_due()
+        self.assertEqual(claim_events(), [])
+
+    def test_retry_failed_queues_parked_events(self):
+        InboundEvent.objects.create(body='not json', sender='15550001234', status='failed', attempts=2)
+        InboundEvent.objects.create(body='{}', sender='15550005678', status='done', attempts=1)
+
+        self.assertEqual(retry_failed_events(), 1)
+        self.assertEqual(InboundEvent.objects.get(sender='15550001234').attempts, 0)
+
+        call_command('process_inbound_events', '--retry-failed', '--once', stdout=StringIO())
+        self.assertEqual(InboundEvent.objects.get(sender='15550001234').status, 'pending')
+
+
+class InboundEventClaimTests(TestCase):
+
+    def event(self, sender, **fields):
+        return InboundEvent.objects.create(body='{}', sender=sender, **fields)
+
+    def test_one_event_per_sender_in_arrival_order(self):
+        first, second = self.event('111'), self.event('111')
+        other = self.event('222')
+        status_only = [self.event(''), self.event('')]
+
+        claimed = claim_events(claimed_by='worker-a')
+        self.assertEqual(claimed, [first, other, *status_only])
+
+        # Another worker finds the sender held by worker-a
+        self.assertEqual(claim_events(claimed_by='worker-b'), [])
+
+        InboundEvent.objects.filter(pk=first.pk).update(status='done', claimed_by='')
+        self.assertEqual(claim_events(claimed_by='worker-b'), [second])
+
+    def test_event_waiting_for_retry_holds_back_its_sender(self):
+        self.event('111', attempts=1, next_attempt_at=timezone.now() + timedelta(minutes=5))
+        later = self.event('111')
+        other = self.event('222')
+
+        self.assertEqual(claim_events(), [other])
+        self.assertEqual(later.status, 'pending')
+
+    def test_requeued_event_waits_for_sender_in_progress(self):
+        parked = self.event('111', status='failed', attempts=5)
+        busy = self.event('111', status='processing', claimed_by='worker-a', claimed_at=timezone.now())
+
+        retry_failed_events()
+        self.assertEqual(claim_events(claimed_by='worker-b'), [])
+
+        InboundEvent.objects.filter(pk=busy.pk).update(status='done', claimed_by='', claimed_at=None)
+        self.assertEqual(claim_events(claimed_by='worker-b'), [parked])
+
+    def test_abandoned_claim_is_taken_over(self):
+        stale = self.event('111', status='processing', claimed_by='crashed',
+                           claimed_at=timezone.now() - timedelta(hours=1))
+        self.event('111')
+
+        self.assertEqual(claim_events(claimed_by='worker-b'), [stale])
+
+
+class CommandRouterTests(SimpleTestCase):
+
+    def command(self, text):
+        command = COMMAND_ROUTER.match(text)
+        return command.name if command else None
+
+    def test_matches_whole_words_only(self):
+        self.assertEqual(self.command('list'), 'pending')
+        self.assertIsNone(self.command('unlisted'))
+        self.assertIsNone(self.command('helpful'))
+        self.assertIsNone(self.command('statuses'))
+        self.assertEqual(self.command('Can I get some HELP?'), 'help')
+
+    def test_spanish_aliases(self):
+        self.assertEqual(self.command('quiero cancelar mi cita'), 'cancel')
+        self.assertEqual(self.command('aprobar'), 'approve')
+        self.assertEqual(self.command('pendientes'), 'pending')
+
+    def test_first_declared_command_wins(self):
+        self.assertEqual(self.command('confirm or cancel'), 'cancel')
+        self.assertEqual(self.command('status help'), 'status')
+
+    def test_no_command(self):
+        self.assertIsNone(self.command('hello there'))
+
+    @override_settings(BARBER_WHATSAPP='+1 (555) 000-9999')
+    def test_role_compares_digits(self):
+        self.assertEqual(role_for('15550009999'), BARBER)
+        self.assertEqual(role_for('+1 555 000 9999'), BARBER)
+        self.assertEqual(role_for('15550001234'), CUSTOMER)
+
+
+@override_settings(NOTIFICATION_DISPATCH='worker', BARBER_WHATSAPP='+15550009999')
+class CommandRoutingTests(TestCase):
+
+    def setUp(self):
+        get_recent_ids().clear()
+
+    def replies_to(self, sender, text):
+        with mock.patch('requests.Session.post', return_value=GraphResponse()) as post, \
+                self.captureOnCommitCallbacks(execute=True):
+            process_webhook_payload(text_delivery(sender, text))
+        return [call.kwargs['json']['text']['body'] for call in post.call_args_list]
+
+    def test_customer_cannot_use_barber_commands(self):
+        self.assertEqual(self.replies_to('15550001234', 'approve'),
+                         ['You are not authorized to approve appointments.'])
+
+    def test_unmatched_text_gets_default_response(self):
+        replies = self.replies_to('15550001234', 'unlisted')
+        self.assertEqual(len(replies), 1)
+        self.assertIn("Type 'help'", replies[0])
+
+    def test_role_resolved_once_per_message(self):
+        with mock.patch('booking.webhook_views.role_for', wraps=role_for) as resolve:
+            replies = self.replies_to('15550009999', 'pending')
+        self.assertEqual(resolve.call_count, 1)
+        self.assertEqual(replies, ['No pending appointments at the moment.'])
+
+
+class ConcurrentReservationTests(BookingFixtureMixin, TransactionTestCase):
+    """Parallel bookings for one slot: only as many succeed as there are free chairs"""
+
+    attempts = 16
+
+    def reserve_concurrently(self, slot_time):
+        results, errors = [], []
+        gate = threading.Barrier(self.attempts)
+
+        def attempt(index):
+            try:
+                gate.wait()
+                results.append(reserve_appointment(
+                    self.service, self.date, slot_time,
+                    name=f'Customer {index}', email=f'customer{index}@example.com',
+                    phone='+15550000000', status='pending'
+                ))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(index,)) for index in range(self.attempts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        return [appointment for appointment in results if appointment]
+
+    def test_single_chair_admits_one_booking(self):
+        winners = self.reserve_concurrently(time(9))
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_each_barber_booked_once(self):
+        barbers = [Barber.objects.create(name=name) for name in ('Sam', 'Jo', 'Lee')]
+        invalidate_schedule()
+
+        winners = self.reserve_concurrently(time(9))
+        self.assertEqual(len(winners), len(barbers))
+        self.assertEqual(sorted(winner.barber_id for winner in winners), [barber.pk for barber in barbers])
+
+    def test_overlapping_slot_counts_against_capacity(self):
+        reserve_appointment(self.service, self.date, time(9), name='Early', email='early@example.com',
+                            phone='+15550000000', status='confirmed')
+
+        self.assertEqual(self.reserve_concurrently(time(9, 30)), [])
+        self.assertEqual(len(self.reserve_concurrently(time(10))), 1)
+
+
+@override_settings(RATE_LIMIT_ENABLED=False, NOTIFICATION_DISPATCH='worker')
+class ConcurrentBookingLoadTests(BookingFixtureMixin, TransactionTestCase):
+    """
+    Hundreds of simultaneous POST /book/ requests for one slot.
+
+    On SQLite this exercises the process-wide write lock, on PostgreSQL the
+    per-date advisory lock.
+    """
+
+    requests = 200
+
+    def test_exactly_one_booking_wins(self):
+        responses, errors = [], []
+        gate = threading.Barrier(self.requests)
+
+        def attempt(index):
+            try:
+                client = Client()
+                gate.wait()
+                responses.append(self.book(client, name=f'Customer {index}', email=f'customer{index}@example.com'))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(index,)) for index in range(self.requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        statuses = [response.status_code for response in responses]
+        self.assertEqual(statuses.count(200), 1)
+        self.assertEqual(statuses.count(400), self.requests - 1)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'advisory locks are PostgreSQL-only')
+class AdvisoryLockTests(BookingFixtureMixin, TransactionTestCase):
+
+    def lock_available(self, date):
+        """Whether another connection could take the booking lock for a date right now"""
+        available = []
+
+        def probe():
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [ADVISORY_LOCK_NAMESPACE, date.toordinal()])
+                    taken = cursor.fetchone()[0]
+                    if taken:
+                        cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [ADVISORY_LOCK_NAMESPACE, date.toordinal()])
+                    available.append(taken)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        return available[0]
+
+    def test_lock_held_for_date_until_commit(self):
+        with locked_booking_transaction(self.date):
+            self.assertFalse(self.lock_available(self.date))
+            self.assertTrue(self.lock_available(self.date + timedelta(days=1)))
+        self.assertTrue(self.lock_available(self.date))
+
+    def test_concurrent_reservations_admit_one(self):
+        winners = []
+        gate = threading.Barrier(50)
+
+        def attempt(index):
+            try:
+                gate.wait()
+                winners.append(reserve_appointment(
+                    self.service, self.date, time(9), name=f'Customer {index}',
+                    email=f'customer{index}@example.com', phone='+15550000000', status='pending'
+                ))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(index,)) for index in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len([winner for winner in winners if winner]), 1)
+
+
+class SlotComputationTests(SimpleTestCase):
+
+    def test_full_intervals_by_capacity(self):
+        intervals = [(540, 600), (570, 630)]
+        self.assertEqual(full_intervals(intervals), [(540, 630)])
+        self.assertEqual(full_intervals(intervals, capacity=2), [(570, 600)])
+        self.assertEqual(full_intervals(intervals, capacity=3), [])
+
+    def test_back_to_back_intervals_do_not_overlap(self):
+        self.assertEqual(full_intervals([(540, 600), (600, 660)], capacity=2), [])
+        self.assertEqual(full_intervals([(540, 600), (600, 660)]), [(540, 600), (600, 660)])
+
+    def test_free_slots_skip_busy_intervals(self):
+        self.assertEqual(compute_free_slots(time(9), time(11), []), ['09:00', '09:30', '10:00', '10:30'])
+        self.assertEqual(
+            compute_free_slots(time(9), time(11), [(570, 600)], slot_length=60),
+            ['10:00', '10:30']
+        )
+
+    def test_closed_day_has_no_slots(self):
+        self.assertEqual(compute_free_slots(None, None, []), [])
+
+
+class AvailableTimesTests(BookingFixtureMixin, TestCase):
+
+    def available_times(self):
+        response = self.client.get('/api/available-times/', {'date': self.date.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['available_times']
+
+    def book_nine(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Appointment.objects.create(
+                service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+                date=self.date, time=time(9), duration=60, status='pending'
+            )
+
+    def test_booked_slot_is_not_offered(self):
+        self.assertIn('09:00', self.available_times())
+        self.book_nine()
+
+        times = self.available_times()
+        self.assertNotIn('09:00', times)
+        self.assertNotIn('09:30', times)
+        self.assertIn('10:00', times)
+
+    def test_slot_offered_while_a_barber_is_free(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Barber.objects.create(name='Sam')
+            Barber.objects.create(name='Kai')
+        self.book_nine()
+        self.assertIn('09:00', self.available_times())
+
+    def test_date_is_required(self):
+        self.assertEqual(self.client.get('/api/available-times/').status_code, 400)
+        self.assertEqual(self.client.get('/api/available-times/', {'date': 'tomorrow'}).status_code, 400)
+
+
+class AvailableCalendarTests(BookingFixtureMixin, TestCase):
+
+    def calendar(self, start, end, **params):
+        return self.client.get('/api/available-calendar/', {'start': start.isoformat(), 'end': end.isoformat(), **params})
+
+    def test_one_entry_per_day(self):
+        response = self.calendar(self.date, self.date + timedelta(days=2), service=self.service.id)
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['start'], self.date.isoformat())
+        self.assertEqual(body['end'], (self.date + timedelta(days=2)).isoformat())
+        self.assertEqual([day['date'] for day in body['days']],
+                         [(self.date + timedelta(days=offset)).isoformat() for offset in range(3)])
+
+        day = body['days'][0]
+        self.assertEqual(set(day), {'date', 'status', 'available_count', 'available_times'})
+        self.assertEqual(day['status'], 'open')
+        # Start times every 30 minutes while the shop is open
+        self.assertEqual(day['available_times'][0], '09:00')
+        self.assertEqual(day['available_times'][-1], '16:30')
+        self.assertEqual(day['available_count'], len(day['available_times']))
+
+    def test_summary_omits_times(self):
+        day = self.calendar(self.date, self.date, summary='1').json()['days'][0]
+        self.assertNotIn('available_times', day)
+        self.assertEqual(day['available_count'], 16)
+
+    def test_full_and_holiday_days(self):
+        holiday = self.date + timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Holiday.objects.create(date=holiday, description='Closed for training')
+            for hour in range(9, 17):
+                Appointment.objects.create(
+                    service=self.service, name=f'Customer {hour}', email=f'customer{hour}@example.com',
+                    phone='+15550001234', date=self.date, time=time(hour), duration=60, status='confirmed'
+                )
+
+        full, closed = self.calendar(self.date, holiday).json()['days']
+
+        self.assertEqual((full['status'], full['available_count'], full['available_times']), ('full', 0, []))
+        self.assertEqual((closed['status'], closed['available_count'], closed['available_times']), ('holiday', 0, []))
+
+    def test_range_limits(self):
+        self.assertEqual(self.calendar(self.date, self.date - timedelta(days=1)).status_code, 400)
+        self.assertEqual(self.calendar(self.date, self.date + timedelta(days=BOOKING_HORIZON_DAYS)).status_code, 200)
+        response = self.calendar(self.date, self.date + timedelta(days=BOOKING_HORIZON_DAYS + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(BOOKING_HORIZON_DAYS), response.json()['error'])
+
+    def test_dates_are_required(self):
+        self.assertEqual(self.client.get('/api/available-calendar/', {'start': self.date.isoformat()}).status_code, 400)
+        self.assertEqual(self.client.get('/api/available-calendar/', {'start': 'today', 'end': 'later'}).status_code, 400)
+
+
+class MultiBarberAvailabilityTests(BookingFixtureMixin, TestCase):
+    """Two barbers, one busy 09:00-09:30 and the other 09:30-10:00"""
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Barber.objects.create(name='Sam')
+            second = Barber.objects.create(name='Kai')
+            for barber, start in ((first, time(9)), (second, time(9, 30))):
+                Appointment.objects.create(
+                    service=self.service, barber=barber, name='Alex Smith', email='alex@example.com',
+                    phone='+15550001234', date=self.date, time=start, duration=30, status='confirmed'
+                )
+
+    def bookable_slots(self):
+        """Every listed start time the booking check would accept for the one-hour service"""
+        schedule = get_schedule()
+        appointments = load_day_appointments(self.date)
+        return [
+            f'{hour:02d}:{minute:02d}'
+            for hour in range(9, 17) for minute in (0, 30)
+            if find_slot_barber(appointments, time(hour, minute), 60, schedule.capacity, schedule.barber_ids)[0]
+        ]
+
+    def test_listing_matches_booking_check(self):
+        slots = get_available_slots(self.date, 60)
+
+        self.assertNotIn('09:00', slots)
+        self.assertIn('09:30', slots)
+        self.assertEqual(slots, self.bookable_slots())
+
+    def test_calendar_matches_booking_check(self):
+        response = self.client.get('/api/available-calendar/', {
+            'start': self.date.isoformat(), 'end': self.date.isoformat(), 'service': self.service.id
+        })
+        self.assertEqual(response.json()['days'][0]['available_times'], self.bookable_slots())
+
+    def test_unlisted_slot_is_rejected_and_listed_slot_booked(self):
+        fields = {'name': 'Jo Doe', 'email': 'jo@example.com', 'phone': '+15550005678'}
+        self.assertIsNone(reserve_appointment(self.service, self.date, time(9), **fields))
+        self.assertIsNotNone(reserve_appointment(self.service, self.date, time(9, 30), **fields))
+
+    def test_rejected_booking_suggests_bookable_slots(self):
+        response = self.book(time='09:00')
+
+        self.assertEqual(response.status_code, 400)
+        suggestions = response.json()['next_available']
+        self.assertEqual(suggestions[0], {'date': self.date.isoformat(), 'time': '09:30'})
+        self.assertEqual([slot['time'] for slot in suggestions], self.bookable_slots()[:3])
+
+
+class FindSlotBarberTests(SimpleTestCase):
+
+    def test_no_barbers_is_a_single_chair(self):
+        self.assertEqual(find_slot_barber([], time(9), 60), (True, None))
+        self.assertEqual(find_slot_barber([(time(9, 30), 30, None)], time(9), 60), (False, None))
+        self.assertEqual(find_slot_barber([(time(10), 30, None)], time(9), 60), (True, None))
+
+    def test_assigns_first_free_barber(self):
+        appointments = [(time(9), 60, 1)]
+        self.assertEqual(find_slot_barber(appointments, time(9), 60, capacity=2, barber_ids=(1, 2)), (True, 2))
+        self.assertEqual(find_slot_barber(appointments, time(10), 60, capacity=2, barber_ids=(1, 2)), (True, 1))
+
+    def test_every_barber_taken(self):
+        appointments = [(time(9), 60, 1), (time(9), 60, 2)]
+        self.assertEqual(find_slot_barber(appointments, time(9), 30, capacity=2, barber_ids=(1, 2)), (False, None))
+
+    def test_barbers_busy_at_different_times_leave_no_barber_free(self):
+        # Never both busy at once, but neither is free for the whole hour
+        appointments = [(time(9), 30, 1), (time(9, 30), 30, 2)]
+        self.assertEqual(find_slot_barber(appointments, time(9), 60, capacity=2, barber_ids=(1, 2)), (False, None))
+
+    def test_unassigned_bookings_count_against_capacity(self):
+        appointments = [(time(9), 60, None)]
+        self.assertEqual(find_slot_barber(appointments, time(9), 60, capacity=2, barber_ids=(1, 2)), (True, 1))
+        appointments.append((time(9), 60, 1))
+        self.assertEqual(find_slot_barber(appointments, time(9), 60, capacity=2, barber_ids=(1, 2)), (False, None))
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_burst_across_window_boundary(self):
+        allowed = [check_rate('test', 'client', 5, 60, now=59.9)[0] for _ in range(5)]
+        allowed += [check_rate('test', 'client', 5, 60, now=60.1)[0] for _ in range(5)]
+        self.assertEqual(allowed.count(True), 5)
+
+    def test_bucket_drains_evenly(self):
+        for _ in range(5):
+            check_rate('test', 'client', 5, 60, now=1000)
+        self.assertEqual(check_rate('test', 'client', 5, 60, now=1011), (False, 1))
+        self.assertEqual(check_rate('test', 'client', 5, 60, now=1012), (True, 0))
+        self.assertFalse(check_rate('test', 'client', 5, 60, now=1012)[0])
+
+    def test_rejected_requests_do_not_fill_bucket(self):
+        for _ in range(20):
+            check_rate('test', 'client', 5, 60, now=1000)
+        self.assertTrue(check_rate('test', 'client', 5, 60, now=1012)[0])
+
+    def test_clients_have_separate_buckets(self):
+        check_rate('test', 'first', 1, 60, now=1000)
+        self.assertFalse(check_rate('test', 'first', 1, 60, now=1000)[0])
+        self.assertTrue(check_rate('test', 'second', 1, 60, now=1000)[0])
+
+    def test_concurrent_requests_do_not_overdraw_bucket(self):
+        get = LocMemCache.get
+        barrier = threading.Barrier(20)
+        allowed = []
+
+        def slow_get(cache_backend, *args, **kwargs):
+            # Widen the gap between reading and writing the bucket
+            value = get(cache_backend, *args, **kwargs)
+            time_module.sleep(0.001)
+            return value
+
+        def request():
+            barrier.wait()
+            allowed.append(check_rate('test', 'client', 5, 60, now=1000)[0])
+
+        with mock.patch.object(LocMemCache, 'get', slow_get):
+            threads = [threading.Thread(target=request) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(allowed.count(True), 5)
+
+    async def test_concurrent_async_requests_do_not_overdraw_bucket(self):
+        results = await asyncio.gather(*[acheck_rate('test', 'client', 5, 60, now=1000) for _ in range(20)])
+        self.assertEqual([allowed for allowed, _ in results].count(True), 5)
+
+    def test_non_atomic_cache_is_reported(self):
+        self.assertEqual(check_rate_limit_cache(None), [])
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                                                   'LOCATION': 'cache'}}):
+            self.assertEqual([warning.id for warning in check_rate_limit_cache(None)], ['booking.W002'])
+
+
+@override_settings(
+    RATE_LIMITS={'webhook': '1/m'}, WHATSAPP_APP_SECRET='app-secret', WHATSAPP_WEBHOOK_PROCESSING='inline'
+)
+class WebhookRateLimitTests(TestCase):
+    body = json.dumps({'object': 'whatsapp_business_account', 'entry': []})
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, signature=None):
+        headers = {'X-Hub-Signature-256': signature} if signature else {}
+        return Client().post('/whatsapp-webhook/', self.body, content_type='application/json', headers=headers)
+
+    def signature(self, secret='app-secret'):
+        return 'sha256=' + hmac.new(secret.encode(), self.body.encode(), hashlib.sha256).hexdigest()
+
+    def test_unsigned_deliveries_are_limited(self):
+        self.assertEqual(self.post().status_code, 200)
+        self.assertEqual(self.post().status_code, 429)
+
+    def test_signed_deliveries_are_not_limited(self):
+        for _ in range(3):
+            self.assertEqual(self.post(self.signature()).status_code, 200)
+
+    def test_bad_signature_is_limited(self):
+        self.assertEqual(self.post(self.signature('wrong-secret')).status_code, 200)
+        self.assertEqual(self.post(self.signature('wrong-secret')).status_code, 429)
+
+    @override_settings(WHATSAPP_APP_SECRET='')
+    def test_signature_ignored_without_app_secret(self):
+        self.assertEqual(self.post(self.signature()).status_code, 200)
+        self.assertEqual(self.post(self.signature()).status_code, 429)
+
+
+class GraphClientPoolTests(SimpleTestCase):
+    """The shared Graph API client against a local keep-alive endpoint"""
+
+    pool_size = 4
+
+    def setUp(self):
+        self.api = FakeGraphAPI(blocked_numbers={'15550000000'}).start()
+        self.addCleanup(self.api.stop)
+        with self.settings(WHATSAPP_API_BASE_URL=self.api.url):
+            self.client = WhatsAppClient(token='test-token', phone_number_id='123', pool_size=self.pool_size,
+                                         connect_timeout=3.05, timeout=10)
+        self.addCleanup(self.client.close)
+
+    def test_pool_configuration(self):
+        adapter = self.client.session.get_adapter(self.client.url)
+        self.assertEqual(adapter._pool_maxsize, self.pool_size)
+        self.assertEqual(adapter.max_retries.total, 0)
+        self.assertEqual(self.client.session.headers['Authorization'], 'Bearer test-token')
+
+    def test_sequential_sends_reuse_one_connection(self):
+        results = [self.client.send_text('15550001234', f'Message {index}') for index in range(5)]
+
+        self.assertTrue(all(result.ok and result.message_id for result in results))
+        self.assertEqual(self.api.requests, 5)
+        self.assertEqual(self.api.connections, 1)
+
+    def test_concurrent_sends_stay_within_pool(self):
+        def send_batch(index):
+            for _ in range(5):
+                self.client.send_text('15550001234', f'From thread {index}')
+
+        threads = [threading.Thread(target=send_batch, args=(index,)) for index in range(self.pool_size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.api.requests, 5 * self.pool_size)
+        self.assertLessEqual(self.api.connections, self.pool_size)
+
+    def test_deadline_caps_read_timeout(self):
+        with mock.patch.object(self.client.session, 'post', wraps=self.client.session.post) as post:
+            self.client.send_text('15550001234', 'Default')
+            self.client.send_text('15550001234', 'Short', deadline=1.5)
+            self.client.send_text('15550001234', 'Tiny', deadline=0.01)
+            self.client.send_text('15550001234', 'Long', deadline=60)
+
+        self.assertEqual([call.kwargs['timeout'] for call in post.call_args_list],
+                         [(3.05, 10), (1.5, 1.5), (0.1, 0.1), (3.05, 10)])
+
+    def test_deadline_exceeded_raises_and_is_counted(self):
+        with mock.patch.object(self.client.session, 'post', side_effect=requests.ReadTimeout('timed out')), \
+                self.assertRaises(requests.Timeout):
+            self.client.send_text('15550001234', 'Slow', deadline=0.1)
+
+        snapshot = self.client.metrics.snapshot()
+        self.assertEqual((snapshot['requests'], snapshot['errors']), (1, 1))
+        self.assertEqual(snapshot['statuses'], {'ReadTimeout': 1})
+
+    def test_metrics_record_status_and_latency(self):
+        self.client.send_text('15550001234', 'Hello')
+        rejected = self.client.send_text('15550000000', 'Hello')
+
+        self.assertFalse(rejected.ok)
+        self.assertEqual(rejected.error_code, 131030)
+        snapshot = self.client.metrics.snapshot()
+        self.assertEqual(snapshot['requests'], 2)
+        self.assertEqual(snapshot['errors'], 1)
+        self.assertEqual(snapshot['statuses'], {200: 1, 400: 1})
+        self.assertGreater(snapshot['p50_ms'], 0)
+        self.assertGreaterEqual(snapshot['p95_ms'], snapshot['p50_ms'])
+
+
+class WhatsAppLoggingTests(SimpleTestCase):
+
+    def test_rejected_recipient_is_masked(self):
+        with mock.patch('requests.Session.post', return_value=GraphError()), \
+                self.assertLogs('booking.webhook_views', 'INFO') as logs:
+            self.assertFalse(send_whatsapp_message('+15550001234', 'Hello'))
+
+        output = '\n'.join(logs.output)
+        self.assertIn('not in allowed list', output)
+        self.assertIn('1234', output)
+        self.assertNotIn('15550001234', output)
+
+
+class FakeClock:
+    """monotonic() that only moves when sleep() is called"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class WhatsAppThrottlingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('booking.whatsapp.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = AdaptiveRateLimiter(rate=20, min_rate=1, max_rate=80, increase=5, decrease=0.5, backoff=0.25)
+
+    def result(self, error_code=None):
+        ok = error_code is None
+        return GraphResult(ok=ok, status_code=200 if ok else 400, data={}, error_code=error_code,
+                           error_message='' if ok else 'Rate limit hit', message_id='wamid.test' if ok else None,
+                           elapsed=0.0, retry_after=None)
+
+    def test_throughput_and_pair_limits_are_throttles(self):
+        self.assertTrue(is_throttled(400, 130429))
+        self.assertTrue(is_throttled(400, 131056))
+        self.assertFalse(is_throttled(400, 131030))
+
+    def test_throttle_halves_rate_and_doubles_backoff(self):
+        self.assertEqual(self.limiter.throttled(), 0.25)
+        self.assertEqual(self.limiter.rate, 10)
+
+        # A second throttle from a request already in flight during the pause counts once
+        self.limiter.throttled()
+        self.assertEqual(self.limiter.rate, 10)
+
+        self.clock.sleep(1)
+        self.assertEqual(self.limiter.throttled(), 0.5)
+        self.assertEqual(self.limiter.rate, 5)
+        self.assertEqual(self.limiter.reserve(), 0.5)
+
+    def test_recovers_slowly_after_throttle(self):
+        self.limiter.throttled()
+        for _ in range(10):
+            self.limiter.succeeded()
+
+        # About `increase` msg/s per second of sending at the current rate, not doubling
+        self.assertGreater(self.limiter.rate, 14)
+        self.assertLess(self.limiter.rate, 15)
+
+    def test_defer_retries_within_max_wait(self):
+        scheduler = WhatsAppScheduler(limiter=self.limiter, max_wait=5)
+        started = self.clock.monotonic()
+
+        self.assertTrue(scheduler.defer(1, started, 400, 131056))
+        self.assertEqual((scheduler.retries, scheduler.given_up), (1, 0))
+        self.assertEqual(self.limiter.rate, 10)
+
+        self.clock.sleep(3)
+        self.assertFalse(scheduler.defer(2, started, 400, 130429, retry_after=2.5))
+        self.assertEqual((scheduler.retries, scheduler.given_up), (1, 1))
+
+    def test_throttled_send_waits_out_backoff_and_retries(self):
+        scheduler = WhatsAppScheduler(limiter=self.limiter, max_wait=5)
+        client = mock.Mock()
+        client.send.side_effect = [self.result(130429), self.result()]
+
+        with mock.patch('booking.whatsapp.get_whatsapp_client', return_value=client):
+            result = scheduler.send({'to': '15550001234'})
+
+        self.assertTrue(result.ok)
+        self.assertEqual(client.send.call_count, 2)
+        self.assertEqual(self.clock.now, 1000.25)
+        self.assertEqual(scheduler.snapshot()['retries'], 1)
+        self.assertEqual(scheduler.snapshot()['queue_depth'], 0)
+
+
+class StructuredLoggingTests(SimpleTestCase):
+
+    def test_redact_masks_secrets_and_phone_numbers(self):
+        payload = {
+            'Authorization': 'Bearer secret-token',
+            'hub.verify_token': 'verify-me',
+            'entry': [{'changes': [{'value': {
+                'metadata': {'display_phone_number': '15550009999'},
+                'messages': [{'from': '15550001234', 'id': 'wamid.1', 'text': {'body': 'status'}}],
+                'statuses': [{'recipient_id': 15550005678, 'status': 'delivered'}],
+            }}]}],
+        }
+
+        redacted = redact(payload)
+
+        self.assertEqual(redacted['Authorization'], '[redacted]')
+        self.assertEqual(redacted['hub.verify_token'], '[redacted]')
+        value = redacted['entry'][0]['changes'][0]['value']
+        self.assertEqual(value['metadata']['display_phone_number'], '*******9999')
+        self.assertEqual(value['messages'][0], {'from': '*******1234', 'id': 'wamid.1', 'text': {'body': 'status'}})
+        self.assertEqual(value['statuses'][0]['recipient_id'], '*******5678')
+        # The logged payload itself is left untouched
+        self.assertEqual(payload['Authorization'], 'Bearer secret-token')
+        self.assertEqual(payload['entry'][0]['changes'][0]['value']['messages'][0]['from'], '15550001234')
+
+    @override_settings(LOG_PAYLOAD_MAX_CHARS=40)
+    def test_payload_logged_compact_redacted_and_truncated(self):
+        logger = logging.getLogger('booking.tests.payloads')
+        with self.assertLogs(logger, 'DEBUG') as logs:
+            log_payload(logger, 'Skipped', {'to': '15550001234'}, sample_rate=0)
+            log_payload(logger, 'Request', {'to': '15550001234', 'text': {'body': 'x' * 100}}, sample_rate=1)
+            # assertLogs needs at least one record; sample_rate=0 must add none
+            self.assertEqual(len(logs.records), 1)
+
+        message = logs.records[0].getMessage()
+        self.assertTrue(message.startswith('Request: {"to":"*******1234","text":'))
+        self.assertNotIn('15550001234', message)
+        self.assertTrue(message.endswith('more chars)'))
+
+    def test_queued_file_handler_writes_records_in_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'app.log')
+            handler = QueuedFileHandler(filename)
+            handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            logger = logging.getLogger('booking.tests.queued')
+            logger.addHandler(handler)
+            logger.propagate = False
+            try:
+                state = {'count': 1}
+                logger.warning('count=%s', Lazy(lambda: state['count']))
+                # Formatted when logged, not when the background thread writes it
+                state['count'] = 2
+                log_event(logger, logging.WARNING, 'booking.created', id=7, note='two words')
+            finally:
+                logger.removeHandler(handler)
+                logger.propagate = True
+                handler.close()
+
+            with open(filename, encoding='utf-8') as log_file:
+                lines = log_file.read().splitlines()
+
+        self.assertEqual(lines, ['WARNING count=1', 'WARNING booking.created id=7 note="two words"'])
+        self.assertIsNone(handler.listener)
+
+
+@override_settings(ROOT_URLCONF='booking.tests', NOTIFICATION_DISPATCH='worker')
+class AsyncViewTests(BookingFixtureMixin, TransactionTestCase):
+
+    async def test_status_page(self):
+        appointment = await Appointment.objects.acreate(
+            service=self.service, name='Alex Smith', email='alex@example.com', phone='+15550001234',
+            date=self.date, time=time(9), duration=60
+        )
+        response = await AsyncClient().get(f'/status/{appointment.appointment_id}/')
+        self.assertContains(response, 'Appointment Status')
+
+    @override_settings(RATE_LIMITS={'booking': '1/m'})
+    async def test_keyed_retry_replayed_past_rate_limit(self):
+        client = AsyncClient()
+        headers = {'Idempotency-Key': 'async-retry'}
+        first = await client.post('/book/', data=self.booking_body(), content_type='application/json', headers=headers)
+        self.assertEqual(first.status_code, 200)
+
+        retry = await client.post('/book/', data=self.booking_body(), content_type='application/json', headers=headers)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json()['appointment_id'], first.json()['appointment_id'])
+
+        other = await client.post('/book/', data=self.booking_body(time='11:00'), content_type='application/json')
+        self.assertEqual(other.status_code, 429)
+
+    async def test_status_error_page(self):
+        with mock.patch.object(async_views, 'aget_object_or_404', side_effect=RuntimeError('database down')):
+            response = await AsyncClient().get('/status/00000000-0000-0000-0000-000000000000/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'database down')
+
+
+class GraphClientLifespanTests(SimpleTestCase):
+
+    class Client:
+        closed = False
+
+        async def aclose(self):
+            self.closed = True
+
+    async def run_lifespan(self, application):
+        events = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(events)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await application({'type': 'lifespan'}, receive, send)
+        return sent
+
+    async def test_shutdown_closes_client_of_running_loop(self):
+        from fitblendz_pro.asgi import application
+
+        client = self.Client()
+        async_views._graph_clients[asyncio.get_running_loop()] = client
+
+        sent = await self.run_lifespan(application)
+
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(client.closed)
+        self.assertNotIn(asyncio.get_running_loop(), async_views._graph_clients)
+
+    async def test_shutdown_without_client(self):
+        sent = await self.run_lifespan(async_views.lifespan)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
@@ -1,14 +1,22 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 from . import webhook_views
 
 app_name = 'booking'
 
+# Under ASGI, the I/O-bound public endpoints are served by their async versions
+if getattr(settings, 'ASYNC_VIEWS', False):
+    from . import async_views
+    public_views = webhook_endpoint = async_views
+else:
+    public_views, webhook_endpoint = views, webhook_views
+
 urlpatterns = [
     # Public pages
     path('', views.home, name='home'),
-    path('book/', views.booking_page, name='booking_page'),
-    path('status/<uuid:appointment_id>/', views.appointment_status, name='appointment_status'),
+    path('book/', public_views.booking_page, name='booking_page'),
+    path('status/<uuid:appointment_id>/', public_views.appointment_status, name='appointment_status'),
     
     # Admin pages
     path('admin-login/', views.admin_login, name='admin_login'),
@@ -18,12 +26,14 @@ urlpatterns = [
     # API endpoints
     path('api/delete-appointment/<uuid:appointment_id>/', views.delete_appointment, name='delete_appointment'),
     path('api/update-appointment-status/<uuid:appointment_id>/', views.update_appointment_status, name='update_appointment_status'),
-    path('api/available-times/', views.get_available_times, name='get_available_times'),
+    path('api/available-times/', public_views.get_available_times, name='get_available_times'),
+    path('api/available-calendar/', views.get_available_calendar, name='get_available_calendar'),
+    path('api/next-available/', views.get_next_available, name='get_next_available'),
     path('api/working-hours/', views.get_working_hours, name='get_working_hours'),
     
     # WhatsApp webhook
-    path('webhook/', webhook_views.whatsapp_webhook, name='whatsapp_webhook'),
-    path('whatsapp-webhook/', webhook_views.whatsapp_webhook, name='whatsapp_webhook_alt'),
+    path('webhook/', webhook_endpoint.whatsapp_webhook, name='whatsapp_webhook'),
+    path('whatsapp-webhook/', webhook_endpoint.whatsapp_webhook, name='whatsapp_webhook_alt'),
     
     # Error page
     path('error/', views.error_page, name='error_page'),
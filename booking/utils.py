@@ -1,394 +1,141 @@
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
 from django.conf import settings
+from django.core.mail.message import make_msgid
 from django.utils import timezone
-from datetime import datetime, time
 import logging
+from .ledger import already_sent, record_failed, record_sent
+from .notification_templates import build_email
 
 logger = logging.getLogger(__name__)
 
-def send_confirmation_email(appointment):
-    """Send confirmation email to customer"""
+def send_notification_email(event, appointment):
+    """Render the registered email for an appointment event and send it, once per appointment"""
     try:
-        subject = f"Appointment Confirmation - {appointment.service.name}"
-        
-        # Format time for display
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        # Email context
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-            'service_price': appointment.service.price,
-            'service_duration': appointment.get_duration_display(),
-        }
-        
-        # Render email templates
-        html_content = render_to_string('booking/emails/appointment_confirmation.html', context)
-        text_content = render_to_string('booking/emails/appointment_confirmation.txt', context)
+        if already_sent(appointment, 'email', event):
+            logger.info("%s email already sent for appointment %s, skipping", event.capitalize(), appointment.id)
+            return True
         
-        # Log email attempt
-        logger.info(f"Attempting to send confirmation email to {appointment.email}")
-        logger.info(f"Using SMTP: {settings.EMAIL_HOST}:{settings.EMAIL_PORT}")
-        logger.info(f"From: {settings.DEFAULT_FROM_EMAIL}")
+        message = build_email(event, appointment)
+        message.extra_headers['Message-ID'] = make_msgid()
         
-        # Send email
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
+        logger.info("Attempting to send %s email to %s", event, appointment.email)
+        message.send(fail_silently=False)
+        record_sent(appointment, 'email', event, message.extra_headers['Message-ID'])
         
-        logger.info(f"Confirmation email sent successfully to {appointment.email} for appointment {appointment.id}")
+        logger.info("%s email sent successfully to %s for appointment %s", event.capitalize(), appointment.email, appointment.id)
         return True
         
     except Exception as e:
-        logger.error(f"Failed to send confirmation email: {e}")
-        logger.error(f"Email settings - Host: {settings.EMAIL_HOST}, Port: {settings.EMAIL_PORT}, User: {settings.EMAIL_HOST_USER}")
-        logger.exception("Full traceback for email error:")
+        logger.error("Failed to send %s email: %s", event, e)
+        logger.error("Email settings - Host: %s, Port: %s, User: %s", settings.EMAIL_HOST, settings.EMAIL_PORT, settings.EMAIL_HOST_USER)
+        record_failed(appointment, 'email', event)
         return False
 
+def send_confirmation_email(appointment):
+    """Send confirmation email to customer"""
+    return send_notification_email('booked', appointment)
+
 def send_reminder_email(appointment):
     """Send reminder email for upcoming appointment"""
-    try:
-        subject = f"Appointment Reminder - {appointment.service.name}"
-        
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-        }
-        
-        html_content = render_to_string('booking/emails/appointment_reminder.html', context)
-        text_content = render_to_string('booking/emails/appointment_reminder.txt', context)
-        
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Reminder email sent to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send reminder email: {e}")
-        return False
+    return send_notification_email('reminder', appointment)
 
 def send_cancellation_email(appointment):
     """Send cancellation email"""
-    try:
-        subject = f"Appointment Cancelled - {appointment.service.name}"
-        
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-        }
-        
-        html_content = render_to_string('booking/emails/appointment_cancelled.html', context)
-        text_content = render_to_string('booking/emails/appointment_cancelled.txt', context)
-        
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Cancellation email sent to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send cancellation email: {e}")
-        return False
+    return send_notification_email('cancellation', appointment)
 
 def send_status_confirmation_email(appointment):
     """Send confirmation email when appointment status is changed to confirmed"""
-    try:
-        subject = f"Appointment Confirmed - {appointment.service.name}"
-        
-        # Format time for display
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        # Email context
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-            'service_price': appointment.service.price,
-            'service_duration': appointment.get_duration_display(),
-        }
-        
-        # Render email templates
-        html_content = render_to_string('booking/emails/appointment_status_confirmed.html', context)
-        text_content = render_to_string('booking/emails/appointment_status_confirmed.txt', context)
-        
-        # Log email attempt
-        logger.info(f"Attempting to send status confirmation email to {appointment.email}")
-        
-        # Send email
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Status confirmation email sent successfully to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send status confirmation email: {e}")
-        return False
+    return send_notification_email('confirmed', appointment)
 
 def send_status_cancellation_email(appointment):
     """Send cancellation email when appointment status is changed to cancelled"""
-    try:
-        subject = f"Appointment Cancelled - {appointment.service.name}"
-        
-        # Format time for display
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        # Email context
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-        }
-        
-        # Render email templates
-        html_content = render_to_string('booking/emails/appointment_status_cancelled.html', context)
-        text_content = render_to_string('booking/emails/appointment_status_cancelled.txt', context)
-        
-        # Log email attempt
-        logger.info(f"Attempting to send status cancellation email to {appointment.email}")
-        
-        # Send email
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Status cancellation email sent successfully to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send status cancellation email: {e}")
-        return False
+    return send_notification_email('cancelled', appointment)
 
 def send_status_completion_email(appointment):
     """Send completion email when appointment status is changed to completed"""
-    try:
-        subject = f"Appointment Completed - {appointment.service.name}"
-        
-        # Format time for display
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        # Email context
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-        }
-        
-        # Render email templates
-        html_content = render_to_string('booking/emails/appointment_status_completed.html', context)
-        text_content = render_to_string('booking/emails/appointment_status_completed.txt', context)
-        
-        # Log email attempt
-        logger.info(f"Attempting to send status completion email to {appointment.email}")
-        
-        # Send email
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Status completion email sent successfully to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send status completion email: {e}")
-        return False
+    return send_notification_email('completed', appointment)
 
 def send_pending_appointment_email(appointment):
     """Send pending appointment email when appointment is first created"""
-    try:
-        subject = f"Appointment Request Submitted - {appointment.service.name}"
-        
-        # Format time for display
-        formatted_time = appointment.time.strftime('%I:%M %p')
-        
-        # Email context
-        context = {
-            'appointment': appointment,
-            'formatted_time': formatted_time,
-            'service_name': appointment.service.name,
-            'service_price': appointment.service.price,
-            'service_duration': appointment.get_duration_display(),
-        }
-        
-        # Render email templates
-        html_content = render_to_string('booking/emails/appointment_pending.html', context)
-        text_content = render_to_string('booking/emails/appointment_pending.txt', context)
-        
-        # Log email attempt
-        logger.info(f"Attempting to send pending appointment email to {appointment.email}")
-        
-        # Send email
-        send_mail(
-            subject=subject,
-            message=text_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[appointment.email],
-            html_message=html_content,
-            fail_silently=False,
-        )
-        
-        logger.info(f"Pending appointment email sent successfully to {appointment.email} for appointment {appointment.id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send pending appointment email: {e}")
-        return False
+    return send_notification_email('pending', appointment)
 
 def is_working_hours(date, time):
     """Check if given date and time are within working hours"""
     try:
-        from .models import WorkingHours
-        
-        # Get day of week (0=Monday, 6=Sunday)
-        day_of_week = date.weekday()
+        from .schedule import get_schedule
         
-        # Get working hours for this day
-        working_hours = WorkingHours.objects.filter(day=day_of_week).first()
-        
-        logger.info(f"Checking working hours for day {day_of_week}, time {time}")
-        logger.info(f"Working hours found: {working_hours}")
-        
-        if not working_hours:
-            logger.warning(f"No working hours found for day {day_of_week}")
-            return False
-            
-        if not working_hours.is_open:
-            logger.warning(f"Shop is closed on day {day_of_week}")
-            return False
-        
-        # Check if time is within working hours
-        if working_hours.open_time and working_hours.close_time:
-            is_within_hours = working_hours.open_time <= time <= working_hours.close_time
-            logger.info(f"Time {time} is within {working_hours.open_time} - {working_hours.close_time}: {is_within_hours}")
-            return is_within_hours
-        
-        logger.warning(f"No open/close times set for day {day_of_week}")
-        return False
+        is_within_hours = get_schedule().is_working_hours(date, time)
+        if not is_within_hours:
+            logger.info("Time %s on %s is outside working hours", time, date)
+        return is_within_hours
         
     except Exception as e:
-        logger.error(f"Error checking working hours: {e}")
+        logger.error("Error checking working hours: %s", e)
         return False
 
 def is_holiday(date):
     """Check if given date is a holiday"""
     try:
-        from .models import Holiday
-        
-        # Check for exact date match
-        holiday = Holiday.objects.filter(date=date).first()
-        if holiday:
-            return True
-        
-        # Check for recurring holidays (same month and day)
-        month = date.month
-        day = date.day
-        
-        recurring_holidays = Holiday.objects.filter(
-            is_recurring=True,
-            date__month=month,
-            date__day=day
-        )
+        from .schedule import get_schedule
         
-        return recurring_holidays.exists()
+        return get_schedule().is_holiday(date)
         
     except Exception as e:
-        logger.error(f"Error checking holiday: {e}")
+        logger.error("Error checking holiday: %s", e)
         return False
 
 def get_available_slots(date, service_duration=30):
     """Get available time slots for a given date"""
     try:
-        from .models import WorkingHours, Appointment
+        from .availability import get_free_slots
+        from .schedule import get_schedule
         
-        # Check if it's a holiday
-        if is_holiday(date):
+        # Holidays and closed weekdays come from the cached schedule
+        schedule = get_schedule()
+        if not schedule.is_open(date):
             return []
         
-        # Get working hours for this day
-        day_of_week = date.weekday()
-        working_hours = WorkingHours.objects.filter(day=day_of_week).first()
+        working_hours = schedule.hours_for(date)
         
-        if not working_hours or not working_hours.is_open:
-            return []
+        # Load the day's appointments once and sweep them for free slots
+        return get_free_slots(
+            date,
+            working_hours.open_time,
+            working_hours.close_time,
+            slot_length=service_duration,
+            capacity=schedule.capacity,
+            barber_ids=schedule.barber_ids
+        )
         
-        # Generate time slots
-        slots = []
-        current_time = working_hours.open_time
+    except Exception as e:
+        logger.error("Error getting available slots: %s", e)
+        return []
+
+def find_next_available_slots(service_id, start, count=5):
+    """Find the first available slots for a service at or after a datetime"""
+    try:
+        from .models import Service
+        from .availability import BOOKING_HORIZON_DAYS, find_next_free_slots, time_to_minutes
         
-        while current_time < working_hours.close_time:
-            # Check if this slot conflicts with existing appointments
-            slot_end = (datetime.combine(date, current_time) + 
-                       timezone.timedelta(minutes=service_duration)).time()
-            
-            # Check for conflicts
-            conflicts = Appointment.objects.filter(
-                date=date,
-                time__lt=slot_end,
-                status__in=['pending', 'confirmed']
-            )
-            
-            # Check if any appointment overlaps with this slot
-            has_conflict = False
-            for appt in conflicts:
-                appt_end = (datetime.combine(date, appt.time) + 
-                           timezone.timedelta(minutes=appt.duration)).time()
-                if current_time < appt_end:
-                    has_conflict = True
-                    break
-            
-            if not has_conflict:
-                slots.append(current_time.strftime('%H:%M'))
-            
-            # Move to next slot (30-minute intervals)
-            current_time = (datetime.combine(date, current_time) + 
-                           timezone.timedelta(minutes=30)).time()
+        service = Service.objects.only('duration').get(id=service_id, is_active=True)
+        
+        # Never suggest slots in the past
+        now = timezone.localtime()
+        if start < now.replace(tzinfo=None):
+            start = now.replace(tzinfo=None)
+        
+        horizon_date = now.date() + timezone.timedelta(days=BOOKING_HORIZON_DAYS)
         
-        return slots
+        slots = find_next_free_slots(
+            start.date(),
+            time_to_minutes(start.time()),
+            service.duration,
+            count,
+            horizon_date
+        )
+        return [{'date': day.isoformat(), 'time': slot} for day, slot in slots]
         
     except Exception as e:
-        logger.error(f"Error getting available slots: {e}")
+        logger.error("Error finding next available slots: %s", e)
         return []
 
 def format_phone_number(phone):
@@ -407,13 +154,14 @@ def format_phone_number(phone):
             return phone
             
     except Exception as e:
-        logger.error(f"Error formatting phone number: {e}")
+        logger.error("Error formatting phone number: %s", e)
         return phone
 
 def validate_appointment_time(date, time, service_duration):
     """Validate if appointment time is available"""
     try:
-        from .models import Appointment
+        from .availability import find_slot_barber, load_day_appointments
+        from .schedule import get_schedule
         
         # Check if it's in the past
         if date < timezone.now().date():
@@ -431,24 +179,17 @@ def validate_appointment_time(date, time, service_duration):
         if is_holiday(date):
             return False, "Selected date is a holiday and we are closed"
         
-        # Check for conflicts
-        slot_end = (datetime.combine(date, time) + 
-                   timezone.timedelta(minutes=service_duration)).time()
-        
-        conflicts = Appointment.objects.filter(
-            date=date,
-            time__lt=slot_end,
-            status__in=['pending', 'confirmed']
+        # Check for conflicts against every barber's bookings
+        schedule = get_schedule()
+        available, _ = find_slot_barber(
+            load_day_appointments(date), time, service_duration,
+            schedule.capacity, schedule.barber_ids
         )
-        
-        for appt in conflicts:
-            appt_end = (datetime.combine(date, appt.time) + 
-                       timezone.timedelta(minutes=appt.duration)).time()
-            if time < appt_end:
-                return False, "This time slot conflicts with an existing appointment"
+        if not available:
+            return False, "This time slot conflicts with an existing appointment"
         
         return True, "Time slot is available"
         
     except Exception as e:
-        logger.error(f"Error validating appointment time: {e}")
+        logger.error("Error validating appointment time: %s", e)
         return False, "Error validating appointment time"
@@ -1,23 +1,37 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.paginator import Paginator
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.utils import timezone
 from datetime import datetime, timedelta
 import json
 import logging
-# from django_ratelimit.decorators import ratelimit  # Temporarily disabled due to installation issues
-from .models import Appointment, Service, WorkingHours, Holiday
-from .webhook_views import send_appointment_notification
-from .utils import send_pending_appointment_email, send_status_confirmation_email, send_status_cancellation_email, send_status_completion_email, is_working_hours, is_holiday
+from .models import Appointment, Service, WorkingHours
+from .availability import BOOKING_HORIZON_DAYS, SLOT_INTERVAL, get_availability_calendar, get_free_slots
+from .reservations import reserve_appointment
+from .availability_cache import get_cached_availability
+from .schedule import get_schedule
+from .notifications import NOTIFICATION_PLAN, enqueue_notifications
+from .ratelimit import rate_limit
+from .structured_logging import Lazy
+from .idempotency import (
+    get_idempotency_key, get_stored_response, replay_response, replay_retries, request_fingerprint, store_response,
+)
+from .utils import find_next_available_slots
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on slots returned by the next-available API
+MAX_NEXT_AVAILABLE = 20
+
+BOOKING_REQUIRED_FIELDS = ['name', 'email', 'phone', 'service', 'date', 'time']
+
 def home(request):
     """Home page with services and booking form"""
     try:
@@ -28,7 +42,7 @@ def home(request):
         }
         return render(request, 'booking/home.html', context)
     except Exception as e:
-        logger.error(f"Error in home view: {e}")
+        logger.error("Error in home view: %s", e)
         messages.error(request, "Sorry, there was an error loading the page. Please try again.")
         return render(request, 'booking/error.html', {'error': str(e)})
 
@@ -72,7 +86,7 @@ def booking_page(request):
             # Get services with error handling
             try:
                 services = Service.objects.filter(is_active=True).order_by('name')
-                logger.info(f"Found {services.count()} active services")
+                logger.debug("Found %s active services", Lazy(services.count))
                 
                 # If no services found, try to create them
                 if services.count() == 0:
@@ -81,20 +95,20 @@ def booking_page(request):
                     try:
                         call_command('populate_services')
                         services = Service.objects.filter(is_active=True).order_by('name')
-                        logger.info(f"Created services, now found {services.count()} active services")
+                        logger.info("Created services, now found %s active services", Lazy(services.count))
                     except Exception as create_error:
-                        logger.error(f"Error creating services: {create_error}")
+                        logger.error("Error creating services: %s", create_error)
                         services = []
                         
             except Exception as e:
-                logger.error(f"Error fetching services: {e}")
+                logger.error("Error fetching services: %s", e)
                 services = []
             
             # Get working hours with error handling
             try:
                 from .models import WorkingHours
                 working_hours = WorkingHours.objects.all()
-                logger.info(f"Found {working_hours.count()} working hours records")
+                logger.debug("Found %s working hours records", Lazy(working_hours.count))
                 
                 # If no working hours found, try to create them
                 if working_hours.count() == 0:
@@ -102,12 +116,12 @@ def booking_page(request):
                     try:
                         call_command('populate_working_hours')
                         working_hours = WorkingHours.objects.all()
-                        logger.info(f"Created working hours, now found {working_hours.count()} records")
+                        logger.info("Created working hours, now found %s records", Lazy(working_hours.count))
                     except Exception as create_error:
-                        logger.error(f"Error creating working hours: {create_error}")
+                        logger.error("Error creating working hours: %s", create_error)
                         
             except Exception as e:
-                logger.error(f"Error fetching working hours: {e}")
+                logger.error("Error fetching working hours: %s", e)
             
             context = {
                 'services': services,
@@ -121,9 +135,9 @@ def booking_page(request):
             return handle_booking_submission(request)
             
     except Exception as e:
-        logger.error(f"Error in booking_page view: {e}")
+        logger.error("Error in booking_page view: %s", e)
         import traceback
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        logger.error("Full traceback: %s", traceback.format_exc())
         return JsonResponse({
             'success': False,
             'error': 'An error occurred while processing your request. Please try again.'
@@ -131,16 +145,26 @@ def booking_page(request):
 
 @csrf_exempt
 @require_http_methods(["POST"])
-# @ratelimit(key='ip', rate='5/m', method='POST', block=True)  # Temporarily disabled due to installation issues
+@replay_retries
+@rate_limit('booking')
 def handle_booking_submission(request):
     """Handle booking form submission"""
     try:
         # Extract and validate form data
         data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
         
+        # Retries with a stored response were already answered by replay_retries
+        try:
+            idempotency_key = get_idempotency_key(request, data)
+        except ValueError as e:
+            return JsonResponse({
+                'success': False,
+                'error': str(e)
+            }, status=400)
+        fingerprint = request_fingerprint(data) if idempotency_key else None
+        
         # Validate required fields
-        required_fields = ['name', 'email', 'phone', 'service', 'date', 'time']
-        missing_fields = [field for field in required_fields if not data.get(field)]
+        missing_fields = [field for field in BOOKING_REQUIRED_FIELDS if not data.get(field)]
         
         if missing_fields:
             return JsonResponse({
@@ -157,102 +181,55 @@ def handle_booking_submission(request):
                 'error': 'Selected service is not available'
             }, status=400)
         
-        # Validate date and time
-        try:
-            appointment_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-            appointment_time = datetime.strptime(data['time'], '%H:%M').time()
-        except ValueError:
-            return JsonResponse({
-                'success': False,
-                'error': 'Invalid date or time format'
-            }, status=400)
-        
-        # Check if appointment is in the past
-        if appointment_date < timezone.now().date():
+        # Validate date and time against the booking window and opening hours
+        error, appointment_date, appointment_time = check_booking_slot(data, get_schedule())
+        if error:
             return JsonResponse({
                 'success': False,
-                'error': 'Cannot book appointments in the past'
+                'error': error
             }, status=400)
         
-        # Check if appointment is in the future (within reasonable time)
-        if appointment_date > timezone.now().date() + timedelta(days=90):
-            return JsonResponse({
-                'success': False,
-                'error': 'Cannot book appointments more than 90 days in advance'
-            }, status=400)
-        
-        # Check working hours and holidays
-        if not is_working_hours(appointment_date, appointment_time):
-            return JsonResponse({
-                'success': False,
-                'error': 'Selected time is outside working hours'
-            }, status=400)
-        
-        if is_holiday(appointment_date):
-            return JsonResponse({
-                'success': False,
-                'error': 'Selected date is a holiday and we are closed'
-            }, status=400)
+        # Store the response under the idempotency key in the booking transaction
+        def remember_response(appointment):
+            store_response(idempotency_key, fingerprint, booking_success_payload(appointment), appointment=appointment)
         
-        # Check for conflicting appointments
-        conflicting_appointments = Appointment.objects.filter(
-            date=appointment_date,
-            time=appointment_time,
-            status__in=['pending', 'confirmed']
-        )
-        
-        if conflicting_appointments.exists():
+        # Check for overlapping appointments and create the booking under a per-date lock
+        try:
+            appointment = reserve_appointment(
+                service,
+                appointment_date,
+                appointment_time,
+                name=data['name'],
+                email=data['email'],
+                phone=data['phone'],
+                notes=data.get('notes', ''),
+                status='pending',
+                notify_event='pending',
+                on_reserved=remember_response if idempotency_key else None
+            )
+        except IntegrityError:
+            # A concurrent retry with the same key won; its booking was kept and ours rolled back
+            stored = get_stored_response(idempotency_key) if idempotency_key else None
+            if stored is None:
+                raise
+            return replay_response(stored, fingerprint)
+        
+        if appointment is None:
+            # A concurrent retry with the same key may be the booking that took the slot
+            stored = get_stored_response(idempotency_key) if idempotency_key else None
+            if stored:
+                return replay_response(stored, fingerprint)
             return JsonResponse({
                 'success': False,
-                'error': 'This time slot is already booked. Please select another time.'
+                'error': 'This time slot is already booked. Please select another time.',
+                'next_available': find_next_available_slots(
+                    service.id, datetime.combine(appointment_date, appointment_time), 3
+                )
             }, status=400)
         
-        # Create appointment
-        appointment = Appointment.objects.create(
-            name=data['name'],
-            email=data['email'],
-            phone=data['phone'],
-            service=service,
-            date=appointment_date,
-            time=appointment_time,
-            duration=service.duration,
-            notes=data.get('notes', ''),
-            status='pending'
-        )
-        
-        logger.info(f"Appointment created: {appointment.id} for {appointment.name}")
-        
-        # Send pending appointment email
-        try:
-            logger.info(f"Attempting to send pending appointment email to {appointment.email}")
-            email_sent = send_pending_appointment_email(appointment)
-            if email_sent:
-                logger.info(f"Pending appointment email sent successfully to {appointment.email}")
-            else:
-                logger.error(f"Failed to send pending appointment email to {appointment.email}")
-        except Exception as e:
-            logger.error(f"Exception while sending pending appointment email: {e}")
-            logger.exception("Full traceback:")
-        
-        # Send pending notification to customer
-        try:
-            from .webhook_views import send_appointment_notification
-            send_appointment_notification(appointment, "pending")
-        except Exception as e:
-            logger.error(f"Failed to send pending notification: {e}")
+        logger.info("Appointment created: %s for %s", appointment.id, appointment.name)
         
-        # Send approval request to barber
-        try:
-            from .webhook_views import send_approval_request_to_barber
-            send_approval_request_to_barber(appointment)
-        except Exception as e:
-            logger.error(f"Failed to send approval request to barber: {e}")
-        
-        return JsonResponse({
-            'success': True,
-            'appointment_id': appointment.appointment_id,
-            'message': 'Appointment request submitted successfully! The barber will review and confirm your appointment. You will receive a WhatsApp notification once approved.'
-        })
+        return JsonResponse(booking_success_payload(appointment))
         
     except json.JSONDecodeError:
         return JsonResponse({
@@ -260,12 +237,52 @@ def handle_booking_submission(request):
             'error': 'Invalid request format'
         }, status=400)
     except Exception as e:
-        logger.error(f"Error handling booking submission: {e}")
+        logger.error("Error handling booking submission: %s", e)
         return JsonResponse({
             'success': False,
             'error': 'An error occurred while booking your appointment. Please try again.'
         }, status=500)
 
+def check_booking_slot(data, schedule):
+    """
+    Validate the requested date and time without touching the database.
+    
+    Returns (error, date, time); error is None when the slot can be booked.
+    """
+    try:
+        appointment_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
+        appointment_time = datetime.strptime(data['time'], '%H:%M').time()
+    except ValueError:
+        return 'Invalid date or time format', None, None
+    
+    today = timezone.now().date()
+    
+    # Check if appointment is in the past
+    if appointment_date < today:
+        return 'Cannot book appointments in the past', None, None
+    
+    # Check if appointment is in the future (within reasonable time)
+    if appointment_date > today + timedelta(days=BOOKING_HORIZON_DAYS):
+        return f'Cannot book appointments more than {BOOKING_HORIZON_DAYS} days in advance', None, None
+    
+    # Check working hours and holidays
+    if not schedule.is_working_hours(appointment_date, appointment_time):
+        return 'Selected time is outside working hours', None, None
+    
+    if schedule.is_holiday(appointment_date):
+        return 'Selected date is a holiday and we are closed', None, None
+    
+    return None, appointment_date, appointment_time
+
+def booking_success_payload(appointment):
+    """Response body for a successful booking"""
+    return {
+        'success': True,
+        'appointment_id': str(appointment.appointment_id),
+        'message': 'Appointment request submitted successfully! The barber will review and confirm your appointment. You will receive a WhatsApp notification once approved.'
+    }
+
+@rate_limit('appointment_status')
 def appointment_status(request, appointment_id):
     """Check appointment status"""
     try:
@@ -278,7 +295,7 @@ def appointment_status(request, appointment_id):
         return render(request, 'booking/appointment_status.html', context)
         
     except Exception as e:
-        logger.error(f"Error in appointment_status view: {e}")
+        logger.error("Error in appointment_status view: %s", e)
         messages.error(request, "Sorry, there was an error loading the appointment status.")
         return render(request, 'booking/error.html', {'error': str(e)})
 
@@ -350,7 +367,7 @@ def admin_dashboard(request):
         return render(request, 'booking/admin_dashboard.html', context)
         
     except Exception as e:
-        logger.error(f"Error in admin_dashboard view: {e}")
+        logger.error("Error in admin_dashboard view: %s", e)
         messages.error(request, "Sorry, there was an error loading the dashboard.")
         return render(request, 'booking/error.html', {'error': str(e)})
 
@@ -396,45 +413,14 @@ def update_appointment_status(request, appointment_id):
         elif new_status == 'completed' and old_status != 'completed':
             appointment.completed_at = timezone.now()
         
-        appointment.save()
-        
-        logger.info(f"Appointment {appointment_id} status updated from {old_status} to {new_status}")
+        # Save the change and queue its notifications in one transaction;
+        # they are delivered in the background once it commits
+        with transaction.atomic():
+            appointment.save()
+            if old_status != new_status and new_status in NOTIFICATION_PLAN:
+                enqueue_notifications(appointment, new_status)
         
-        # Send notifications if status changed
-        if old_status != new_status:
-            try:
-                # Send WhatsApp notification
-                if new_status == 'confirmed':
-                    send_appointment_notification(appointment, "confirmation")
-                elif new_status == 'cancelled':
-                    send_appointment_notification(appointment, "cancellation")
-                elif new_status == 'completed':
-                    send_appointment_notification(appointment, "update")
-            except Exception as e:
-                logger.error(f"Failed to send WhatsApp notification: {e}")
-            
-            # Send email notification
-            try:
-                if new_status == 'confirmed':
-                    email_sent = send_status_confirmation_email(appointment)
-                    if email_sent:
-                        logger.info(f"Status confirmation email sent successfully to {appointment.email}")
-                    else:
-                        logger.warning(f"Failed to send status confirmation email to {appointment.email}")
-                elif new_status == 'cancelled':
-                    email_sent = send_status_cancellation_email(appointment)
-                    if email_sent:
-                        logger.info(f"Status cancellation email sent successfully to {appointment.email}")
-                    else:
-                        logger.warning(f"Failed to send status cancellation email to {appointment.email}")
-                elif new_status == 'completed':
-                    email_sent = send_status_completion_email(appointment)
-                    if email_sent:
-                        logger.info(f"Status completion email sent successfully to {appointment.email}")
-                    else:
-                        logger.warning(f"Failed to send status completion email to {appointment.email}")
-            except Exception as e:
-                logger.error(f"Failed to send status update email: {e}")
+        logger.info("Appointment %s status updated from %s to %s", appointment_id, old_status, new_status)
         
         return JsonResponse({
             'success': True,
@@ -444,7 +430,7 @@ def update_appointment_status(request, appointment_id):
         })
         
     except Exception as e:
-        logger.error(f"Error updating appointment status: {e}")
+        logger.error("Error updating appointment status: %s", e)
         return JsonResponse({
             'success': False,
             'error': 'An error occurred while updating the appointment status.'
@@ -460,7 +446,7 @@ def delete_appointment(request, appointment_id):
         
         # Allow deletion of any appointment status
         appointment.delete()
-        logger.info(f"Appointment {appointment_id} deleted")
+        logger.info("Appointment %s deleted", appointment_id)
         
         return JsonResponse({
             'success': True,
@@ -468,12 +454,13 @@ def delete_appointment(request, appointment_id):
         })
         
     except Exception as e:
-        logger.error(f"Error deleting appointment: {e}")
+        logger.error("Error deleting appointment: %s", e)
         return JsonResponse({
             'success': False,
             'error': 'An error occurred while deleting the appointment.'
         }, status=500)
 
+@rate_limit('available_times')
 def get_available_times(request):
     """Get available time slots for a given date"""
     try:
@@ -483,77 +470,132 @@ def get_available_times(request):
         
         appointment_date = datetime.strptime(date_str, '%Y-%m-%d').date()
         
-        # Check if it's a holiday
-        if is_holiday(appointment_date):
-            return JsonResponse({'available_times': [], 'message': 'Closed on this date'})
+        # Served from the per-date cache until an appointment on that date changes
+        return JsonResponse(get_cached_availability(appointment_date, build_available_times))
+        
+    except ValueError:
+        return JsonResponse({'error': 'Invalid date format'}, status=400)
+    except Exception as e:
+        logger.error("Error getting available times: %s", e)
+        return JsonResponse({'error': 'An error occurred'}, status=500)
+
+def build_available_times(appointment_date):
+    """Build the available-times response payload for a date"""
+    schedule = get_schedule()
+    
+    # Check if it's a holiday
+    if schedule.is_holiday(appointment_date):
+        return {'available_times': [], 'message': 'Closed on this date'}
+    
+    # Get working hours for this day
+    working_hours = schedule.hours_for(appointment_date)
+    
+    if not working_hours or not working_hours.is_open:
+        return {'available_times': [], 'message': 'Closed on this day'}
+    
+    # Generate time slots
+    available_times = generate_time_slots(working_hours, appointment_date)
+    
+    return {
+        'available_times': available_times,
+        'working_hours': {
+            'open': working_hours.open_time.strftime('%H:%M') if working_hours.open_time else None,
+            'close': working_hours.close_time.strftime('%H:%M') if working_hours.close_time else None
+        }
+    }
+
+def get_available_calendar(request):
+    """Get available time slots for every day in a date range"""
+    try:
+        start_str = request.GET.get('start')
+        end_str = request.GET.get('end')
+        if not start_str or not end_str:
+            return JsonResponse({'error': 'Start and end parameters are required'}, status=400)
         
-        # Get working hours for this day
-        working_hours = WorkingHours.objects.filter(day=appointment_date.weekday()).first()
+        start_date = datetime.strptime(start_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_str, '%Y-%m-%d').date()
         
-        if not working_hours or not working_hours.is_open:
-            return JsonResponse({'available_times': [], 'message': 'Closed on this day'})
+        if end_date < start_date:
+            return JsonResponse({'error': 'End date must not be before start date'}, status=400)
         
-        # Generate time slots
-        available_times = generate_time_slots(working_hours, appointment_date)
+        if (end_date - start_date).days > BOOKING_HORIZON_DAYS:
+            return JsonResponse({
+                'error': f'Date range cannot exceed {BOOKING_HORIZON_DAYS} days'
+            }, status=400)
+        
+        # Optional service so slots match its duration
+        slot_length = SLOT_INTERVAL
+        service_id = request.GET.get('service')
+        if service_id:
+            try:
+                slot_length = Service.objects.only('duration').get(id=service_id, is_active=True).duration
+            except (Service.DoesNotExist, ValueError):
+                return JsonResponse({'error': 'Selected service is not available'}, status=400)
+        
+        # Summary mode returns only the free-slot count for each day
+        include_times = request.GET.get('summary', '').lower() not in ('1', 'true', 'yes')
+        
+        days = get_availability_calendar(start_date, end_date, slot_length, include_times)
         
         return JsonResponse({
-            'available_times': available_times,
-            'working_hours': {
-                'open': working_hours.open_time.strftime('%H:%M') if working_hours.open_time else None,
-                'close': working_hours.close_time.strftime('%H:%M') if working_hours.close_time else None
-            }
+            'start': start_date.isoformat(),
+            'end': end_date.isoformat(),
+            'days': days
         })
         
     except ValueError:
         return JsonResponse({'error': 'Invalid date format'}, status=400)
     except Exception as e:
-        logger.error(f"Error getting available times: {e}")
+        logger.error("Error getting available calendar: %s", e)
         return JsonResponse({'error': 'An error occurred'}, status=500)
 
-def generate_time_slots(working_hours, date):
-    """Generate available time slots for a given date"""
-    if not working_hours.open_time or not working_hours.close_time:
-        return []
-    
-    # Get existing appointments for this date
-    existing_appointments = Appointment.objects.filter(
-        date=date,
-        status__in=['pending', 'confirmed']
-    ).values_list('time', 'duration')
-    
-    # Generate time slots (30-minute intervals)
-    slots = []
-    current_time = working_hours.open_time
-    
-    while current_time < working_hours.close_time:
-        # Check if this slot conflicts with existing appointments
-        slot_end = (datetime.combine(date, current_time) + timedelta(minutes=30)).time()
-        
-        # Check for conflicts
-        conflict = False
-        for appt_time, appt_duration in existing_appointments:
-            appt_end = (datetime.combine(date, appt_time) + timedelta(minutes=appt_duration)).time()
-            
-            # Check if slots overlap
-            if (current_time < appt_end and slot_end > appt_time):
-                conflict = True
-                break
+def get_next_available(request):
+    """Get the next available time slots for a service"""
+    try:
+        service_id = request.GET.get('service')
+        if not service_id:
+            return JsonResponse({'error': 'Service parameter is required'}, status=400)
+        
+        if not Service.objects.filter(id=service_id, is_active=True).exists():
+            return JsonResponse({'error': 'Selected service is not available'}, status=400)
+        
+        # Accept either a full datetime or a plain date; default to now
+        start_str = request.GET.get('start')
+        if not start_str:
+            start = timezone.localtime().replace(tzinfo=None)
+        elif 'T' in start_str:
+            start = datetime.strptime(start_str, '%Y-%m-%dT%H:%M')
+        else:
+            start = datetime.strptime(start_str, '%Y-%m-%d')
         
-        if not conflict:
-            slots.append(current_time.strftime('%H:%M'))
+        count = min(max(int(request.GET.get('count', 5)), 1), MAX_NEXT_AVAILABLE)
         
-        # Move to next slot
-        current_time = (datetime.combine(date, current_time) + timedelta(minutes=30)).time()
-    
-    return slots
+        return JsonResponse({
+            'next_available': find_next_available_slots(service_id, start, count)
+        })
+        
+    except ValueError:
+        return JsonResponse({'error': 'Invalid start or count parameter'}, status=400)
+    except Exception as e:
+        logger.error("Error getting next available slots: %s", e)
+        return JsonResponse({'error': 'An error occurred'}, status=500)
+
+def generate_time_slots(working_hours, date):
+    """Generate available time slots for a given date"""
+    schedule = get_schedule()
+    return get_free_slots(
+        date, working_hours.open_time, working_hours.close_time,
+        capacity=schedule.capacity, barber_ids=schedule.barber_ids
+    )
 
 def get_working_hours(request):
     """Get working hours for all days"""
     try:
-        working_hours = WorkingHours.objects.all().order_by('day')
+        working_hours = get_schedule().working_hours
         hours_data = {}
         
-        for wh in working_hours:
+        for day in sorted(working_hours):
+            wh = working_hours[day]
             hours_data[wh.day] = {
                 'is_open': wh.is_open,
                 'open_time': wh.open_time.strftime('%H:%M') if wh.open_time else None,
@@ -569,7 +611,7 @@ def get_working_hours(request):
         })
         
     except Exception as e:
-        logger.error(f"Error getting working hours: {e}")
+        logger.error("Error getting working hours: %s", e)
         return JsonResponse({
             'success': False,
             'error': 'An error occurred while fetching working hours.'
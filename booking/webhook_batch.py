@@ -0,0 +1,156 @@
+"""
+Batched handling of WhatsApp webhook deliveries.
+
+Under load Meta packs several entries, each with several changes, into one
+webhook delivery, and a change can carry many messages and status updates.
+WebhookBatch flattens a delivery into its messages and statuses and loads
+every appointment they refer to (by the appointment id in a button reply or
+by the sender's phone number) in a single query, so the handlers look them
+up in memory instead of querying once per message.
+
+The replies the handlers produce are collected as Reply objects and merged
+with coalesce_replies(): consecutive text replies to the same recipient go
+out as one message.
+"""
+import uuid
+import logging
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
+
+# WhatsApp's limit on the body of a text message
+TEXT_BODY_LIMIT = 4096
+
+# Prefixes of the interactive button ids in approval requests
+BUTTON_PREFIXES = ('approve_', 'deny_')
+
+
+class Reply:
+    """An outgoing Graph API payload and the callbacks to run once it is accepted"""
+
+    __slots__ = ('payload', 'callbacks')
+
+    def __init__(self, payload, callbacks=()):
+        self.payload = payload
+        self.callbacks = list(callbacks)
+
+    def sent(self, message_id):
+        for callback in self.callbacks:
+            callback(message_id)
+
+
+def button_appointment_id(message):
+    """Appointment id referenced by an approve/deny button reply, or None"""
+    if message.get('type') != 'interactive':
+        return None
+    button_id = message.get('interactive', {}).get('button_reply', {}).get('id', '')
+    for prefix in BUTTON_PREFIXES:
+        if button_id.startswith(prefix):
+            return normalize_appointment_id(button_id[len(prefix):])
+    return None
+
+
+def normalize_appointment_id(value):
+    """Canonical string form of an appointment UUID, or None if it is not one"""
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+class WebhookBatch:
+    """The messages and status updates of one webhook delivery and the appointments they refer to"""
+
+    def __init__(self, data):
+        self.messages = []
+        self.statuses = []
+        for entry in data.get('entry') or []:
+            for change in entry.get('changes') or []:
+                value = change.get('value') or {}
+                self.messages.extend(value.get('messages') or [])
+                self.statuses.extend(value.get('statuses') or [])
+
+        self.appointments_by_id = {}
+        self.appointments_by_phone = {}
+
+    def __bool__(self):
+        return bool(self.messages or self.statuses)
+
+    def preload(self):
+        """Load every referenced appointment, with its service, in one query"""
+        from .models import Appointment
+
+        appointment_ids = {button_appointment_id(message) for message in self.messages} - {None}
+        phones = {message['from'] for message in self.messages if message.get('from')}
+        if not appointment_ids and not phones:
+            return
+
+        appointments = Appointment.objects.select_related('service').filter(
+            Q(appointment_id__in=appointment_ids) | Q(phone__in=phones)
+        )
+        for appointment in appointments:
+            self.appointments_by_id[str(appointment.appointment_id)] = appointment
+            self.appointments_by_phone.setdefault(appointment.phone, []).append(appointment)
+
+    def remember(self, appointment):
+        """Replace the preloaded copy of an appointment a handler loaded and changed itself"""
+        self.appointments_by_id[str(appointment.appointment_id)] = appointment
+        same_phone = self.appointments_by_phone.get(appointment.phone)
+        if same_phone is not None:
+            same_phone[:] = [appointment if loaded.pk == appointment.pk else loaded for loaded in same_phone]
+
+    def appointment(self, appointment_id):
+        """Preloaded appointment with this id, or None"""
+        return self.appointments_by_id.get(normalize_appointment_id(appointment_id))
+
+    def latest_for_phone(self, phone_number):
+        """Most recent preloaded appointment booked with this phone number, or None"""
+        appointments = self.appointments_by_phone.get(phone_number, [])
+        return max(appointments, key=lambda appointment: (appointment.date, appointment.time), default=None)
+
+    def failed_message_ids(self):
+        """WhatsApp ids of outgoing messages reported as failed"""
+        return [status['id'] for status in self.statuses if status.get('status') == 'failed' and status.get('id')]
+
+
+def coalesce_replies(replies):
+    """
+    Merge consecutive text replies to the same recipient into one message.
+
+    A reply that is not plain text (e.g. interactive buttons) ends the run for
+    its recipient so messages never arrive out of order. Identical texts are
+    sent once, and a merged body never exceeds TEXT_BODY_LIMIT.
+    """
+    merged = []
+    # Recipient -> (merged reply, texts it already carries)
+    open_texts = {}
+
+    for reply in replies:
+        payload = reply.payload
+        recipient = payload.get('to')
+
+        if payload.get('type') != 'text':
+            open_texts.pop(recipient, None)
+            merged.append(reply)
+            continue
+
+        body = payload['text']['body']
+        if recipient in open_texts:
+            current, bodies = open_texts[recipient]
+            current_body = current.payload['text']['body']
+            if body in bodies:
+                current.callbacks.extend(reply.callbacks)
+                continue
+            if len(current_body) + len(body) + 2 <= TEXT_BODY_LIMIT:
+                current.payload['text']['body'] = f"{current_body}\n\n{body}"
+                current.callbacks.extend(reply.callbacks)
+                bodies.append(body)
+                continue
+
+        reply = Reply({**payload, 'text': {**payload['text']}}, reply.callbacks)
+        open_texts[recipient] = (reply, [body])
+        merged.append(reply)
+
+    if len(merged) < len(replies):
+        logger.info("Coalesced %s WhatsApp replies into %s", len(replies), len(merged))
+    return merged
@@ -2,88 +2,173 @@ from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, transaction
 from django.utils import timezone
+import contextvars
+import hashlib
+import hmac
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import requests
 from .models import Appointment
+from .ratelimit import rate_limit
+from .structured_logging import log_event, log_payload, mask_phone
+from .dedupe import claim_new_messages, is_redelivery
+from .inbound import processing_mode, record_inbound_event
+from .ledger import already_sent, record_delivery_failures, record_failed, record_sent
+from .notification_templates import render_notification
+from .notifications import enqueue_notifications
+from .webhook_batch import Reply, WebhookBatch, coalesce_replies
+from .whatsapp_commands import BARBER, COMMAND_ROUTER, UNKNOWN, role_for
+from .whatsapp import get_whatsapp_scheduler
 
 logger = logging.getLogger(__name__)
 
+# send_appointment_notification types and the WhatsApp templates they use
+WHATSAPP_NOTIFICATION_EVENTS = {
+    'pending': 'pending',
+    'confirmation': 'confirmed',
+    'reminder': 'reminder',
+    'cancellation': 'cancelled',
+    'completion': 'completed',
+}
+
+# Outgoing Graph API payloads collected while a webhook delivery is handled (see collect_replies)
+_reply_buffer = contextvars.ContextVar('whatsapp_reply_buffer', default=None)
+
+# Returned instead of True for a collected reply, which has not been sent yet
+REPLY_PENDING = object()
+
+# The delivery being handled by process_webhook_payload, with its preloaded appointments
+_webhook_batch = contextvars.ContextVar('whatsapp_webhook_batch', default=None)
+
+def signed_by_meta(request):
+    """Whether the body carries a valid X-Hub-Signature-256 made with WHATSAPP_APP_SECRET"""
+    secret = getattr(settings, 'WHATSAPP_APP_SECRET', '')
+    signature = request.headers.get('X-Hub-Signature-256', '')
+    if not secret or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(secret.encode(), request.body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature[len('sha256='):], expected)
+
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
+@rate_limit('webhook', exempt=signed_by_meta)
 def whatsapp_webhook(request):
     """WhatsApp webhook handler for both verification and incoming messages"""
-    logger.info(f"Webhook request: {request.method} {request.path} from {request.META.get('REMOTE_ADDR', 'unknown')}")
-    logger.info(f"Request headers: {dict(request.headers)}")
-    logger.info(f"Request GET params: {dict(request.GET)}")
-    """
-    Improved WhatsApp webhook handler that addresses all common issues:
-    1. CSRF exempt
-    2. Clean response format
-    3. Proper logging
-    4. No extra content in verification response
-    5. Better error handling
-    """
+    log_event(logger, logging.DEBUG, 'webhook.request', method=request.method, path=request.path,
+              remote=request.META.get('REMOTE_ADDR', 'unknown'), bytes=len(request.body))
+    log_payload(logger, 'Request headers', request.headers)
+    log_payload(logger, 'Request GET params', request.GET)
     
     if request.method == "GET":
-        # WhatsApp verification
-        mode = request.GET.get('hub.mode')
-        token = request.GET.get('hub.verify_token')
-        challenge = request.GET.get('hub.challenge')
-        
-        logger.info(f"Webhook verification request: mode={mode}, token={token}, challenge={challenge}")
-        
-        # Check if all required parameters are present
-        if not all([mode, token, challenge]):
-            logger.warning(f"Missing required parameters: mode={mode}, token={token}, challenge={challenge}")
-            # Return a more helpful error message for debugging
-            return HttpResponse(
-                'Bad Request: Missing required WhatsApp verification parameters. '
-                'Expected: hub.mode, hub.verify_token, hub.challenge', 
-                status=400, 
-                content_type='text/plain'
-            )
-        
-        # Verify the token
-        if mode == 'subscribe' and token == settings.WHATSAPP_VERIFY_TOKEN:
-            logger.info(f"Verification successful for token: {token}")
-            # Return ONLY the challenge string - this is critical!
-            return HttpResponse(challenge, content_type='text/plain')
-        else:
-            logger.warning(f"Verification failed: mode={mode}, token={token}, expected={settings.WHATSAPP_VERIFY_TOKEN}")
-            return HttpResponse('Forbidden', status=403, content_type='text/plain')
+        return verify_webhook(request)
     
-    elif request.method == "POST":
+    if request.method == "POST":
         try:
             # Parse incoming webhook data
             data = json.loads(request.body)
-            logger.info(f"Received webhook POST data: {json.dumps(data, indent=2)}")
             
-            # Process the webhook data
-            if 'entry' in data and len(data['entry']) > 0:
-                entry = data['entry'][0]
-                if 'changes' in entry and len(entry['changes']) > 0:
-                    change = entry['changes'][0]
-                    if 'value' in change and 'messages' in change['value']:
-                        messages = change['value']['messages']
-                        for message in messages:
-                            logger.info(f"Processing message: {message}")
-                            handle_whatsapp_message(message)
+            if is_redelivery(WebhookBatch(data).messages):
+                # Every message in it was handled already; just acknowledge it again
+                logger.info("Ignoring redelivered webhook event")
+            elif processing_mode() == 'inline':
+                log_payload(logger, 'Received webhook POST data', data)
+                process_webhook_payload(data)
+            else:
+                # Store the delivery and acknowledge it; the handlers run in the background
+                event = record_inbound_event(request.body, data)
+                logger.info("Queued webhook event %s from %s", event.pk, mask_phone(event.sender) if event.sender else 'status update')
             
             # Return simple OK response
             return HttpResponse('OK', content_type='text/plain')
             
         except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in webhook: {e}")
+            logger.error("Invalid JSON in webhook: %s", e)
             return HttpResponse('Invalid JSON', status=400, content_type='text/plain')
         except Exception as e:
-            logger.error(f"Error processing webhook: {e}")
+            logger.error("Error processing webhook: %s", e)
             return HttpResponse('Internal Error', status=500, content_type='text/plain')
     
     # This should never be reached due to @require_http_methods
     return HttpResponse('Method Not Allowed', status=405, content_type='text/plain')
 
+def verify_webhook(request):
+    """Answer the webhook verification handshake from Meta"""
+    # WhatsApp verification
+    mode = request.GET.get('hub.mode')
+    token = request.GET.get('hub.verify_token')
+    challenge = request.GET.get('hub.challenge')
+    
+    log_event(logger, logging.INFO, 'webhook.verify', mode=mode, token_present=bool(token), challenge=challenge)
+    
+    # Check if all required parameters are present
+    if not all([mode, token, challenge]):
+        logger.warning("Missing required parameters: mode=%s, token present=%s, challenge=%s", mode, bool(token), challenge)
+        # Return a more helpful error message for debugging
+        return HttpResponse(
+            'Bad Request: Missing required WhatsApp verification parameters. '
+            'Expected: hub.mode, hub.verify_token, hub.challenge', 
+            status=400, 
+            content_type='text/plain'
+        )
+    
+    # Verify the token
+    if mode == 'subscribe' and token == settings.WHATSAPP_VERIFY_TOKEN:
+        logger.info("Webhook verification successful")
+        # Return ONLY the challenge string - this is critical!
+        return HttpResponse(challenge, content_type='text/plain')
+    else:
+        logger.warning("Verification failed: mode=%s, token does not match WHATSAPP_VERIFY_TOKEN", mode)
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+
+def process_webhook_payload(data):
+    """
+    Handle every message and status update in a webhook delivery as one batch.
+    
+    All entries and changes are handled in a single transaction, with the
+    appointments they refer to loaded in one query. Messages that were
+    already handled (Meta redelivers them) are dropped first. The replies they trigger
+    are merged per recipient and sent once the transaction commits, or handed
+    to the enclosing collect_replies() block.
+    """
+    batch = WebhookBatch(data)
+    if not batch:
+        return
+    
+    outer_replies = _reply_buffer.get()
+    token = _webhook_batch.set(batch)
+    try:
+        with collect_replies() as replies, transaction.atomic():
+            batch.messages = claim_new_messages(batch.messages)
+            batch.preload()
+            for message in batch.messages:
+                log_payload(logger, 'Processing message', message)
+                handle_whatsapp_message(message)
+            if batch.statuses:
+                handle_message_statuses(batch)
+    finally:
+        _webhook_batch.reset(token)
+    
+    replies = coalesce_replies(replies)
+    if outer_replies is not None:
+        outer_replies.extend(replies)
+    elif replies:
+        transaction.on_commit(partial(send_replies, replies))
+
+def handle_message_statuses(batch):
+    """Record delivery failures reported for our outgoing messages"""
+    failed_ids = batch.failed_message_ids()
+    logger.info("Received %s message status update(s), %s failed", len(batch.statuses), len(failed_ids))
+    if failed_ids:
+        reset = record_delivery_failures(failed_ids)
+        logger.warning("WhatsApp could not deliver %s message(s); %s notification(s) can be sent again", len(failed_ids), reset)
+
 def handle_whatsapp_message(message):
     """Handle incoming WhatsApp message with improved logic"""
     try:
@@ -91,85 +176,92 @@ def handle_whatsapp_message(message):
         from_number = message.get('from')
         message_type = message.get('type')
         timestamp = message.get('timestamp')
+        role = role_for(from_number)
         
-        logger.info(f"Processing {message_type} message from {from_number}")
+        log_event(logger, logging.DEBUG, 'webhook.message', type=message_type, sender=mask_phone(from_number), id=message.get('id', ''))
         
         if message_type == 'text':
             text = message.get('text', {}).get('body', '').lower()
-            logger.info(f"Text message: {text}")
+            logger.debug("Text message: %s", text[:200])
             
-            # Handle different types of text messages
-            if 'cancel' in text or 'cancelar' in text:
-                handle_cancellation_request(from_number, text)
-            elif 'confirm' in text or 'confirmar' in text:
-                handle_confirmation_request(from_number, text)
-            elif 'status' in text or 'estado' in text:
-                handle_status_request(from_number, text)
-            elif 'help' in text or 'ayuda' in text:
-                send_help_message(from_number)
-            elif 'approve' in text or 'approve' in text:
-                handle_approval_request(from_number, text)
-            elif 'deny' in text or 'reject' in text:
-                handle_rejection_request(from_number, text)
-            elif 'pending' in text or 'list' in text:
-                handle_pending_appointments_request(from_number, text)
-            else:
-                send_default_response(from_number)
+            handle_text_command(from_number, text, role)
         
         elif message_type == 'interactive':
             # Handle button responses
             interactive = message.get('interactive', {})
             if interactive.get('type') == 'button_reply':
                 button_id = interactive.get('button_reply', {}).get('id', '')
-                logger.info(f"Button response: {button_id}")
+                logger.debug("Button response: %s", button_id)
                 
                 if button_id.startswith('approve_'):
                     appointment_id = button_id.replace('approve_', '')
-                    handle_button_approval(from_number, appointment_id)
+                    handle_button_approval(from_number, appointment_id, role)
                 elif button_id.startswith('deny_'):
                     appointment_id = button_id.replace('deny_', '')
-                    handle_button_rejection(from_number, appointment_id)
+                    handle_button_rejection(from_number, appointment_id, role)
                 else:
-                    logger.warning(f"Unknown button ID: {button_id}")
+                    logger.warning("Unknown button ID: %s", button_id)
                 
     except Exception as e:
-        logger.error(f"Error handling WhatsApp message: {e}")
+        logger.error("Error handling WhatsApp message: %s", e)
+
+def handle_text_command(phone_number, text, role):
+    """Run the handler for the command in a text message, if the sender's role may use it"""
+    command = COMMAND_ROUTER.match(text)
+    name = command.name if command else UNKNOWN
+    logger.debug("Routing %s message to command: %s", role, name)
+    
+    started = time.perf_counter()
+    ok = False
+    try:
+        if command is None:
+            send_default_response(phone_number)
+        elif role not in command.roles:
+            send_whatsapp_message(phone_number, command.denied_message)
+        else:
+            TEXT_COMMAND_HANDLERS[command.name](phone_number, text, role)
+        ok = True
+    finally:
+        COMMAND_ROUTER.record(name, role, time.perf_counter() - started, ok)
 
-def handle_cancellation_request(phone_number, message_text):
+def handle_cancellation_request(phone_number, message_text, role):
     """Handle appointment cancellation requests"""
     try:
         # Extract appointment ID from message if present
         # This is a simplified version - you can enhance it
-        logger.info(f"Handling cancellation request from {phone_number}")
+        logger.debug("Handling cancellation request from %s", mask_phone(phone_number))
         
         # Send cancellation confirmation
         response_text = "To cancel your appointment, please contact us directly or use the cancellation link in your confirmation email."
         send_whatsapp_message(phone_number, response_text)
         
     except Exception as e:
-        logger.error(f"Error handling cancellation request: {e}")
+        logger.error("Error handling cancellation request: %s", e)
 
-def handle_confirmation_request(phone_number, message_text):
+def handle_confirmation_request(phone_number, message_text, role):
     """Handle appointment confirmation requests"""
     try:
-        logger.info(f"Handling confirmation request from {phone_number}")
+        logger.debug("Handling confirmation request from %s", mask_phone(phone_number))
         
         response_text = "To confirm your appointment, please check your email for the confirmation link or contact us directly."
         send_whatsapp_message(phone_number, response_text)
         
     except Exception as e:
-        logger.error(f"Error handling confirmation request: {e}")
+        logger.error("Error handling confirmation request: %s", e)
 
-def handle_status_request(phone_number, message_text):
+def handle_status_request(phone_number, message_text, role):
     """Handle appointment status requests"""
     try:
-        logger.info(f"Handling status request from {phone_number}")
+        logger.debug("Handling status request from %s", mask_phone(phone_number))
         
-        # Find appointments for this phone number
-        appointments = Appointment.objects.filter(phone=phone_number).order_by('-date', '-time')
+        # Find the latest appointment for this phone number
+        batch = _webhook_batch.get()
+        if batch is not None:
+            latest = batch.latest_for_phone(phone_number)
+        else:
+            latest = Appointment.objects.select_related('service').filter(phone=phone_number).order_by('-date', '-time').first()
         
-        if appointments.exists():
-            latest = appointments.first()
+        if latest:
             status_text = f"Your latest appointment: {latest.service.name} on {latest.date} at {latest.time} - Status: {latest.get_status_display()}"
         else:
             status_text = "No appointments found for this phone number. Please check your booking details."
@@ -177,15 +269,11 @@ def handle_status_request(phone_number, message_text):
         send_whatsapp_message(phone_number, status_text)
         
     except Exception as e:
-        logger.error(f"Error handling status request: {e}")
+        logger.error("Error handling status request: %s", e)
 
-def send_help_message(phone_number):
-    """Send help message with available commands"""
-    # Check if this is the barber's number (normalize both numbers)
-    barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-    incoming_number = str(phone_number).replace('+', '').replace(' ', '')
-    
-    if incoming_number == barber_number:
+def send_help_message(phone_number, role):
+    """Send help message with the commands available to the sender's role"""
+    if role == BARBER:
         help_text = """Barber Commands:
 • 'approve' - Approve pending appointment
 • 'deny' - Reject pending appointment
@@ -210,18 +298,12 @@ def send_default_response(phone_number):
     default_text = "Thank you for your message. Type 'help' to see available commands or contact us directly for assistance."
     send_whatsapp_message(phone_number, default_text)
 
-def handle_approval_request(phone_number, message_text):
+def handle_approval_request(phone_number, message_text, role):
     """Handle appointment approval requests from barber"""
     try:
-        logger.info(f"Handling approval request from barber: {phone_number}")
-        
-        # Check if this is the barber's number (normalize both numbers)
-        barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-        incoming_number = str(phone_number).replace('+', '').replace(' ', '')
+        logger.info("Handling approval request from barber: %s", mask_phone(phone_number))
         
-        logger.info(f"Checking authorization: incoming={incoming_number}, barber={barber_number}")
-        
-        if incoming_number == barber_number:
+        if role == BARBER:
             # Find pending appointments
             pending_appointments = Appointment.objects.filter(status='pending').order_by('date', 'time')
             
@@ -233,44 +315,30 @@ def handle_approval_request(phone_number, message_text):
                 appointment.status = 'confirmed'
                 appointment.confirmed_at = timezone.now()
                 appointment.save()
+                remember_appointment(appointment)
                 
-                # Send confirmation to customer
-                send_appointment_notification(appointment, "confirmation")
-                
-                # Send confirmation email to customer
-                try:
-                    from .utils import send_status_confirmation_email
-                    email_sent = send_status_confirmation_email(appointment)
-                    if email_sent:
-                        logger.info(f"Confirmation email sent successfully to {appointment.email}")
-                    else:
-                        logger.warning(f"Failed to send confirmation email to {appointment.email}")
-                except Exception as e:
-                    logger.error(f"Failed to send confirmation email: {e}")
+                # Queue the customer's WhatsApp and email confirmation; delivered once the status change commits
+                enqueue_notifications(appointment, 'confirmed')
                 
                 # Send confirmation to barber
                 barber_message = f"Appointment approved!\n\nCustomer: {appointment.name}\nService: {appointment.service.name}\nDate: {appointment.date}\nTime: {appointment.time.strftime('%I:%M %p')}\n\nCustomer has been notified."
                 send_whatsapp_message(phone_number, barber_message)
                 
-                logger.info(f"Appointment {appointment.id} approved by barber")
+                logger.info("Appointment %s approved by barber", appointment.id)
             else:
                 send_whatsapp_message(phone_number, "No pending appointments to approve.")
         else:
             send_whatsapp_message(phone_number, "You are not authorized to approve appointments.")
             
     except Exception as e:
-        logger.error(f"Error handling approval request: {e}")
+        logger.error("Error handling approval request: %s", e)
 
-def handle_rejection_request(phone_number, message_text):
+def handle_rejection_request(phone_number, message_text, role):
     """Handle appointment rejection requests from barber"""
     try:
-        logger.info(f"Handling rejection request from barber: {phone_number}")
-        
-        # Check if this is the barber's number (normalize both numbers)
-        barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-        incoming_number = str(phone_number).replace('+', '').replace(' ', '')
+        logger.info("Handling rejection request from barber: %s", mask_phone(phone_number))
         
-        if incoming_number == barber_number:
+        if role == BARBER:
             # Find pending appointments
             pending_appointments = Appointment.objects.filter(status='pending').order_by('date', 'time')
             
@@ -281,48 +349,33 @@ def handle_rejection_request(phone_number, message_text):
                 # Update appointment status to cancelled
                 appointment.status = 'cancelled'
                 appointment.save()
+                remember_appointment(appointment)
                 
-                # Send cancellation to customer
-                send_appointment_notification(appointment, "cancellation")
-                
-                # Send cancellation email to customer
-                try:
-                    from .utils import send_status_cancellation_email
-                    email_sent = send_status_cancellation_email(appointment)
-                    if email_sent:
-                        logger.info(f"Cancellation email sent successfully to {appointment.email}")
-                    else:
-                        logger.warning(f"Failed to send cancellation email to {appointment.email}")
-                except Exception as e:
-                    logger.error(f"Failed to send cancellation email: {e}")
+                # Queue the customer's WhatsApp and email cancellation; delivered once the status change commits
+                enqueue_notifications(appointment, 'cancelled')
                 
                 # Send confirmation to barber
                 barber_message = f"Appointment rejected!\n\nCustomer: {appointment.name}\nService: {appointment.service.name}\nDate: {appointment.date}\nTime: {appointment.time.strftime('%I:%M %p')}\n\nCustomer has been notified."
                 send_whatsapp_message(phone_number, barber_message)
                 
-                logger.info(f"Appointment {appointment.id} rejected by barber")
+                logger.info("Appointment %s rejected by barber", appointment.id)
             else:
                 send_whatsapp_message(phone_number, "No pending appointments to reject.")
         else:
             send_whatsapp_message(phone_number, "You are not authorized to reject appointments.")
             
     except Exception as e:
-        logger.error(f"Error handling rejection request: {e}")
+        logger.error("Error handling rejection request: %s", e)
 
-def handle_button_approval(phone_number, appointment_id):
+def handle_button_approval(phone_number, appointment_id, role):
     """Handle button approval for specific appointment"""
     try:
-        logger.info(f"Handling button approval from barber: {phone_number} for appointment: {appointment_id}")
-        
-        # Check if this is the barber's number (normalize both numbers)
-        barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-        incoming_number = str(phone_number).replace('+', '').replace(' ', '')
+        logger.info("Handling button approval from barber: %s for appointment: %s", mask_phone(phone_number), appointment_id)
         
-        if incoming_number == barber_number:
+        if role == BARBER:
             # Find the specific appointment
-            try:
-                appointment = Appointment.objects.get(appointment_id=appointment_id, status='pending')
-            except Appointment.DoesNotExist:
+            appointment = find_pending_appointment(appointment_id)
+            if appointment is None:
                 send_whatsapp_message(phone_number, f"Appointment {appointment_id} not found or already processed.")
                 return
             
@@ -331,19 +384,8 @@ def handle_button_approval(phone_number, appointment_id):
             appointment.confirmed_at = timezone.now()
             appointment.save()
             
-            # Send confirmation to customer
-            send_appointment_notification(appointment, "confirmation")
-            
-            # Send confirmation email to customer
-            try:
-                from .utils import send_status_confirmation_email
-                email_sent = send_status_confirmation_email(appointment)
-                if email_sent:
-                    logger.info(f"Confirmation email sent successfully to {appointment.email}")
-                else:
-                    logger.warning(f"Failed to send confirmation email to {appointment.email}")
-            except Exception as e:
-                logger.error(f"Failed to send confirmation email: {e}")
+            # Queue the customer's WhatsApp and email confirmation; delivered once the status change commits
+            enqueue_notifications(appointment, 'confirmed')
             
             # Send confirmation to barber
             barber_message = f"Appointment approved!\n\nCustomer: {appointment.name}\nService: {appointment.service.name}\nDate: {appointment.date}\nTime: {appointment.time.strftime('%I:%M %p')}\n\nCustomer has been notified."
@@ -352,27 +394,22 @@ def handle_button_approval(phone_number, appointment_id):
             # Send button disabled message to indicate action is complete
             send_button_disabled_message(phone_number, appointment_id, "approved")
             
-            logger.info(f"Appointment {appointment_id} approved by barber via button")
+            logger.info("Appointment %s approved by barber via button", appointment_id)
         else:
             send_whatsapp_message(phone_number, "You are not authorized to approve appointments.")
             
     except Exception as e:
-        logger.error(f"Error handling button approval: {e}")
+        logger.error("Error handling button approval: %s", e)
 
-def handle_button_rejection(phone_number, appointment_id):
+def handle_button_rejection(phone_number, appointment_id, role):
     """Handle button rejection for specific appointment"""
     try:
-        logger.info(f"Handling button rejection from barber: {phone_number} for appointment: {appointment_id}")
+        logger.info("Handling button rejection from barber: %s for appointment: %s", mask_phone(phone_number), appointment_id)
         
-        # Check if this is the barber's number (normalize both numbers)
-        barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-        incoming_number = str(phone_number).replace('+', '').replace(' ', '')
-        
-        if incoming_number == barber_number:
+        if role == BARBER:
             # Find the specific appointment
-            try:
-                appointment = Appointment.objects.get(appointment_id=appointment_id, status='pending')
-            except Appointment.DoesNotExist:
+            appointment = find_pending_appointment(appointment_id)
+            if appointment is None:
                 send_whatsapp_message(phone_number, f"Appointment {appointment_id} not found or already processed.")
                 return
             
@@ -380,19 +417,8 @@ def handle_button_rejection(phone_number, appointment_id):
             appointment.status = 'cancelled'
             appointment.save()
             
-            # Send cancellation to customer
-            send_appointment_notification(appointment, "cancellation")
-            
-            # Send cancellation email to customer
-            try:
-                from .utils import send_status_cancellation_email
-                email_sent = send_status_cancellation_email(appointment)
-                if email_sent:
-                    logger.info(f"Cancellation email sent successfully to {appointment.email}")
-                else:
-                    logger.warning(f"Failed to send cancellation email to {appointment.email}")
-            except Exception as e:
-                logger.error(f"Failed to send cancellation email: {e}")
+            # Queue the customer's WhatsApp and email cancellation; delivered once the status change commits
+            enqueue_notifications(appointment, 'cancelled')
             
             # Send confirmation to barber
             barber_message = f"Appointment rejected!\n\nCustomer: {appointment.name}\nService: {appointment.service.name}\nDate: {appointment.date}\nTime: {appointment.time.strftime('%I:%M %p')}\n\nCustomer has been notified."
@@ -401,25 +427,21 @@ def handle_button_rejection(phone_number, appointment_id):
             # Send button disabled message to indicate action is complete
             send_button_disabled_message(phone_number, appointment_id, "rejected")
             
-            logger.info(f"Appointment {appointment_id} rejected by barber via button")
+            logger.info("Appointment %s rejected by barber via button", appointment_id)
         else:
             send_whatsapp_message(phone_number, "You are not authorized to reject appointments.")
             
     except Exception as e:
-        logger.error(f"Error handling button rejection: {e}")
+        logger.error("Error handling button rejection: %s", e)
 
-def handle_pending_appointments_request(phone_number, message_text):
+def handle_pending_appointments_request(phone_number, message_text, role):
     """Handle request to list pending appointments"""
     try:
-        logger.info(f"Handling pending appointments request from: {phone_number}")
-        
-        # Check if this is the barber's number (normalize both numbers)
-        barber_number = str(settings.BARBER_WHATSAPP).replace('+', '').replace(' ', '')
-        incoming_number = str(phone_number).replace('+', '').replace(' ', '')
+        logger.debug("Handling pending appointments request from: %s", mask_phone(phone_number))
         
-        if incoming_number == barber_number:
+        if role == BARBER:
             # Find all pending appointments
-            pending_appointments = Appointment.objects.filter(status='pending').order_by('date', 'time')
+            pending_appointments = Appointment.objects.select_related('service').filter(status='pending').order_by('date', 'time')
             
             if pending_appointments.exists():
                 message = "Pending Appointments:\n\n"
@@ -442,34 +464,134 @@ def handle_pending_appointments_request(phone_number, message_text):
             send_whatsapp_message(phone_number, "You are not authorized to view pending appointments.")
             
     except Exception as e:
-        logger.error(f"Error handling pending appointments request: {e}")
+        logger.error("Error handling pending appointments request: %s", e)
+
+# Handlers for the commands declared in booking.whatsapp_commands, called with the sender's resolved role
+TEXT_COMMAND_HANDLERS = {
+    'cancel': handle_cancellation_request,
+    'confirm': handle_confirmation_request,
+    'status': handle_status_request,
+    'help': lambda phone_number, message_text, role: send_help_message(phone_number, role),
+    'approve': handle_approval_request,
+    'deny': handle_rejection_request,
+    'pending': handle_pending_appointments_request,
+}
+
+def find_pending_appointment(appointment_id):
+    """Pending appointment with this id, from the current webhook batch when there is one; None if not found"""
+    batch = _webhook_batch.get()
+    if batch is not None:
+        appointment = batch.appointment(appointment_id)
+        return appointment if appointment is not None and appointment.status == 'pending' else None
+    try:
+        return Appointment.objects.select_related('service').get(appointment_id=appointment_id, status='pending')
+    except (Appointment.DoesNotExist, ValidationError):
+        return None
+
+def remember_appointment(appointment):
+    """Let the current webhook batch see a status change made from a text command"""
+    batch = _webhook_batch.get()
+    if batch is not None:
+        batch.remember(appointment)
+
+@contextmanager
+def collect_replies():
+    """
+    Collect WhatsApp messages sent inside the block as Reply objects
+    instead of posting them.
+    
+    Used by process_webhook_payload to merge a delivery's replies, and by the
+    async webhook, which runs the synchronous handlers and then sends the
+    collected payloads concurrently with an async HTTP client.
+    """
+    replies = []
+    token = _reply_buffer.set(replies)
+    try:
+        yield replies
+    finally:
+        _reply_buffer.reset(token)
+
+@contextmanager
+def send_immediately():
+    """
+    Post WhatsApp messages sent inside the block straight away, even inside
+    collect_replies(), so the caller sees whether they were accepted.
+    
+    Used for outbox deliveries, whose rows are settled from the send result.
+    """
+    token = _reply_buffer.set(None)
+    try:
+        yield
+    finally:
+        _reply_buffer.reset(token)
+
+def format_whatsapp_phone(phone_number):
+    """Format a phone number (or an Appointment) for the WhatsApp API"""
+    if hasattr(phone_number, 'get_whatsapp_phone'):
+        # If it's an Appointment object, use the method
+        return phone_number.get_whatsapp_phone()
+    
+    # If it's a string, format it manually
+    digits = ''.join(filter(str.isdigit, str(phone_number)))
+    if len(digits) == 10:
+        return f"+91{digits}"
+    elif len(digits) > 10:
+        return f"+{digits}"
+    return phone_number
+
+def post_whatsapp_payload(payload, label='WhatsApp', on_sent=None):
+    """
+    Send a Graph API message payload through the rate-aware scheduler;
+    returns True on success. on_sent, if given, is called with the WhatsApp
+    message ID once the message is accepted.
+    
+    Inside collect_replies() the payload is only collected and REPLY_PENDING
+    is returned; on_sent runs if and when the reply is actually sent.
+    """
+    replies = _reply_buffer.get()
+    if replies is not None:
+        replies.append(Reply(payload, [on_sent] if on_sent else []))
+        return REPLY_PENDING
+    
+    result = get_whatsapp_scheduler().send(payload)
+    
+    log_event(logger, logging.DEBUG, 'whatsapp.response', label=label, status=result.status_code,
+              elapsed_ms=round(result.elapsed * 1000), error_code=result.error_code or '')
+    
+    if result.ok:
+        logger.info("%s message sent successfully to %s (ID: %s)", label, mask_phone(payload['to']), result.message_id or 'Unknown')
+        if on_sent:
+            on_sent(result.message_id)
+        return True
+    elif result.status_code == 400 and result.error_code == 131030:  # Recipient not in allowed list
+        logger.warning("%s: Phone number %s not in allowed list. This is normal during development. Error: %s", label, mask_phone(payload['to']), result.error_message)
+    elif result.status_code == 400 and result.error_code == 100:  # Invalid parameter
+        logger.error("%s: Invalid parameter - %s", label, result.error_message)
+    elif result.error_code is not None:
+        logger.error("%s API error %s: %s", label, result.error_code, result.error_message)
+    else:
+        logger.error("%s API error: %s - %s", label, result.status_code, result.error_message)
+    return False
+
+def send_replies(replies):
+    """Send collected webhook replies, concurrently when there are several; returns how many succeeded"""
+    def send(reply):
+        try:
+            return post_whatsapp_payload(reply.payload, on_sent=reply.sent)
+        finally:
+            if len(replies) > 1:
+                close_old_connections()
+    
+    if len(replies) == 1:
+        return int(send(replies[0]))
+    with ThreadPoolExecutor(max_workers=min(len(replies), settings.WHATSAPP_POOL_SIZE), thread_name_prefix='webhook-replies') as executor:
+        return sum(executor.map(send, replies))
 
-def send_whatsapp_message(phone_number, message_text):
+def send_whatsapp_message(phone_number, message_text, on_sent=None):
     """Send WhatsApp message with improved error handling"""
     try:
-        # Format phone number for WhatsApp
-        if hasattr(phone_number, 'get_whatsapp_phone'):
-            # If it's an Appointment object, use the method
-            formatted_phone = phone_number.get_whatsapp_phone()
-        else:
-            # If it's a string, format it manually
-            digits = ''.join(filter(str.isdigit, str(phone_number)))
-            if len(digits) == 10:
-                formatted_phone = f"+91{digits}"
-            elif len(digits) > 10:
-                formatted_phone = f"+{digits}"
-            else:
-                formatted_phone = phone_number
-        
-        logger.info(f"Sending WhatsApp message to: {formatted_phone}")
-        
-        # WhatsApp Business API endpoint
-        url = f"https://graph.facebook.com/v20.0/{settings.PHONE_NUMBER_ID}/messages"
-        
-        headers = {
-            "Authorization": f"Bearer {settings.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        formatted_phone = format_whatsapp_phone(phone_number)
+        logger.debug("Sending WhatsApp message to: %s", mask_phone(formatted_phone))
         
         payload = {
             "messaging_product": "whatsapp",
@@ -478,175 +600,75 @@ def send_whatsapp_message(phone_number, message_text):
             "text": {"body": message_text}
         }
         
-        logger.info(f"WhatsApp API Request: {json.dumps(payload, indent=2)}")
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        log_payload(logger, 'WhatsApp API Request', payload)
         
-        logger.info(f"WhatsApp API Response: {response.status_code} - {response.text}")
-        
-        if response.status_code == 200:
-            data = response.json()
-            message_id = data.get('messages', [{}])[0].get('id', 'Unknown')
-            logger.info(f"WhatsApp message sent successfully to {formatted_phone} (ID: {message_id})")
-            return True
-        elif response.status_code == 400:
-            # Check for specific error types
-            try:
-                error_data = response.json()
-                error_code = error_data.get('error', {}).get('code')
-                error_message = error_data.get('error', {}).get('message', '')
-                
-                if error_code == 131030:  # Recipient not in allowed list
-                    logger.warning(f"WhatsApp: Phone number {formatted_phone} not in allowed list. This is normal during development. Error: {error_message}")
-                    return False
-                elif error_code == 100:  # Invalid parameter
-                    logger.error(f"WhatsApp: Invalid parameter - {error_message}")
-                    return False
-                else:
-                    logger.error(f"WhatsApp API error {error_code}: {error_message}")
-                    return False
-            except:
-                logger.error(f"WhatsApp API error: {response.status_code} - {response.text}")
-                return False
-        else:
-            logger.error(f"WhatsApp API error: {response.status_code} - {response.text}")
-            return False
+        return post_whatsapp_payload(payload, on_sent=on_sent)
             
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout sending WhatsApp message to {phone_number}")
+        logger.error("Timeout sending WhatsApp message to %s", mask_phone(phone_number))
         return False
     except requests.exceptions.RequestException as e:
-        logger.error(f"Request error sending WhatsApp message: {e}")
+        logger.error("Request error sending WhatsApp message: %s", e)
         return False
     except Exception as e:
-        logger.error(f"Error sending WhatsApp message: {e}")
+        logger.error("Error sending WhatsApp message: %s", e)
         return False
 
 def send_appointment_notification(appointment, notification_type="confirmation"):
     """Send appointment notifications via WhatsApp with fallback handling"""
     try:
         phone_number = appointment.get_whatsapp_phone()
-        logger.info(f"Sending {notification_type} notification to: {phone_number}")
+        logger.info("Sending %s notification to: %s", notification_type, mask_phone(phone_number))
         
-        if notification_type == "pending":
-            message = f"""Appointment Request Submitted
-
-Hi {appointment.name},
-
-Your appointment request has been submitted successfully!
-
-Service: {appointment.service.name}
-Date: {appointment.date}
-Time: {appointment.time.strftime('%I:%M %p')}
-Duration: {appointment.get_duration_display()}
-Status: Pending Approval
-
-The barber will review your request and send you a confirmation shortly.
-
-Best regards,
-FitBlendz Team"""
-        
-        elif notification_type == "confirmation":
-            message = f"""Appointment Confirmed!
-
-Hi {appointment.name},
-
-Your appointment for {appointment.service.name} has been confirmed for {appointment.date} at {appointment.time.strftime('%I:%M %p')}.
-
-Duration: {appointment.get_duration_display()}
-Status: Confirmed
-
-We look forward to seeing you!
-
-Best regards,
-FitBlendz Team"""
+        event = WHATSAPP_NOTIFICATION_EVENTS.get(notification_type, 'update')
         
-        elif notification_type == "reminder":
-            message = f"""Appointment Reminder!
-
-Hi {appointment.name},
-
-This is a friendly reminder about your appointment tomorrow:
-
-Service: {appointment.service.name}
-Date: {appointment.date}
-Time: {appointment.time.strftime('%I:%M %p')}
-
-Please arrive 10 minutes early.
-
-See you soon!
-FitBlendz Team"""
+        # Each event's message goes out once; generic updates are not tracked
+        tracked = event != 'update'
+        if tracked and already_sent(appointment, 'whatsapp', event):
+            logger.info("WhatsApp %s notification already sent for appointment %s, skipping", event, appointment.id)
+            return True
         
-        elif notification_type == "cancellation":
-            message = f"""Appointment Cancelled
-
-Hi {appointment.name},
-
-Your appointment for {appointment.service.name} on {appointment.date} at {appointment.time.strftime('%I:%M %p')} has been cancelled.
-
-To reschedule, please visit our website or contact us directly.
-
-We apologize for any inconvenience.
-
-FitBlendz Team"""
+        def on_sent(message_id):
+            mark_whatsapp_sent(appointment)
+            if tracked:
+                record_sent(appointment, 'whatsapp', event, message_id)
         
-        else:
-            message = f"""Appointment Update
-
-Hi {appointment.name},
-
-Your appointment details:
-Service: {appointment.service.name}
-Date: {appointment.date}
-Time: {appointment.time.strftime('%I:%M %p')}
-Status: {appointment.get_status_display()}
-
-FitBlendz Team"""
+        message = render_notification('whatsapp', event, appointment).text
         
         # Send the message
-        success = send_whatsapp_message(phone_number, message)
+        success = send_whatsapp_message(phone_number, message, on_sent=on_sent)
         
-        if success:
-            # Update appointment record
-            appointment.whatsapp_sent = True
-            appointment.whatsapp_sent_at = timezone.now()
-            appointment.save()
-            logger.info(f"WhatsApp notification sent successfully for appointment {appointment.id}")
+        if success is REPLY_PENDING:
+            logger.info("WhatsApp notification for appointment %s will be sent with the webhook replies", appointment.id)
+        elif success:
+            logger.info("WhatsApp notification sent successfully for appointment %s", appointment.id)
         else:
             # WhatsApp failed - this is normal during development
-            logger.warning(f"WhatsApp notification failed for appointment {appointment.id} - phone number may not be in allowed list")
-            # Don't mark as failed since this is expected during development
+            logger.warning("WhatsApp notification failed for appointment %s - phone number may not be in allowed list", appointment.id)
+            if tracked:
+                record_failed(appointment, 'whatsapp', event)
             
         return success
         
     except Exception as e:
-        logger.error(f"Error sending appointment notification: {e}")
+        logger.error("Error sending appointment notification: %s", e)
         return False
 
-def send_whatsapp_interactive_message(phone_number, message_text, appointment_id):
+def mark_whatsapp_sent(appointment):
+    """Flag that a WhatsApp message reached the customer"""
+    appointment.whatsapp_sent = True
+    appointment.whatsapp_sent_at = timezone.now()
+    # Update only the delivery fields so a concurrent status change is not overwritten
+    Appointment.objects.filter(pk=appointment.pk).update(
+        whatsapp_sent=True,
+        whatsapp_sent_at=appointment.whatsapp_sent_at
+    )
+
+def send_whatsapp_interactive_message(phone_number, message_text, appointment_id, on_sent=None):
     """Send WhatsApp interactive message with buttons"""
     try:
-        # Format phone number for WhatsApp
-        if hasattr(phone_number, 'get_whatsapp_phone'):
-            formatted_phone = phone_number.get_whatsapp_phone()
-        else:
-            digits = ''.join(filter(str.isdigit, str(phone_number)))
-            if len(digits) == 10:
-                formatted_phone = f"+91{digits}"
-            elif len(digits) > 10:
-                formatted_phone = f"+{digits}"
-            else:
-                formatted_phone = phone_number
-        
-        logger.info(f"Sending interactive WhatsApp message to: {formatted_phone}")
-        
-        # WhatsApp Business API endpoint
-        url = f"https://graph.facebook.com/v20.0/{settings.PHONE_NUMBER_ID}/messages"
-        
-        headers = {
-            "Authorization": f"Bearer {settings.WHATSAPP_TOKEN}",
-            "Content-Type": "application/json"
-        }
+        formatted_phone = format_whatsapp_phone(phone_number)
+        logger.debug("Sending interactive WhatsApp message to: %s", mask_phone(formatted_phone))
         
         payload = {
             "messaging_product": "whatsapp",
@@ -678,79 +700,48 @@ def send_whatsapp_interactive_message(phone_number, message_text, appointment_id
             }
         }
         
-        logger.info(f"Interactive WhatsApp API Request: {json.dumps(payload, indent=2)}")
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        
-        logger.info(f"Interactive WhatsApp API Response: {response.status_code} - {response.text}")
+        log_payload(logger, 'Interactive WhatsApp API Request', payload)
         
-        if response.status_code == 200:
-            data = response.json()
-            message_id = data.get('messages', [{}])[0].get('id', 'Unknown')
-            logger.info(f"Interactive WhatsApp message sent successfully to {formatted_phone} (ID: {message_id})")
-            return True
-        elif response.status_code == 400:
-            # Check for specific error types
-            try:
-                error_data = response.json()
-                error_code = error_data.get('error', {}).get('code')
-                error_message = error_data.get('error', {}).get('message', '')
-                
-                if error_code == 131030:  # Recipient not in allowed list
-                    logger.warning(f"WhatsApp Interactive: Phone number {formatted_phone} not in allowed list. This is normal during development. Error: {error_message}")
-                    return False
-                else:
-                    logger.error(f"WhatsApp Interactive API error {error_code}: {error_message}")
-                    return False
-            except:
-                logger.error(f"WhatsApp Interactive API error: {response.status_code} - {response.text}")
-                return False
-        else:
-            logger.error(f"WhatsApp Interactive API error: {response.status_code} - {response.text}")
-            return False
+        return post_whatsapp_payload(payload, label='Interactive WhatsApp', on_sent=on_sent)
             
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout sending interactive WhatsApp message to {phone_number}")
+        logger.error("Timeout sending interactive WhatsApp message to %s", mask_phone(phone_number))
         return False
     except requests.exceptions.RequestException as e:
-        logger.error(f"Request error sending interactive WhatsApp message: {e}")
+        logger.error("Request error sending interactive WhatsApp message: %s", e)
         return False
     except Exception as e:
-        logger.error(f"Error sending interactive WhatsApp message: {e}")
+        logger.error("Error sending interactive WhatsApp message: %s", e)
         return False
 
 def send_approval_request_to_barber(appointment):
     """Send approval request to barber for new appointment with interactive buttons"""
     try:
+        if already_sent(appointment, 'whatsapp', 'approval_request'):
+            logger.info("Approval request already sent for appointment %s, skipping", appointment.id)
+            return True
+        
         barber_phone = settings.BARBER_WHATSAPP
-        logger.info(f"Sending approval request to barber: {barber_phone}")
+        logger.info("Sending approval request to barber: %s", mask_phone(barber_phone))
         
-        # Format time with AM/PM
-        time_str = appointment.time.strftime('%I:%M %p')
-        
-        message = f"""New Appointment Request
-
-Customer: {appointment.name}
-Phone: {appointment.phone}
-Email: {appointment.email}
-Service: {appointment.service.name}
-Date: {appointment.date}
-Time: {time_str}
-Duration: {appointment.get_duration_display()}
-Notes: {appointment.notes or 'None'}
-
-Appointment ID: {appointment.appointment_id}"""
+        message = render_notification('whatsapp', 'approval_request', appointment).text
         
         # Send interactive message with buttons
-        success = send_whatsapp_interactive_message(barber_phone, message, appointment.appointment_id)
-        
-        if success:
-            logger.info(f"Interactive approval request sent to barber for appointment {appointment.id}")
+        success = send_whatsapp_interactive_message(
+            barber_phone, message, appointment.appointment_id,
+            on_sent=lambda message_id: record_sent(appointment, 'whatsapp', 'approval_request', message_id)
+        )
+        
+        if success is REPLY_PENDING:
+            logger.info("Approval request for appointment %s will be sent with the webhook replies", appointment.id)
+        elif success:
+            logger.info("Interactive approval request sent to barber for appointment %s", appointment.id)
         else:
-            logger.warning(f"Failed to send interactive approval request to barber for appointment {appointment.id} - this is normal during development")
+            logger.warning("Failed to send interactive approval request to barber for appointment %s - this is normal during development", appointment.id)
+            record_failed(appointment, 'whatsapp', 'approval_request')
             
         return success
         
     except Exception as e:
-        logger.error(f"Error sending approval request to barber: {e}")
+        logger.error("Error sending approval request to barber: %s", e)
         return False
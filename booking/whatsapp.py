@@ -0,0 +1,443 @@
+"""
+WhatsApp Cloud (Graph) API client.
+
+All outgoing WhatsApp messages go through one shared WhatsAppClient, whose
+requests.Session keeps connections to graph.facebook.com alive, so only the
+first message pays the DNS lookup, TCP connect and TLS handshake. The pool
+size and timeouts come from settings (WHATSAPP_POOL_SIZE,
+WHATSAPP_CONNECT_TIMEOUT, WHATSAPP_TIMEOUT), and every call can carry its
+own deadline. Each request is timed; client.metrics.snapshot() reports call
+counts, errors and latency percentiles.
+
+Sends go through the WhatsAppScheduler in front of the client, which keeps
+under Meta's throughput caps without knowing them in advance: an
+AdaptiveRateLimiter paces every send, raising the rate while sends succeed
+and halving it when the Graph API throttles us (HTTP 429, error codes 4,
+80007, 130429, 131056). A throttled message is not dropped; it waits out the
+backoff (or the Retry-After the API asked for) and is sent again, for up to
+WHATSAPP_THROTTLE_MAX_WAIT seconds. scheduler.snapshot() reports the current
+rate, queue depth and end-to-end send latency.
+"""
+import threading
+import time
+from collections import Counter, deque, namedtuple
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_BASE = 'https://graph.facebook.com'
+DEFAULT_API_VERSION = 'v20.0'
+
+# Number of recent request latencies kept for percentiles
+LATENCY_WINDOW = 1000
+
+# Graph API error codes meaning "slow down" rather than "this message is bad":
+# 4 (application request limit), 80007 (WhatsApp Business Account rate limit),
+# 130429 (Cloud API throughput reached) and 131056 (too many messages to one recipient)
+THROTTLE_ERROR_CODES = frozenset({4, 80007, 130429, 131056})
+
+# Longest single backoff after a throttling response without Retry-After, in seconds
+MAX_BACKOFF = 30
+
+GraphResponse = namedtuple(
+    'GraphResponse',
+    ['ok', 'status_code', 'data', 'error_code', 'error_message', 'message_id', 'elapsed', 'retry_after']
+)
+
+
+def is_throttled(status_code, error_code):
+    """Whether a Graph API response asks us to send more slowly"""
+    return status_code == 429 or error_code in THROTTLE_ERROR_CODES
+
+
+def parse_retry_after(headers):
+    """Seconds from a Retry-After header, or None"""
+    try:
+        return max(0.0, float(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+
+def graph_messages_url(phone_number_id=None, api_version=None):
+    """Graph API endpoint for sending messages from our business number"""
+    phone_number_id = phone_number_id or settings.PHONE_NUMBER_ID
+    api_version = api_version or getattr(settings, 'WHATSAPP_API_VERSION', DEFAULT_API_VERSION)
+    return f"{getattr(settings, 'WHATSAPP_API_BASE_URL', GRAPH_API_BASE)}/{api_version}/{phone_number_id}/messages"
+
+
+def graph_headers(token=None):
+    """Headers for authenticated Graph API requests"""
+    return {
+        "Authorization": f"Bearer {token or settings.WHATSAPP_TOKEN}",
+        "Content-Type": "application/json"
+    }
+
+
+class ClientMetrics:
+    """Thread-safe request counters and latency samples"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.total_seconds = 0.0
+            self.statuses = Counter()
+            self.latencies = deque(maxlen=self.window)
+
+    def record(self, status, elapsed, ok):
+        with self._lock:
+            self.requests += 1
+            self.total_seconds += elapsed
+            self.statuses[status] += 1
+            self.latencies.append(elapsed)
+            if not ok:
+                self.errors += 1
+
+    def snapshot(self):
+        """Return counts and latency percentiles (in milliseconds) as a dict"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            requests_made, errors, total = self.requests, self.errors, self.total_seconds
+            statuses = dict(self.statuses)
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+
+        return {
+            'requests': requests_made,
+            'errors': errors,
+            'statuses': statuses,
+            'avg_ms': total / requests_made * 1000 if requests_made else 0.0,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+        }
+
+
+class WhatsAppClient:
+    """Graph API client sharing one keep-alive connection pool across threads"""
+
+    def __init__(self, token=None, phone_number_id=None, api_version=None,
+                 pool_size=None, connect_timeout=None, timeout=None):
+        self.url = graph_messages_url(phone_number_id, api_version)
+        self.pool_size = pool_size or getattr(settings, 'WHATSAPP_POOL_SIZE', 10)
+        self.connect_timeout = connect_timeout or getattr(settings, 'WHATSAPP_CONNECT_TIMEOUT', 3.05)
+        self.timeout = timeout or getattr(settings, 'WHATSAPP_TIMEOUT', 10)
+        self.metrics = ClientMetrics()
+
+        self.session = requests.Session()
+        self.session.headers.update(graph_headers(token))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, payload, deadline=None):
+        """
+        POST a message payload and return a GraphResponse.
+
+        ``deadline`` caps the whole call in seconds, overriding the default
+        read timeout when shorter. Network errors propagate as
+        requests.RequestException after being counted.
+        """
+        read_timeout = self.timeout if deadline is None else max(0.1, min(self.timeout, deadline))
+        started = time.perf_counter()
+        try:
+            response = self.session.post(
+                self.url, json=payload, timeout=(min(self.connect_timeout, read_timeout), read_timeout)
+            )
+        except requests.RequestException as e:
+            elapsed = time.perf_counter() - started
+            self.metrics.record(type(e).__name__, elapsed, False)
+            logger.debug("Graph API request failed after %.0f ms: %s", elapsed * 1000, e)
+            raise
+
+        elapsed = time.perf_counter() - started
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+
+        error = data.get('error', {}) if isinstance(data, dict) else {}
+        ok = response.status_code == 200
+        result = GraphResponse(
+            ok=ok,
+            status_code=response.status_code,
+            data=data,
+            error_code=error.get('code'),
+            error_message=error.get('message', response.text if not ok else ''),
+            message_id=data.get('messages', [{}])[0].get('id') if ok and isinstance(data, dict) else None,
+            elapsed=elapsed,
+            retry_after=parse_retry_after(response.headers),
+        )
+
+        self.metrics.record(response.status_code, elapsed, ok)
+        logger.debug("Graph API POST %s in %.0f ms", response.status_code, elapsed * 1000)
+        return result
+
+    def send_text(self, to, body, deadline=None):
+        """Send a plain text message"""
+        return self.send({
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": body}
+        }, deadline=deadline)
+
+    def close(self):
+        self.session.close()
+
+
+class AdaptiveRateLimiter:
+    """
+    Shared send pacing with additive increase, multiplicative decrease.
+
+    Until the first throttle the rate doubles every second (slow start);
+    after that each success raises it by ``increase / rate``, i.e. by about
+    ``increase`` messages per second every second, up to ``max_rate``. A
+    throttling response multiplies it by ``decrease`` (down to
+    ``min_rate``) and pauses every sender, for the server's Retry-After or
+    else ``backoff`` seconds, doubled for each throttle in a row. Throttles
+    from requests already in flight during that pause count only once.
+    """
+
+    def __init__(self, rate, min_rate=1.0, max_rate=80.0, increase=5.0, decrease=0.5, backoff=0.25):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.backoff = backoff
+        self.consecutive = 0
+        self.waiting = 0
+        self.throttles = 0
+        self.slow_start = True
+        self._next_slot = time.monotonic()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Claim the next send slot; returns the seconds to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._resume_at)
+            self._next_slot = slot + 1.0 / self.rate
+        return slot - now
+
+    def _paused(self):
+        return time.monotonic() < self._resume_at
+
+    def _set_waiting(self, delta):
+        with self._lock:
+            self.waiting += delta
+
+    def acquire(self):
+        """Block until this thread may send"""
+        delay = self.reserve()
+        if delay <= 0:
+            return
+        self._set_waiting(1)
+        try:
+            # A throttle seen while we slept moves our slot back
+            while delay > 0:
+                time.sleep(delay)
+                delay = self.reserve() if self._paused() else 0
+        finally:
+            self._set_waiting(-1)
+
+    async def aacquire(self):
+        """Wait, without blocking the event loop, until this coroutine may send"""
+        import asyncio
+
+        delay = self.reserve()
+        if delay <= 0:
+            return
+        self._set_waiting(1)
+        try:
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.reserve() if self._paused() else 0
+        finally:
+            self._set_waiting(-1)
+
+    def succeeded(self):
+        with self._lock:
+            self.consecutive = 0
+            step = 1.0 if self.slow_start else self.increase / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def throttled(self, retry_after=None):
+        """Slow down and pause all senders; returns the pause in seconds"""
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            self.slow_start = False
+            if now >= self._resume_at:
+                self.consecutive += 1
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after is None:
+                delay = min(self.backoff * 2 ** (self.consecutive - 1), MAX_BACKOFF)
+            else:
+                delay = retry_after
+            self._resume_at = max(self._resume_at, now + delay)
+            # Drop the slots handed out at the old rate; senders re-queue after the pause
+            self._next_slot = self._resume_at
+        return delay
+
+
+class WhatsAppScheduler:
+    """Paces Graph API sends and retries throttled ones instead of dropping them"""
+
+    def __init__(self, limiter=None, max_wait=None):
+        self.limiter = limiter or AdaptiveRateLimiter(
+            rate=getattr(settings, 'WHATSAPP_RATE', 20),
+            min_rate=getattr(settings, 'WHATSAPP_MIN_RATE', 1),
+            max_rate=getattr(settings, 'WHATSAPP_MAX_RATE', 80),
+        )
+        self.max_wait = getattr(settings, 'WHATSAPP_THROTTLE_MAX_WAIT', 60) if max_wait is None else max_wait
+        self.metrics = ClientMetrics()
+        self.deferred = 0
+        self.retries = 0
+        self.given_up = 0
+        self._lock = threading.Lock()
+
+    def defer(self, attempt, started, status_code, error_code, retry_after=None):
+        """
+        Record a throttled attempt and slow the limiter down.
+
+        Returns True if the message should be retried, False once it has
+        waited for longer than max_wait.
+        """
+        delay = self.limiter.throttled(retry_after)
+
+        with self._lock:
+            if time.monotonic() - started + delay > self.max_wait:
+                self.given_up += 1
+                retry = False
+            else:
+                self.retries += 1
+                retry = True
+
+        if retry:
+            logger.info(
+                "Graph API throttled (%s); retrying in %.1fs, rate now %.1f msg/s",
+                error_code or status_code, delay, self.limiter.rate
+            )
+        else:
+            logger.warning("Graph API still throttling (%s) after %s attempt(s); giving up", error_code or status_code, attempt)
+        return retry
+
+    def _set_deferred(self, delta):
+        with self._lock:
+            self.deferred += delta
+
+    def send(self, payload, deadline=None):
+        """
+        Send a payload through the shared client at the allowed rate.
+
+        Throttled sends are retried until they succeed, fail for another
+        reason or exceed max_wait; the last GraphResponse is returned.
+        """
+        started = time.monotonic()
+        attempt = 0
+        status = None
+        result = None
+        try:
+            while True:
+                self.limiter.acquire()
+                try:
+                    result = get_whatsapp_client().send(payload, deadline=deadline)
+                except requests.RequestException as e:
+                    status = type(e).__name__
+                    raise
+                status = result.status_code
+
+                if not is_throttled(result.status_code, result.error_code):
+                    if result.ok:
+                        self.limiter.succeeded()
+                    return result
+
+                attempt += 1
+                if attempt == 1:
+                    self._set_deferred(1)
+                if not self.defer(attempt, started, result.status_code, result.error_code, result.retry_after):
+                    return result
+        finally:
+            if attempt:
+                self._set_deferred(-1)
+            self.metrics.record(status, time.monotonic() - started, bool(result and result.ok))
+
+    def snapshot(self):
+        """Current rate, queue depth and end-to-end latency (including time spent queued)"""
+        stats = self.metrics.snapshot()
+        stats.update(
+            rate=self.limiter.rate,
+            queue_depth=self.limiter.waiting + self.deferred,
+            waiting=self.limiter.waiting,
+            deferred=self.deferred,
+            throttled=self.limiter.throttles,
+            retries=self.retries,
+            given_up=self.given_up,
+        )
+        return stats
+
+    def describe(self):
+        """One-line summary of snapshot() for command output"""
+        stats = self.snapshot()
+        return (
+            f"WhatsApp: {stats['requests']} send(s) at {stats['rate']:.1f} msg/s, "
+            f"{stats['throttled']} throttled, {stats['retries']} retried, {stats['given_up']} given up, "
+            f"queue depth {stats['queue_depth']}, latency p50 {stats['p50_ms']:.0f} ms / "
+            f"p95 {stats['p95_ms']:.0f} ms / p99 {stats['p99_ms']:.0f} ms"
+        )
+
+
+_client = None
+_scheduler = None
+_client_lock = threading.Lock()
+
+
+def get_whatsapp_client():
+    """Return the process-wide WhatsApp client"""
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WhatsAppClient()
+    return _client
+
+
+def get_whatsapp_scheduler():
+    """Return the process-wide send scheduler"""
+    global _scheduler
+
+    if _scheduler is None:
+        with _client_lock:
+            if _scheduler is None:
+                _scheduler = WhatsAppScheduler()
+    return _scheduler
+
+
+@receiver(setting_changed)
+def reset_whatsapp_client(setting, **kwargs):
+    """Rebuild the client and scheduler when their settings change (e.g. in tests)"""
+    global _client, _scheduler
+
+    if setting.startswith('WHATSAPP_') or setting == 'PHONE_NUMBER_ID':
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
+            _scheduler = None
@@ -0,0 +1,135 @@
+"""
+Commands understood in incoming WhatsApp text messages.
+
+COMMANDS declares every barber and customer command with its English and
+Spanish aliases and the roles allowed to use it. At import time the
+registry is compiled into one case-insensitive regular expression that
+matches whole words only ("unlisted" is not "list"), so routing a message is
+a single scan however many commands there are. When a message names several
+commands, the one declared first wins.
+
+The sender's role is resolved once per message by comparing digits with
+the barber's number, which is normalized once and cached. The router keeps
+per-command counters and latency percentiles of the handlers it routes to
+(COMMAND_ROUTER.snapshot()).
+"""
+import re
+import threading
+from collections import namedtuple
+import logging
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .whatsapp import ClientMetrics
+
+logger = logging.getLogger(__name__)
+
+BARBER = 'barber'
+CUSTOMER = 'customer'
+EVERYONE = (BARBER, CUSTOMER)
+
+# Name used for messages that match no command
+UNKNOWN = 'unknown'
+
+Command = namedtuple('Command', 'name aliases roles denied_message', defaults=(EVERYONE, ''))
+
+# Declaration order is match priority
+COMMANDS = (
+    Command('cancel', ('cancel', 'cancelar', 'anular')),
+    Command('confirm', ('confirm', 'confirmar')),
+    Command('status', ('status', 'estado')),
+    Command('help', ('help', 'ayuda')),
+    Command('approve', ('approve', 'accept', 'aprobar', 'aceptar'), (BARBER,),
+            "You are not authorized to approve appointments."),
+    Command('deny', ('deny', 'reject', 'rechazar', 'denegar'), (BARBER,),
+            "You are not authorized to reject appointments."),
+    Command('pending', ('pending', 'list', 'pendiente', 'pendientes', 'lista'), (BARBER,),
+            "You are not authorized to view pending appointments."),
+)
+
+_barber_number = None
+_barber_lock = threading.Lock()
+
+
+def normalize_number(phone_number):
+    """Digits of a phone number, for comparing numbers written differently"""
+    return ''.join(filter(str.isdigit, str(phone_number)))
+
+
+def barber_number():
+    """The barber's WhatsApp number, normalized once"""
+    global _barber_number
+
+    if _barber_number is None:
+        with _barber_lock:
+            if _barber_number is None:
+                _barber_number = normalize_number(settings.BARBER_WHATSAPP)
+    return _barber_number
+
+
+@receiver(setting_changed)
+def reset_barber_number(setting, **kwargs):
+    """Normalize the number again when it changes (e.g. in tests)"""
+    global _barber_number
+
+    if setting == 'BARBER_WHATSAPP':
+        _barber_number = None
+
+
+def role_for(phone_number):
+    """BARBER for the barber's number, CUSTOMER for anyone else"""
+    return BARBER if normalize_number(phone_number) == barber_number() else CUSTOMER
+
+
+class CommandRouter:
+    """Matches text against a compiled command registry and times the handlers"""
+
+    def __init__(self, commands):
+        self.commands = {command.name: command for command in commands}
+        self.priority = {command.name: index for index, command in enumerate(commands)}
+
+        # One named group per command; longer aliases first so the longest word wins
+        alternatives = '|'.join(
+            f"(?P<{command.name}>{'|'.join(re.escape(alias) for alias in sorted(command.aliases, key=len, reverse=True))})"
+            for command in commands
+        )
+        self.pattern = re.compile(rf'\b(?:{alternatives})\b', re.IGNORECASE)
+
+        self.metrics = {name: ClientMetrics() for name in [*self.commands, UNKNOWN]}
+
+    def match(self, text):
+        """The highest-priority command named in text, or None"""
+        best = None
+        for found in self.pattern.finditer(text):
+            if best is None or self.priority[found.lastgroup] < self.priority[best]:
+                best = found.lastgroup
+                if self.priority[best] == 0:
+                    break
+        return self.commands[best] if best else None
+
+    def record(self, name, role, elapsed, ok):
+        """Count one handled message for a command (or UNKNOWN)"""
+        self.metrics[name].record(role, elapsed, ok)
+
+    def snapshot(self):
+        """Counts and latency percentiles per command that has handled a message"""
+        snapshots = {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+        return {name: stats for name, stats in snapshots.items() if stats['requests']}
+
+    def describe(self):
+        """One-line summary of the commands handled so far"""
+        snapshot = self.snapshot()
+        if not snapshot:
+            return 'WhatsApp commands: none handled'
+        return 'WhatsApp commands: ' + ', '.join(
+            f"{name} {stats['requests']} (p50 {stats['p50_ms']:.0f} ms, p95 {stats['p95_ms']:.0f} ms"
+            + (f", {stats['errors']} failed)" if stats['errors'] else ')')
+            for name, stats in snapshot.items()
+        )
+
+    def reset(self):
+        for metrics in self.metrics.values():
+            metrics.reset()
+
+
+COMMAND_ROUTER = CommandRouter(COMMANDS)
@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fitblendz_pro.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """Django, plus the lifespan events Django does not handle itself"""
+    if scope['type'] == 'lifespan':
+        from booking.async_views import lifespan
+        await lifespan(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -66,6 +66,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'fitblendz_pro.wsgi.application'
+ASGI_APPLICATION = 'fitblendz_pro.asgi.application'
+
+# Serve booking, status, available-times and the webhook with async views
+# (enable when running under ASGI, e.g. gunicorn with uvicorn workers)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False').lower() == 'true'
 
 # Database Configuration
 # Use SQLite for deployment (can be changed to PostgreSQL later)
@@ -73,6 +78,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts so concurrent
+            # booking transactions queue up instead of failing mid-way
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # Threaded tests need a file: shared in-memory SQLite reports locked
+        # tables instead of waiting for them
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -155,8 +171,17 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
-# Rate Limiting (if using django-ratelimit)
-RATELIMIT_USE_CACHE = 'default'
+# Rate Limiting (GCRA buckets in the cache below; 'N/s', 'N/m', 'N/h' or 'N/d' per view).
+# Webhook deliveries signed with WHATSAPP_APP_SECRET are not limited.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_CACHE = 'default'
+RATE_LIMIT_TRUST_X_FORWARDED_FOR = os.getenv('RATE_LIMIT_TRUST_X_FORWARDED_FOR', 'False').lower() == 'true'
+RATE_LIMITS = {
+    'booking': os.getenv('RATE_LIMIT_BOOKING', '5/m'),
+    'webhook': os.getenv('RATE_LIMIT_WEBHOOK', '600/m'),
+    'available_times': os.getenv('RATE_LIMIT_AVAILABLE_TIMES', '60/m'),
+    'appointment_status': os.getenv('RATE_LIMIT_APPOINTMENT_STATUS', '30/m'),
+}
 
 # Caching Configuration
 CACHES = {
@@ -175,27 +200,103 @@ CACHE_MIDDLEWARE_ALIAS = 'default'
 CACHE_MIDDLEWARE_SECONDS = 300  # 5 minutes
 CACHE_MIDDLEWARE_KEY_PREFIX = 'fitblendz'
 
+# Max age (seconds) of the in-process WorkingHours/Holiday schedule cache
+SCHEDULE_CACHE_TIMEOUT = int(os.getenv('SCHEDULE_CACHE_TIMEOUT', '300'))
+
+# Per-date availability response cache (invalidated by appointment writes).
+# Its version counters live in CACHES['default'], so with more than one worker
+# process that must be a shared backend (Redis, Memcached or the database
+# cache); with LocMemCache each process only sees its own invalidations.
+# Stale-while-revalidate serves an outdated entry while it is recomputed.
+AVAILABILITY_CACHE_TIMEOUT = int(os.getenv('AVAILABILITY_CACHE_TIMEOUT', '86400'))
+AVAILABILITY_CACHE_STALE_WHILE_REVALIDATE = os.getenv('AVAILABILITY_CACHE_STALE_WHILE_REVALIDATE', 'False').lower() == 'true'
+
 # WhatsApp Business API Configuration
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN', 'EAALYGYkTohABPFTc7s3aS2VNY6VCWLr7QoLFRBFRfnsZBPEJ3JWvEMxlyZAb7LW42itPLgPtcw8qBBlv0HaHqOmoR2K3PlPZBYkMZCxRNJRAFOVVPCYytVLNTJvW6zj714XQ6ZAw427pI7s7YOw3qZArbl9Pvi6nOFwlBLKKUN9FNCogEZC7duZCYFVZAPdit3phPtgZDZD')
 PHONE_NUMBER_ID = os.getenv('PHONE_NUMBER_ID', '720494921152084')
 WHATSAPP_VERIFY_TOKEN = os.getenv('WHATSAPP_VERIFY_TOKEN', 'fitblendz_whatsapp_verify_7c2f4b1e')
+# Meta app secret, used to check the X-Hub-Signature-256 header of webhook deliveries
+WHATSAPP_APP_SECRET = os.getenv('WHATSAPP_APP_SECRET', '')
 BARBER_WHATSAPP = os.getenv('BARBER_WHATSAPP', '+916239514954')
 
+# WhatsApp Graph API client (booking.whatsapp): keep-alive pool size and timeouts in seconds.
+# Set WHATSAPP_API_BASE_URL to a local fake (`manage.py run_fake_services`) to test offline.
+WHATSAPP_API_BASE_URL = os.getenv('WHATSAPP_API_BASE_URL', 'https://graph.facebook.com')
+WHATSAPP_API_VERSION = 'v20.0'
+WHATSAPP_POOL_SIZE = int(os.getenv('WHATSAPP_POOL_SIZE', '10'))
+WHATSAPP_CONNECT_TIMEOUT = float(os.getenv('WHATSAPP_CONNECT_TIMEOUT', '3.05'))
+WHATSAPP_TIMEOUT = float(os.getenv('WHATSAPP_TIMEOUT', '10'))
+
+# Adaptive send rate (messages/second): starts at WHATSAPP_RATE, grows while
+# sends succeed and halves on Graph API throttling. Throttled messages are
+# retried for up to WHATSAPP_THROTTLE_MAX_WAIT seconds.
+WHATSAPP_RATE = float(os.getenv('WHATSAPP_RATE', '20'))
+WHATSAPP_MIN_RATE = 1
+WHATSAPP_MAX_RATE = float(os.getenv('WHATSAPP_MAX_RATE', '80'))
+WHATSAPP_THROTTLE_MAX_WAIT = int(os.getenv('WHATSAPP_THROTTLE_MAX_WAIT', '60'))
+
+# Incoming webhook deliveries (booking.inbound): 'thread' (stored, then processed by a
+# background thread after the 200), 'worker' (only `manage.py process_inbound_events`)
+# or 'inline' (processed before answering)
+WHATSAPP_WEBHOOK_PROCESSING = os.getenv('WHATSAPP_WEBHOOK_PROCESSING', 'thread')
+WHATSAPP_WEBHOOK_WORKERS = int(os.getenv('WHATSAPP_WEBHOOK_WORKERS', '4'))
+# Attempts per stored event before it is parked as failed; retries back off
+# like notifications (NOTIFICATION_RETRY_BASE_SECONDS / _MAX_SECONDS)
+WHATSAPP_WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WHATSAPP_WEBHOOK_MAX_ATTEMPTS', '5'))
+INBOUND_EVENT_RETENTION_DAYS = 7
+
+# Incoming message ids kept to ignore Meta's redeliveries (booking.dedupe): how long
+# they are stored (seconds) and how many recent ones each process keeps in memory
+WHATSAPP_DEDUPE_TTL = int(os.getenv('WHATSAPP_DEDUPE_TTL', str(7 * 86400)))
+WHATSAPP_DEDUPE_CACHE_SIZE = 10000
+
 # Email Configuration
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_BACKEND = 'booking.mail.PooledEmailBackend'  # Django's SMTP backend with pooled connections
 EMAIL_HOST = os.getenv('EMAIL_HOST', 'smtp.gmail.com')  # Gmail SMTP (permanent solution)
 EMAIL_PORT = int(os.getenv('EMAIL_PORT', '587'))
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', 'bjot404@gmail.com')  # Your Gmail account
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', 'pane gfwn gggh nqkr')  # Gmail App Password
 
-EMAIL_USE_TLS = True
+EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', 'True').lower() == 'true'  # False for a local SMTP sink
 EMAIL_USE_SSL = False
 DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'bjot404@gmail.com')
 
 # Email timeout settings
 EMAIL_TIMEOUT = 30
 
+# SMTP connection pool (booking.mail.PooledEmailBackend)
+EMAIL_POOL_SIZE = int(os.getenv('EMAIL_POOL_SIZE', '4'))
+EMAIL_POOL_IDLE_TIMEOUT = int(os.getenv('EMAIL_POOL_IDLE_TIMEOUT', '60'))
+EMAIL_POOL_MAX_MESSAGES = int(os.getenv('EMAIL_POOL_MAX_MESSAGES', '100'))
+
+# Notification outbox delivery: 'thread' (background pool after commit),
+# 'sync' (inline after commit) or 'worker' (only `manage.py run_outbox`)
+NOTIFICATION_DISPATCH = os.getenv('NOTIFICATION_DISPATCH', 'thread')
+NOTIFICATION_WORKERS = int(os.getenv('NOTIFICATION_WORKERS', '4'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '5'))
+NOTIFICATION_RETRY_BASE_SECONDS = 30
+NOTIFICATION_RETRY_MAX_SECONDS = 3600
+
+# `manage.py send_reminders`: concurrent sends and overall send budget
+REMINDER_WORKERS = int(os.getenv('REMINDER_WORKERS', '8'))
+REMINDER_MESSAGES_PER_SECOND = float(os.getenv('REMINDER_MESSAGES_PER_SECOND', '20'))
+
+# How long a booking Idempotency-Key replays its original response (seconds)
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', '86400'))
+
 # Logging Configuration
+# Each subsystem's loggers run at LOG_LEVEL_<SUBSYSTEM> (default LOG_LEVEL). Bulky payloads
+# (webhook bodies, Graph API requests) are logged at DEBUG for a sample of calls only,
+# with secrets and phone numbers masked (booking.structured_logging)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_SUBSYSTEMS = {
+    'views': ['booking.views', 'booking.async_views'],
+    'webhook': ['booking.webhook_views', 'booking.inbound', 'booking.webhook_batch', 'booking.dedupe', 'booking.whatsapp_commands'],
+    'notifications': ['booking.utils', 'booking.notifications', 'booking.whatsapp', 'booking.mail'],
+}
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+LOG_PAYLOAD_MAX_CHARS = 1000
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -215,7 +316,7 @@ LOGGING = {
             'formatter': 'verbose',
         },
         'file': {
-            'class': 'logging.FileHandler',
+            'class': 'booking.structured_logging.QueuedFileHandler',
             'filename': BASE_DIR / 'django.log',
             'formatter': 'verbose',
         },
@@ -232,8 +333,13 @@ LOGGING = {
         },
         'booking': {
             'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': False,
         },
+        **{
+            logger_name: {'level': os.getenv(f'LOG_LEVEL_{subsystem.upper()}', LOG_LEVEL)}
+            for subsystem, logger_names in LOG_SUBSYSTEMS.items()
+            for logger_name in logger_names
+        },
     },
 }